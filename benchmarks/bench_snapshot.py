@@ -0,0 +1,419 @@
+"""
+End-to-end benchmarks of `nshsnap.snapshot()` on synthetic git repositories.
+
+Each repository shape is generated once (offline, with a fixed seed), and
+every run snapshots it in a fresh subprocess with its own `HOME`, so the
+nshsnap caches of the user are never touched. The first run of each shape
+starts with empty caches; later runs reuse them.
+
+Usage:
+    python benchmarks/bench_snapshot.py --output results.json
+    python benchmarks/bench_snapshot.py --shapes small_files,huge_files --repeat 5
+    python benchmarks/bench_snapshot.py --output new.json --compare results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+RESULTS_VERSION = 1
+
+# Phases that are reported for every run, in seconds
+PHASES = ["total", "environment", "git", "copy", "metadata"]
+
+# Differences below this many seconds are considered noise by `--compare`
+NOISE_FLOOR_SECONDS = 0.05
+
+
+@dataclass
+class Shape:
+    name: str
+    modules: list[str]
+    """The modules to snapshot."""
+
+    python_path: list[str] = field(default_factory=list)
+    """The `sys.path` entries that make the modules importable."""
+
+    editable: bool = False
+    """Whether the modules are installed as editable packages (`editable_modules=True`)."""
+
+
+def _git_commit_all(repo: Path):
+    def git(*args: str):
+        subprocess.run(
+            ["git", "-C", str(repo), *args],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    git("init", "-q")
+    git("add", "-A")
+    git(
+        "-c",
+        "user.name=nshsnap-bench",
+        "-c",
+        "user.email=bench@localhost",
+        "-c",
+        "commit.gpgsign=false",
+        "commit",
+        "-q",
+        "-m",
+        "Initial commit",
+    )
+
+
+def _write_files(
+    directory: Path,
+    count: int,
+    rng: random.Random,
+    min_size: int = 512,
+    max_size: int = 4096,
+    per_dir: int = 50,
+):
+    for i in range(count):
+        subdir = directory / f"sub{i // per_dir:04d}"
+        if i % per_dir == 0:
+            subdir.mkdir(parents=True, exist_ok=True)
+            (subdir / "__init__.py").write_text("")
+        size = rng.randint(min_size, max_size)
+        (subdir / f"mod{i:06d}.py").write_text(f"# {i}\n" + "x = 1\n" * (size // 6))
+
+
+def _package(repo: Path, name: str) -> Path:
+    package = repo / "src" / name
+    package.mkdir(parents=True)
+    (package / "__init__.py").write_text(f'"""The {name} package."""\n')
+    return package
+
+
+def _shape_small_files(root: Path, scale: float, rng: random.Random) -> Shape:
+    package = _package(root, "bench_small")
+    _write_files(package, max(1, int(5000 * scale)), rng)
+    _git_commit_all(root)
+    return Shape("small_files", ["bench_small"], [str(root / "src")])
+
+
+def _shape_huge_files(root: Path, scale: float, rng: random.Random) -> Shape:
+    package = _package(root, "bench_huge")
+    size = max(1, int(32 * 1024 * 1024 * scale))
+    for i in range(4):
+        (package / f"blob{i}.bin").write_bytes(rng.randbytes(size))
+    _git_commit_all(root)
+    return Shape("huge_files", ["bench_huge"], [str(root / "src")])
+
+
+def _shape_deep_nesting(root: Path, scale: float, rng: random.Random) -> Shape:
+    package = _package(root, "bench_deep")
+    directory = package
+    for depth in range(max(2, int(50 * scale))):
+        directory = directory / f"level{depth:03d}"
+        directory.mkdir()
+        (directory / "__init__.py").write_text("")
+        for i in range(5):
+            (directory / f"mod{i}.py").write_text("x = 1\n" * rng.randint(10, 100))
+    _git_commit_all(root)
+    return Shape("deep_nesting", ["bench_deep"], [str(root / "src")])
+
+
+def _shape_ignored_tree(root: Path, scale: float, rng: random.Random) -> Shape:
+    package = _package(root, "bench_ignored")
+    _write_files(package, 200, rng)
+    (root / ".gitignore").write_text("build/\n*.pyc\n__pycache__/\n")
+    _write_files(package / "build", max(1, int(20000 * scale)), rng, 64, 256, 500)
+    cache = package / "__pycache__"
+    cache.mkdir()
+    for i in range(max(1, int(2000 * scale))):
+        (cache / f"mod{i}.cpython.pyc").write_bytes(rng.randbytes(128))
+    _git_commit_all(root)
+    # An untracked (but not ignored) file
+    (package / "scratch.py").write_text("y = 2\n")
+    return Shape("ignored_tree", ["bench_ignored"], [str(root / "src")])
+
+
+def _shape_many_packages(root: Path, scale: float, rng: random.Random) -> Shape:
+    # Editable installs are registered with PEP 610 `direct_url.json` files in
+    # a site directory, as `pip install -e` would (without needing pip).
+    site_dir = root / "site-packages"
+    site_dir.mkdir(parents=True)
+    modules: list[str] = []
+    python_path = [str(site_dir)]
+    for i in range(max(1, int(30 * scale))):
+        name = f"bench_pkg{i:03d}"
+        repo = root / name
+        _write_files(_package(repo, name), 50, rng)
+        _git_commit_all(repo)
+
+        dist_info = site_dir / f"{name}-0.1.0.dist-info"
+        dist_info.mkdir()
+        (dist_info / "METADATA").write_text(
+            f"Metadata-Version: 2.1\nName: {name}\nVersion: 0.1.0\n"
+        )
+        (dist_info / "top_level.txt").write_text(f"{name}\n")
+        (dist_info / "direct_url.json").write_text(
+            json.dumps({"url": repo.as_uri(), "dir_info": {"editable": True}})
+        )
+        modules.append(name)
+        python_path.append(str(repo / "src"))
+    return Shape("many_packages", modules, python_path, editable=True)
+
+
+SHAPES: dict[str, Callable[[Path, float, random.Random], Shape]] = {
+    "small_files": _shape_small_files,
+    "huge_files": _shape_huge_files,
+    "deep_nesting": _shape_deep_nesting,
+    "ignored_tree": _shape_ignored_tree,
+    "many_packages": _shape_many_packages,
+}
+
+
+def generate_shape(workdir: Path, name: str, scale: float, seed: int) -> Shape:
+    """Generate the repository of a shape, unless it was already generated."""
+    root = workdir / "repos" / f"{name}-{scale:g}-{seed}"
+    spec = root / "shape.json"
+    if spec.is_file():
+        return Shape(**json.loads(spec.read_text()))
+
+    shutil.rmtree(root, ignore_errors=True)
+    root.mkdir(parents=True)
+    start = time.perf_counter()
+    shape = SHAPES[name](root, scale, random.Random(seed))
+    spec.write_text(json.dumps(asdict(shape)))
+    print(
+        f"Generated {name} in {time.perf_counter() - start:.1f}s ({root})",
+        file=sys.stderr,
+    )
+    return shape
+
+
+def run_worker(shape: Shape, options: dict) -> dict:
+    """Snapshot the shape in this process, and return its phase timings."""
+    sys.path[:0] = shape.python_path
+    import nshsnap
+
+    snapshot_dir = Path(options["snapshot_dir"])
+    config = {
+        "modules": [] if shape.editable else shape.modules,
+        "editable_modules": shape.editable,
+        "snapshot_dir": snapshot_dir,
+        "copy_strategy": options["copy_strategy"],
+        "format": options["format"],
+        "store": options["store"],
+    }
+    info = nshsnap.snapshot(config)
+    assert info.timings is not None
+
+    # Phases of modules that are snapshot concurrently add up the time spent
+    # in every thread.
+    categories = info.timings.categories()
+    timings = {phase: categories.get(phase, 0.0) for phase in PHASES}
+    timings["total"] = info.timings.total
+    return {
+        "phases": timings,
+        "git_subprocesses": info.timings.subprocesses.get("git", 0),
+        "modules": len(info.modules),
+        "files": info.timings.files_copied,
+        "bytes": info.timings.bytes_copied,
+    }
+
+
+def _run_once(
+    shape: Shape,
+    home: Path,
+    snapshot_dir: Path,
+    args: argparse.Namespace,
+) -> dict:
+    options = {
+        "snapshot_dir": str(snapshot_dir),
+        "copy_strategy": args.copy_strategy,
+        "format": args.format,
+        "store": args.store,
+    }
+    env = {
+        **os.environ,
+        "HOME": str(home),
+        "PYTHONPATH": os.pathsep.join(
+            [str(Path(__file__).parents[1] / "src"), os.environ.get("PYTHONPATH", "")]
+        ),
+    }
+    process = subprocess.run(
+        [
+            sys.executable,
+            __file__,
+            "--worker",
+            json.dumps({"shape": asdict(shape), "options": options}),
+        ],
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+        text=True,
+    )
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="nshsnap_bench_"))
+    results: dict[str, dict] = {}
+    for name in args.shapes:
+        shape = generate_shape(workdir, name, args.scale, args.seed)
+
+        home = workdir / "home" / name
+        shutil.rmtree(home, ignore_errors=True)
+        home.mkdir(parents=True)
+
+        runs = []
+        for i in range(args.repeat):
+            snapshot_dir = workdir / "snapshots" / f"{name}-{i}"
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            run = _run_once(shape, home, snapshot_dir, args)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            runs.append(run)
+            phases = "  ".join(f"{p}={run['phases'][p]:.3f}s" for p in PHASES)
+            print(f"{name} [{i}]  {phases}", file=sys.stderr)
+
+        results[name] = {
+            "runs": runs,
+            "median": {
+                phase: statistics.median(run["phases"][phase] for run in runs)
+                for phase in PHASES
+            },
+        }
+
+    if not args.keep and args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": time.time(),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "options": {
+            "scale": args.scale,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "copy_strategy": args.copy_strategy,
+            "format": args.format,
+            "store": args.store,
+        },
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> list[str]:
+    """Print the phase medians of both runs, and return the regressions."""
+    if old.get("options") != new.get("options"):
+        print(
+            "Warning: the runs used different options "
+            f"({old.get('options')} vs. {new.get('options')})",
+            file=sys.stderr,
+        )
+
+    regressions: list[str] = []
+    print(f"{'shape':<16}{'phase':<13}{'old':>10}{'new':>10}{'change':>9}")
+    for name, result in new["results"].items():
+        if (old_result := old["results"].get(name)) is None:
+            continue
+        for phase in PHASES:
+            before = old_result["median"][phase]
+            after = result["median"][phase]
+            change = (after - before) / before if before > 0 else 0.0
+            regressed = (
+                after > before * (1 + threshold)
+                and after - before > NOISE_FLOOR_SECONDS
+            )
+            if regressed:
+                regressions.append(f"{name}/{phase}")
+            print(
+                f"{name:<16}{phase:<13}{before:>9.3f}s{after:>9.3f}s{change:>+8.0%}"
+                f"{'  REGRESSION' if regressed else ''}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--shapes",
+        type=lambda value: value.split(","),
+        default=list(SHAPES),
+        help=f"Comma-separated repository shapes (default: {','.join(SHAPES)})",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplier for the number and size of the generated files (default: 1)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per shape (default: 3)"
+    )
+    parser.add_argument(
+        "--copy-strategy",
+        choices=["auto", "rsync", "native", "reflink", "hardlink"],
+        default="auto",
+    )
+    parser.add_argument("--format", choices=["directory", "zip"], default="directory")
+    parser.add_argument("--store", action="store_true")
+    parser.add_argument(
+        "--workdir",
+        help="Where to generate the repositories. Generated repositories are "
+        "reused by later runs with the same workdir (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the temporary workdir"
+    )
+    parser.add_argument("--output", type=Path, help="Write the results to this file")
+    parser.add_argument(
+        "--compare", type=Path, help="Compare the results against a previous run"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown that counts as a regression (default: 0.2)",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the nshsnap logs")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        payload = json.loads(args.worker)
+        print(json.dumps(run_worker(Shape(**payload["shape"]), payload["options"])))
+        return
+
+    if unknown := set(args.shapes) - set(SHAPES):
+        parser.error(f"Unknown shapes: {', '.join(sorted(unknown))}")
+
+    results = run_benchmarks(args)
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=4))
+        print(f"Wrote the results to {args.output}", file=sys.stderr)
+
+    if args.compare is not None:
+        regressions = compare(
+            json.loads(args.compare.read_text()), results, args.threshold
+        )
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,5 +24,12 @@ def lint(session: nox.Session) -> None:
     session.run("basedpyright", "src")
 
 
+@nox.session(python=PYTHON_VERSIONS)
+def test(session: nox.Session) -> None:
+    """Run the tests against different Python versions."""
+    session.install(".[extra]", "pytest")
+    session.run("pytest", "tests", *session.posargs)
+
+
 if __name__ == "__main__":
     nox.main()
@@ -1,11 +1,59 @@
 from __future__ import annotations
 
+import importlib
+from typing import TYPE_CHECKING, Any
+
 from ._config import SnapshotConfig as SnapshotConfig
 from ._load import load_existing_snapshot as load_existing_snapshot
+from ._manifest import ManifestEntry as ManifestEntry
+from ._manifest import lookup_manifest as lookup_manifest
+from ._manifest import read_manifest as read_manifest
 from ._snapshot import ActiveSnapshot as ActiveSnapshot
 from ._snapshot import snapshot as snapshot
+from ._trace import SnapshotTimings as SnapshotTimings
+from ._trace import TraceEvent as TraceEvent
 from ._util import snapshot_id as snapshot_id
 
+if TYPE_CHECKING:
+    from ._async import asnapshot as asnapshot
+    from ._batch import snapshot_many as snapshot_many
+    from ._catalog import CatalogEntry as CatalogEntry
+    from ._catalog import list_snapshots as list_snapshots
+    from ._catalog import rebuild_catalog as rebuild_catalog
+    from ._export import export_snapshot as export_snapshot
+    from ._export import import_snapshot as import_snapshot
+    from ._gc import GCResult as GCResult
+    from ._gc import gc_snapshots as gc_snapshots
+    from ._stage_local import stage_locally as stage_locally
+
+# Imported on first use, so that `import nshsnap` (e.g., in every job that
+# loads a snapshot) does not pay for asyncio, sqlite3, tarfile, etc.
+_LAZY_IMPORTS = {
+    "asnapshot": "._async",
+    "snapshot_many": "._batch",
+    "CatalogEntry": "._catalog",
+    "list_snapshots": "._catalog",
+    "rebuild_catalog": "._catalog",
+    "export_snapshot": "._export",
+    "import_snapshot": "._export",
+    "GCResult": "._gc",
+    "gc_snapshots": "._gc",
+    "stage_locally": "._stage_local",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if (module := _LAZY_IMPORTS.get(name)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *_LAZY_IMPORTS})
+
+
 SnapshotInfo = ActiveSnapshot
 
 try:
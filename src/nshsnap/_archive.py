@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import time
+import zipfile
+from collections.abc import Iterable
+from pathlib import Path
+
+from ._util import SNAPSHOT_ARCHIVE_NAME
+
+log = logging.getLogger(__name__)
+
+# The earliest timestamp that can be stored in a zip file
+_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _zip_info(arcname: str, path: Path) -> zipfile.ZipInfo:
+    st = path.stat()
+    date_time = max(time.localtime(st.st_mtime)[:6], _ZIP_EPOCH)
+    info = zipfile.ZipInfo(arcname, date_time=date_time)
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    info.compress_type = zipfile.ZIP_STORED
+    # `ZipFile.open` decides up front whether the entry needs ZIP64
+    info.file_size = 0 if arcname.endswith("/") else st.st_size
+    return info
+
+
+def _walk_sorted(root: Path) -> Iterable[tuple[str, Path]]:
+    """
+    Yield ``(arcname, path)`` for ``root`` and everything below it, sorted.
+    Symlinks to directories are followed, like symlinks to files, unless they
+    point to a directory that is already archived (e.g., a cycle).
+    """
+    seen: set[str] = set()
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        base = Path(dirpath)
+        seen.add(os.path.realpath(base))
+        for name in list(dirnames):
+            if (path := base / name).is_symlink() and os.path.realpath(path) in seen:
+                log.warning(
+                    f"Not archiving {path}, a symlink to the directory "
+                    f"{os.path.realpath(path)} that is already in the archive"
+                )
+                dirnames.remove(name)
+        dirnames.sort()
+        yield f"{base.relative_to(root.parent).as_posix()}/", base
+        for filename in sorted(filenames):
+            path = base / filename
+            yield path.relative_to(root.parent).as_posix(), path
+
+
+def archive_modules(snapshot_dir: Path, top_level_names: Iterable[str]) -> Path:
+    """
+    Move the given top-level entries of the snapshot directory into a single
+    uncompressed zip archive that `zipimport` can import from.
+
+    Entries are written in sorted order, with explicit directory entries, and
+    the archive is only moved into place once it is complete.
+
+    Returns:
+        The path to the archive.
+    """
+    archive = snapshot_dir / SNAPSHOT_ARCHIVE_NAME
+    tmp = archive.with_name(f"{archive.name}.tmp")
+
+    names = sorted(set(top_level_names))
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name in names:
+            for arcname, path in _walk_sorted(snapshot_dir / name):
+                if arcname.endswith("/"):
+                    zf.writestr(_zip_info(arcname, path), b"")
+                else:
+                    # Symlinks are stored as the contents of their target.
+                    info = _zip_info(arcname, path)
+                    with open(path, "rb") as f:
+                        with zf.open(info, "w") as w:
+                            shutil.copyfileobj(f, w, _CHUNK_SIZE)
+    os.replace(tmp, archive)
+
+    for name in names:
+        shutil.rmtree(snapshot_dir / name)
+
+    log.info(f"Archived {', '.join(names)} to {archive}")
+    return archive
+
+
+def archive_module_names(archive: Path) -> list[str]:
+    """Return the top-level packages in a snapshot archive."""
+    with zipfile.ZipFile(archive) as zf:
+        return sorted({name.split("/", 1)[0] for name in zf.namelist() if "/" in name})
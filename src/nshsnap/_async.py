@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Generator
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, TypeVar, cast
+
+from . import _catalog, _copy, _reuse, _trace
+from ._config import SnapshotConfig
+from ._copy import _RSYNC_FILES_FROM_ARGS, CopyStats
+from ._files import _git_ls_files_command, list_source_files, use_git
+from ._incremental import resolve_base_snapshot
+from ._lease import hold_lease, release_lease
+from ._manifest import ManifestBuilder
+from ._pip_deps import EnvironmentInfo, current_environment
+from ._snapshot import (
+    ActiveSnapshot,
+    SnapshotModuleInfo,
+    _base_module_resolver,
+    _ensure_supported,
+    _find_modules,
+    _finish_snapshot,
+    _load_module_infos,
+    _module_location,
+    _save_timings,
+    _snapshot_meta,
+    _snapshot_module_steps,
+)
+from ._store import SnapshotStore, StoreStats
+from ._util import Step, gitignored_dir, run_git
+
+if TYPE_CHECKING:
+    from . import configs
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_LOCK_POLL_SECONDS = 0.05
+
+
+async def _in_thread(fn: Callable[..., T], *args: Any) -> T:
+    """
+    Run ``fn`` in the default executor, in a copy of the current context.
+
+    Threads cannot be interrupted, so if the calling task is cancelled, the
+    cancellation only propagates once ``fn`` returns. This way, a cancelled
+    snapshot is only removed once nothing writes to it anymore.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    future = loop.run_in_executor(
+        None, cast(Callable[[], T], functools.partial(context.run, fn, *args))
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # The task may be cancelled again while it waits (e.g., by `_gather`
+        # once another awaitable was cancelled), which must not cut it short.
+        while not future.done():
+            with contextlib.suppress(asyncio.CancelledError):
+                await asyncio.wait([future])
+        if not future.cancelled():
+            # Consumed, so that asyncio does not log it as never retrieved
+            future.exception()
+        raise
+
+
+async def _gather(*aws: Awaitable[Any]) -> list[Any]:
+    """
+    Like `asyncio.gather`, but once one of the awaitables fails (or the caller
+    is cancelled), the others are cancelled and awaited before raising.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _kill(processes: list[asyncio.subprocess.Process]):
+    for process in processes:
+        if process.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+    for process in processes:
+        await process.wait()
+
+
+async def _run(
+    *args: str,
+    input: bytes | None = None,
+    env: dict[str, str] | None = None,
+) -> bytes:
+    """
+    Run a command without blocking the event loop, and return its stdout.
+    The command is killed if the calling task is cancelled.
+
+    Raises:
+        subprocess.CalledProcessError: If the command fails.
+    """
+    _trace.add_subprocess(args)
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    try:
+        stdout, stderr = await process.communicate(input)
+    except BaseException:
+        await _kill([process])
+        raise
+    if process.returncode != 0:
+        assert process.returncode is not None
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+    return stdout
+
+
+async def _copy_rsync(source: Path, location: Path):
+    """The asynchronous equivalent of `_copy_rsync`."""
+    target_root = location / source.name
+    target_root.mkdir(parents=True, exist_ok=True)
+    rsync_args = [*_RSYNC_FILES_FROM_ARGS, f"{source}/", f"{target_root}/"]
+
+    if not await _in_thread(use_git, source):
+        files = await _in_thread(
+            lambda: b"\0".join(os.fsencode(rel) for rel in list_source_files(source))
+        )
+        await _run(*rsync_args, input=files)
+        return
+
+    # `git ls-files` is piped straight into `rsync --files-from`
+    ls_files_args = _git_ls_files_command(source)
+    _trace.add_subprocess(ls_files_args)
+    _trace.add_subprocess(rsync_args)
+    processes: list[asyncio.subprocess.Process] = []
+    try:
+        read_fd, write_fd = os.pipe()
+        try:
+            processes.append(
+                await asyncio.create_subprocess_exec(*ls_files_args, stdout=write_fd)
+            )
+            processes.append(
+                await asyncio.create_subprocess_exec(*rsync_args, stdin=read_fd)
+            )
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        returncodes = await asyncio.gather(*(process.wait() for process in processes))
+    except BaseException:
+        await _kill(processes)
+        raise
+
+    for args, returncode in zip((ls_files_args, rsync_args), returncodes):
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+
+@contextlib.asynccontextmanager
+async def _file_lock(path: Path) -> AsyncIterator[None]:
+    """
+    The asynchronous equivalent of `file_lock`, which polls for the lock
+    instead of blocking the event loop.
+    """
+    import fcntl
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(_LOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+async def _run_git(
+    path: Path,
+    args: tuple[str, ...],
+    env: dict[str, str] | None = None,
+    input: str | None = None,
+) -> str:
+    """The asynchronous equivalent of `run_git`."""
+    stdout = await _run(
+        "git",
+        "-C",
+        str(path),
+        *args,
+        input=input.encode() if input is not None else None,
+        env=env,
+    )
+    return stdout.decode().strip()
+
+
+_ASYNC_STEPS: dict[Callable[..., Any], Callable[..., Awaitable[Any]]] = {
+    run_git: _run_git,
+    _copy._copy_rsync: _copy_rsync,
+}
+"""The steps that run as asyncio subprocesses, instead of in a thread."""
+
+
+async def _run_steps(steps: Generator[Step, Any, T]) -> T:
+    """
+    The asynchronous equivalent of `run_steps`. The git and rsync steps run
+    as asyncio subprocesses, and the other steps run in threads.
+    """
+    result: Any = None
+    error: Exception | None = None
+    try:
+        while True:
+            try:
+                if error is not None:
+                    fn, args = steps.throw(error)
+                else:
+                    fn, args = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                if (async_fn := _ASYNC_STEPS.get(fn)) is not None:
+                    result, error = await async_fn(*args), None
+                else:
+                    result, error = await _in_thread(fn, *args), None
+            except Exception as e:
+                result, error = None, e
+    finally:
+        steps.close()
+
+
+async def _snapshot_modules(
+    config: SnapshotConfig,
+    snapshot_dir: Path,
+    modules: list[str],
+    store: SnapshotStore | None,
+    manifest: ManifestBuilder | None,
+    base_snapshot: Path | None,
+):
+    """
+    The asynchronous equivalent of `_snapshot_modules`. Up to
+    `config.module_workers` modules are snapshot concurrently.
+    """
+    git_references = config.git_references or {}
+    log.critical(f"Snapshotting {modules=} to {snapshot_dir}")
+
+    module_infos, found = await _in_thread(
+        _find_modules, modules, config.on_module_not_found, git_references
+    )
+    base_module = await _in_thread(_base_module_resolver, base_snapshot)
+
+    semaphore = asyncio.Semaphore(config.module_workers or min(8, len(found)) or 1)
+    parents_lock = threading.Lock()
+    start = time.perf_counter()
+
+    async def snapshot_module(module: str, location: Path):
+        async with semaphore:
+            with _trace.phase("module", module=module):
+                result = await _run_steps(
+                    _snapshot_module_steps(
+                        snapshot_dir,
+                        module,
+                        location,
+                        git_references.get(module),
+                        parents_lock,
+                        store,
+                        config.copy_strategy,
+                        config.copy_workers,
+                        base_module(module, location),
+                        config.staged,
+                    )
+                )
+        if manifest is not None and (destination := result[0].destination):
+            await _in_thread(manifest.add_tree, destination)
+        return result
+
+    results = await _gather(
+        *(snapshot_module(module, location) for _, module, location in found)
+    )
+
+    store_stats = StoreStats() if store is not None else None
+    copy_stats: CopyStats | None = None
+    for (index, _, _), (info, module_store_stats, module_copy_stats) in zip(
+        found, results
+    ):
+        module_infos[index] = info
+        if store_stats is not None and module_store_stats is not None:
+            store_stats.update(module_store_stats)
+        if module_copy_stats is not None:
+            copy_stats = copy_stats or CopyStats()
+            copy_stats.update(module_copy_stats)
+    if copy_stats is not None:
+        # Modules are copied concurrently, so report the wall-clock time.
+        copy_stats.seconds = time.perf_counter() - start
+
+    return (
+        [info for info in module_infos if info is not None],
+        store_stats,
+        copy_stats,
+    )
+
+
+def _remove_partial_snapshot(snapshot_dir: Path, preexisting: set[str] | None):
+    """
+    Remove what a cancelled snapshot wrote to ``snapshot_dir``. Entries that
+    were already in the directory (if it existed) are left alone.
+    """
+    if preexisting is None:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+    else:
+        for entry in snapshot_dir.iterdir():
+            if entry.name in preexisting:
+                continue
+            if entry.is_dir() and not entry.is_symlink():
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                entry.unlink(missing_ok=True)
+    _catalog.remove_snapshots([snapshot_dir])
+
+
+async def _create_snapshot(
+    config: SnapshotConfig,
+    modules: list[str],
+    environment: EnvironmentInfo,
+):
+    snapshot_dir = config._resolve_snapshot_dir().absolute()
+    # A generated snapshot directory was created just now (with its
+    # `.gitignore`), so all of it belongs to this snapshot.
+    preexisting = (
+        set(os.listdir(snapshot_dir))
+        if config.snapshot_dir is not None and snapshot_dir.is_dir()
+        else None
+    )
+    manifest = ManifestBuilder(snapshot_dir) if config.manifest else None
+    try:
+        return await _create_snapshot_in(
+            config, snapshot_dir, modules, environment, manifest
+        )
+    except asyncio.CancelledError:
+        log.warning(f"Snapshot cancelled. Removing the partial snapshot {snapshot_dir}")
+        if manifest is not None:
+            manifest.cancel()
+        _remove_partial_snapshot(snapshot_dir, preexisting)
+        raise
+
+
+async def _create_snapshot_in(
+    config: SnapshotConfig,
+    snapshot_dir: Path,
+    modules: list[str],
+    environment: EnvironmentInfo,
+    manifest: ManifestBuilder | None,
+):
+    await _in_thread(gitignored_dir, snapshot_dir)
+    hold_lease(snapshot_dir)
+    base_snapshot: Path | None = None
+    try:
+        with _trace.phase("base_snapshot"):
+            base_snapshot = await _in_thread(
+                resolve_base_snapshot, config.base_snapshot, snapshot_dir, modules
+            )
+        if base_snapshot is not None:
+            hold_lease(base_snapshot)
+
+        async def snapshot_meta():
+            with _trace.phase("metadata"):
+                await _in_thread(
+                    _snapshot_meta, config, snapshot_dir, environment, base_snapshot
+                )
+
+        # The metadata only writes to `.nshsnapmeta` and `.bin`, so it is
+        # captured while the modules are copied.
+        store = SnapshotStore(config._resolve_store_dir()) if config.store else None
+        _, (module_infos, store_stats, copy_stats) = await _gather(
+            snapshot_meta(),
+            _snapshot_modules(
+                config, snapshot_dir, modules, store, manifest, base_snapshot
+            ),
+        )
+        module_infos = await _in_thread(
+            _finish_snapshot, config, snapshot_dir, module_infos, manifest
+        )
+    except asyncio.CancelledError:
+        # The partial snapshot is removed, so neither it nor its base is in use.
+        if base_snapshot is not None:
+            release_lease(base_snapshot)
+        release_lease(snapshot_dir)
+        raise
+    return ActiveSnapshot(
+        config,
+        snapshot_dir,
+        module_infos,
+        store_stats=store_stats,
+        copy_stats=copy_stats,
+        base_snapshot=base_snapshot,
+    )
+
+
+async def _reuse_or_create_snapshot(
+    config: SnapshotConfig,
+    modules: list[str],
+    environment: EnvironmentInfo,
+):
+    with _trace.phase("reuse_key"):
+        key = await _in_thread(
+            lambda: _reuse.snapshot_key(
+                config, {module: _module_location(module) for module in modules}
+            )
+        )
+    if key is None:
+        return await _create_snapshot(config, modules, environment)
+
+    async with _file_lock(_reuse.lock_path(key)):
+        if (snapshot_dir := await _in_thread(_reuse.lookup, key)) is not None:
+            hold_lease(snapshot_dir)
+            log.critical(f"Reusing existing snapshot {snapshot_dir} for {modules=}")
+            return ActiveSnapshot(
+                config,
+                snapshot_dir,
+                await _in_thread(_load_module_infos, snapshot_dir),
+                reused=True,
+            )
+
+        active = await _create_snapshot(config, modules, environment)
+        await _in_thread(_reuse.publish, key, active.snapshot_dir)
+        return active
+
+
+async def _snapshot_traced(config: SnapshotConfig):
+    await _in_thread(_ensure_supported, config)
+
+    with _trace.phase("environment"):
+        environment = await _in_thread(current_environment)
+    with _trace.phase("resolve_modules"):
+        modules = await _in_thread(config._resolve_modules, environment)
+
+    if config.reuse:
+        if config.snapshot_dir is None:
+            return await _reuse_or_create_snapshot(config, modules, environment)
+        log.warning(
+            "Snapshot reuse is only supported for the default snapshot directory. "
+            f"Creating a new snapshot in {config.snapshot_dir}."
+        )
+
+    return await _create_snapshot(config, modules, environment)
+
+
+async def asnapshot(
+    config: configs.SnapshotConfigInstanceOrDict | None = None,
+    /,
+    *,
+    on_trace_event: _trace.TraceCallback | None = None,
+) -> ActiveSnapshot:
+    """
+    Snapshot the configured modules without blocking the event loop.
+
+    This runs the same pipeline as `snapshot`, but git and rsync run as
+    asyncio subprocesses, and filesystem work runs in threads. The modules
+    are snapshot concurrently, while the metadata is captured. Many
+    snapshots can be prepared concurrently from the same event loop.
+
+    If the task is cancelled, its subprocesses are killed and the partial
+    snapshot directory is removed before the cancellation propagates.
+
+    Args:
+        config: The snapshot configuration.
+        on_trace_event: Optional callback, which is called with a `TraceEvent`
+            as each phase of the snapshot finishes (see `snapshot`).
+    """
+    from . import configs
+
+    if config is None:
+        config = SnapshotConfig()
+
+    config = configs.CreateSnapshotConfig(config)
+    tracer = _trace.SnapshotTracer(on_trace_event)
+    with tracer.activate():
+        active = await _snapshot_traced(config)
+    timings = tracer.finish()
+
+    if not active.reused:
+        try:
+            await _in_thread(_save_timings, active.snapshot_dir, timings)
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to save the timings of {active.snapshot_dir}: {e}")
+    return dataclasses.replace(active, timings=timings)
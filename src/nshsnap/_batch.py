@@ -0,0 +1,516 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import subprocess
+import threading
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, ClassVar
+
+from . import _trace
+from ._config import SnapshotConfig
+from ._copy import CopyStats, _copy_file_hardlink, link_tree
+from ._lease import hold_lease
+from ._manifest import ManifestBuilder
+from ._pip_deps import current_environment
+from ._snapshot import (
+    ActiveSnapshot,
+    SnapshotModuleInfo,
+    _create_parent_packages,
+    _ensure_supported,
+    _find_modules,
+    _finish_snapshot,
+    _save_timings,
+    _snapshot_meta,
+    _snapshot_module,
+)
+from ._store import SnapshotStore, StoreStats
+from ._util import (
+    copy_symlink,
+    extract_git_reference,
+    get_current_git_reference,
+    gitignored_dir,
+    is_git_repository,
+)
+
+if TYPE_CHECKING:
+    from . import configs
+
+log = logging.getLogger(__name__)
+
+# `git ls-tree` entries of submodules, which are not files
+_GITLINK_MODE = "160000"
+
+
+@dataclass(slots=True)
+class _ModulePlan:
+    """How a module is snapshot into each snapshot of a batch."""
+
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    module: str
+    """The name of the module."""
+
+    location: Path
+    """The directory of the module."""
+
+    worktree: list[int] = field(default_factory=list)
+    """The snapshots that copy the working tree of the module. It is copied
+    into the first one, and linked into the others."""
+
+    commits: dict[str, list[int]] = field(default_factory=dict)
+    """The snapshots that extract each commit of the module. Each commit is
+    extracted into the first one, and linked into the others."""
+
+    entries: dict[str, dict[str, str]] = field(default_factory=dict)
+    """The files of each commit, and their git mode and object id."""
+
+    owners: dict[str, tuple[str, str]] = field(default_factory=dict)
+    """The commit (and path) that extracts each distinct file (git mode and
+    object id). The other commits link the file from it."""
+
+    references: dict[int, str] = field(default_factory=dict)
+    """The git reference that each snapshot requested."""
+
+    infos: dict[int, SnapshotModuleInfo] = field(default_factory=dict)
+    """The info of the module in each snapshot, once it is snapshot."""
+
+    copy_stats: dict[int, CopyStats] = field(default_factory=dict)
+    """The copy statistics of the working tree in each snapshot."""
+
+    store_stats: StoreStats | None = None
+    """The blob store statistics of the working tree copy, if any."""
+
+    git_reference_original: str | None = None
+    """The current git reference of the repository of the module."""
+
+
+def _git(location: Path, *args: str) -> str:
+    _trace.add_subprocess(["git"])
+    return subprocess.run(
+        ["git", "-C", str(location), *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    ).stdout
+
+
+def _tree_entries(location: Path, commit: str) -> dict[str, str]:
+    """The files under ``location`` in ``commit``, with their git mode and object id."""
+    entries: dict[str, str] = {}
+    # Paths are listed relative to `location`, as in `extract_git_reference`
+    for line in _git(location, "ls-tree", "-r", "-z", commit).split("\0"):
+        if not line:
+            continue
+        meta, rel = line.split("\t", 1)
+        mode, _, oid = meta.split(" ")
+        # Submodules are extracted by each commit on its own
+        entries[rel] = f"{commit} {rel}" if mode == _GITLINK_MODE else f"{mode} {oid}"
+    return entries
+
+
+def _failed_info(
+    plan: _ModulePlan,
+    index: int,
+    git_ref_original: str | None = None,
+) -> SnapshotModuleInfo:
+    return SnapshotModuleInfo(
+        name=plan.module,
+        status="git_reference_failed",
+        location=plan.location,
+        destination=None,
+        git_reference_requested=plan.references[index],
+        git_reference_original=git_ref_original,
+    )
+
+
+def _plan_module(
+    module: str,
+    location: Path,
+    reference_sets: list[dict[str, str]],
+) -> _ModulePlan:
+    """
+    Resolve the git references of ``module`` in each snapshot, and decide
+    which commit extracts each of their files.
+    """
+    plan = _ModulePlan(module, location)
+    for index, references in enumerate(reference_sets):
+        if (reference := references.get(module)) is None:
+            plan.worktree.append(index)
+        else:
+            plan.references[index] = reference
+    if not plan.references:
+        return plan
+
+    if not is_git_repository(location):
+        log.error(
+            f"Module {module} at {location} is not a git repository, "
+            f"but git references were specified. "
+            "Only git repositories support git references."
+        )
+        plan.infos = {index: _failed_info(plan, index) for index in plan.references}
+        return plan
+
+    with _trace.phase("git.resolve", module=module):
+        plan.git_reference_original = get_current_git_reference(location)
+        resolved: dict[str, str | None] = {}
+        for index, reference in plan.references.items():
+            if reference not in resolved:
+                try:
+                    resolved[reference] = _git(
+                        location, "rev-parse", "--verify", f"{reference}^{{commit}}"
+                    ).strip()
+                except subprocess.CalledProcessError as e:
+                    log.error(
+                        f"Failed to resolve git reference '{reference}' "
+                        f"for module {module}: {e}"
+                    )
+                    resolved[reference] = None
+            if (commit := resolved[reference]) is None:
+                plan.infos[index] = _failed_info(
+                    plan, index, plan.git_reference_original
+                )
+            else:
+                plan.commits.setdefault(commit, []).append(index)
+
+        for commit in plan.commits:
+            plan.entries[commit] = _tree_entries(location, commit)
+            for rel, key in plan.entries[commit].items():
+                plan.owners.setdefault(key, (commit, rel))
+    return plan
+
+
+def _module_destination(
+    snapshot_dirs: list[Path],
+    index: int,
+    module: str,
+    parents_lock: threading.Lock,
+) -> Path:
+    parent = _create_parent_packages(snapshot_dirs[index], module, parents_lock)
+    return parent / module.split(".")[-1]
+
+
+def _link_into(
+    plan: _ModulePlan,
+    source: Path,
+    indices: list[int],
+    snapshot_dirs: list[Path],
+    parents_lock: threading.Lock,
+) -> dict[int, CopyStats]:
+    """Link the copy of the module at ``source`` into the other snapshots."""
+    stats: dict[int, CopyStats] = {}
+    for index in indices:
+        destination = _module_destination(
+            snapshot_dirs, index, plan.module, parents_lock
+        )
+        with _trace.phase("copy", module=plan.module, strategy="link") as args:
+            stats[index] = link_tree(source, destination)
+            args["files"] = stats[index].files
+            args["bytes"] = stats[index].bytes
+            _trace.add_copied(stats[index].files, stats[index].bytes)
+    return stats
+
+
+def _worktree_jobs(
+    plan: _ModulePlan,
+    config: SnapshotConfig,
+    snapshot_dirs: list[Path],
+    store: SnapshotStore | None,
+    parents_lock: threading.Lock,
+) -> tuple[list[Callable[[], None]], list[Callable[[], None]]]:
+    """Copy the working tree of the module once, and link it into the other snapshots."""
+    first, *others = plan.worktree
+
+    def copy():
+        with _trace.phase("module", module=plan.module):
+            info, store_stats, copy_stats = _snapshot_module(
+                snapshot_dirs[first],
+                plan.module,
+                plan.location,
+                None,
+                parents_lock,
+                store,
+                config.copy_strategy,
+                config.copy_workers,
+                None,
+                config.staged,
+            )
+        plan.infos[first] = info
+        plan.store_stats = store_stats
+        if copy_stats is not None:
+            plan.copy_stats[first] = copy_stats
+
+    def link():
+        info = plan.infos[first]
+        assert info.destination is not None
+        with _trace.phase("module", module=plan.module):
+            stats = _link_into(
+                plan, info.destination, others, snapshot_dirs, parents_lock
+            )
+        for index, copy_stats in stats.items():
+            plan.infos[index] = dataclasses.replace(
+                info,
+                destination=snapshot_dirs[index].joinpath(*plan.module.split(".")),
+            )
+            plan.copy_stats[index] = copy_stats
+
+    return [copy], [link] if others else []
+
+
+def _commit_jobs(
+    plan: _ModulePlan,
+    commit: str,
+    snapshot_dirs: list[Path],
+    parents_lock: threading.Lock,
+) -> tuple[list[Callable[[], None]], list[Callable[[], None]]]:
+    """
+    Extract the files of ``commit`` that no other commit extracts, and then
+    link the others from the commits that extract them, and the whole module
+    into the other snapshots of the commit.
+    """
+    first, *others = plan.commits[commit]
+    entries = plan.entries[commit]
+    owned = [rel for rel, key in entries.items() if plan.owners[key] == (commit, rel)]
+    shared = [rel for rel, key in entries.items() if plan.owners[key] != (commit, rel)]
+
+    def extracted(commit: str) -> Path:
+        return _module_destination(
+            snapshot_dirs, plan.commits[commit][0], plan.module, parents_lock
+        )
+
+    def extract():
+        with _trace.phase("module", module=plan.module):
+            with _trace.phase(
+                "git.extract",
+                module=plan.module,
+                ref=plan.references[first],
+                files=len(owned),
+            ):
+                extract_git_reference(
+                    plan.location,
+                    commit,
+                    extracted(commit),
+                    # Everything, unless files are shared with another commit
+                    None if not shared else owned,
+                )
+
+    def link():
+        destination = extracted(commit)
+        with _trace.phase("module", module=plan.module):
+            with _trace.phase("copy", module=plan.module, strategy="link") as args:
+                files, size = 0, 0
+                for rel in shared:
+                    owner, owner_rel = plan.owners[entries[rel]]
+                    src = extracted(owner) / owner_rel
+                    dst = destination / rel
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    if src.is_symlink():
+                        copy_symlink(src, dst)
+                    else:
+                        files += 1
+                        size += _copy_file_hardlink(src, dst)
+                args["files"] = files
+                args["bytes"] = size
+                _trace.add_copied(files, size)
+            _link_into(plan, destination, others, snapshot_dirs, parents_lock)
+
+    return [extract], [link] if shared or others else []
+
+
+def _commit_infos(plan: _ModulePlan, snapshot_dirs: list[Path]):
+    """The infos of the module in the snapshots that extracted a commit."""
+    for commit, indices in plan.commits.items():
+        for index in indices:
+            reference = plan.references[index]
+            plan.infos[index] = SnapshotModuleInfo(
+                name=plan.module,
+                status="success",
+                location=plan.location,
+                destination=snapshot_dirs[index].joinpath(*plan.module.split(".")),
+                git_reference_requested=reference,
+                git_reference_original=plan.git_reference_original,
+                git_reference_used=reference,
+                git_commit=commit,
+            )
+
+
+def _batch_config(
+    config: SnapshotConfig,
+    references: Mapping[str, str],
+    index: int,
+) -> SnapshotConfig:
+    return config.model_copy(
+        update={
+            "git_references": {**config.git_references, **references},
+            "snapshot_dir": config.snapshot_dir / str(index)
+            if config.snapshot_dir is not None
+            else None,
+            "reuse": False,
+            "base_snapshot": None,
+        }
+    )
+
+
+def _snapshot_many_traced(
+    config: SnapshotConfig,
+    reference_sets: Sequence[Mapping[str, str]],
+) -> list[ActiveSnapshot]:
+    if config.reuse or config.base_snapshot is not None:
+        log.warning(
+            "Snapshot reuse and incremental snapshots are not supported for "
+            "batches. Creating new snapshots."
+        )
+    set_configs = [
+        _batch_config(config, references, index)
+        for index, references in enumerate(reference_sets)
+    ]
+    references = [set_config.git_references for set_config in set_configs]
+    # git is only required if any of the snapshots uses git references
+    _ensure_supported(
+        next((c for c in set_configs if c.git_references), set_configs[0])
+    )
+
+    # Scanned once, and shared by the metadata of all snapshots
+    with _trace.phase("environment"):
+        environment = current_environment()
+    with _trace.phase("resolve_modules"):
+        modules = config._resolve_modules(environment)
+
+    log.critical(f"Snapshotting {modules=} at {len(set_configs)} sets of references")
+    not_found, found = _find_modules(modules, config.on_module_not_found, {})
+
+    snapshot_dirs: list[Path] = []
+    for set_config in set_configs:
+        snapshot_dir = set_config._resolve_snapshot_dir()
+        gitignored_dir(snapshot_dir)
+        hold_lease(snapshot_dir)
+        with _trace.phase("metadata"):
+            _snapshot_meta(set_config, snapshot_dir, environment)
+        snapshot_dirs.append(snapshot_dir.absolute())
+
+    store = SnapshotStore(config._resolve_store_dir()) if config.store else None
+    parents_lock = threading.Lock()
+    workers = config.module_workers or 8
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        plans = list(
+            executor.map(
+                _trace.propagate(
+                    lambda item: _plan_module(item[1], item[2], references)
+                ),
+                found,
+            )
+        )
+
+        copy_jobs: list[Callable[[], None]] = []
+        link_jobs: list[Callable[[], None]] = []
+        for plan in plans:
+            if plan.worktree:
+                jobs = _worktree_jobs(plan, config, snapshot_dirs, store, parents_lock)
+                copy_jobs.extend(jobs[0])
+                link_jobs.extend(jobs[1])
+            for commit in plan.commits:
+                jobs = _commit_jobs(plan, commit, snapshot_dirs, parents_lock)
+                copy_jobs.extend(jobs[0])
+                link_jobs.extend(jobs[1])
+
+        # Each distinct file is extracted once before it is linked elsewhere
+        for jobs in (copy_jobs, link_jobs):
+            for future in [executor.submit(_trace.propagate(job)) for job in jobs]:
+                future.result()
+
+    for plan in plans:
+        _commit_infos(plan, snapshot_dirs)
+
+    actives: list[ActiveSnapshot] = []
+    for index, (set_config, snapshot_dir) in enumerate(zip(set_configs, snapshot_dirs)):
+        # The modules that were not found keep their position
+        module_infos: list[SnapshotModuleInfo | None] = [
+            dataclasses.replace(
+                info, git_reference_requested=references[index].get(info.name)
+            )
+            if info is not None
+            else None
+            for info in not_found
+        ]
+        store_stats = StoreStats() if store is not None else None
+        copy_stats: CopyStats | None = None
+        for (position, _, _), plan in zip(found, plans):
+            module_infos[position] = plan.infos[index]
+            if store_stats is not None and plan.store_stats is not None:
+                if plan.worktree[0] == index:
+                    store_stats.update(plan.store_stats)
+            if (module_copy_stats := plan.copy_stats.get(index)) is not None:
+                copy_stats = copy_stats or CopyStats()
+                copy_stats.update(module_copy_stats)
+        infos = [info for info in module_infos if info is not None]
+
+        manifest = ManifestBuilder(snapshot_dir) if config.manifest else None
+        if manifest is not None:
+            for info in infos:
+                if info.destination is not None:
+                    manifest.add_tree(info.destination)
+        infos = _finish_snapshot(set_config, snapshot_dir, infos, manifest)
+        actives.append(
+            ActiveSnapshot(
+                set_config,
+                snapshot_dir,
+                infos,
+                store_stats=store_stats,
+                copy_stats=copy_stats,
+            )
+        )
+    return actives
+
+
+def snapshot_many(
+    config: configs.SnapshotConfigInstanceOrDict | None,
+    git_references: Sequence[Mapping[str, str]],
+    /,
+    *,
+    on_trace_event: _trace.TraceCallback | None = None,
+) -> list[ActiveSnapshot]:
+    """
+    Snapshot the configured modules once for each set of git references, e.g.,
+    to bisect a regression over a range of commits.
+
+    The environment is scanned once for all snapshots. Each distinct file of
+    the referenced commits is extracted once (concurrently), and hardlinked
+    into every snapshot that contains it, as is the working tree of modules
+    without a git reference.
+
+    Args:
+        config: The snapshot configuration. Its `git_references` apply to every
+            snapshot, unless overridden by a set. If `snapshot_dir` is set, the
+            snapshots are created in numbered subdirectories of it.
+        git_references: The git references of each snapshot, as module name to
+            git reference mappings.
+        on_trace_event: Optional callback, which is called with a `TraceEvent`
+            as each phase finishes (see `snapshot`).
+
+    Returns:
+        The snapshots, in the order of ``git_references``. They share a single
+        `SnapshotTimings` of the whole batch.
+    """
+    from . import configs
+
+    if config is None:
+        config = SnapshotConfig()
+    config = configs.CreateSnapshotConfig(config)
+    if not git_references:
+        return []
+
+    tracer = _trace.SnapshotTracer(on_trace_event)
+    with tracer.activate():
+        actives = _snapshot_many_traced(config, git_references)
+    timings = tracer.finish()
+
+    for active in actives:
+        try:
+            _save_timings(active.snapshot_dir, timings)
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to save the timings of {active.snapshot_dir}: {e}")
+    return [dataclasses.replace(active, timings=timings) for active in actives]
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import compileall
+import functools
+import logging
+import os
+import py_compile
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+def _iter_sources(roots: Iterable[Path]) -> Iterator[str]:
+    seen = set[Path]()
+    for root in roots:
+        if root in seen:
+            continue
+        seen.add(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+            for filename in filenames:
+                if filename.endswith(".py"):
+                    yield os.path.join(dirpath, filename)
+
+
+def compile_bytecode(
+    roots: Iterable[Path],
+    optimize: list[int],
+    *,
+    workers: int | None = None,
+    legacy: bool = False,
+    stripdir: Path | None = None,
+    prependdir: Path | None = None,
+) -> bool:
+    """
+    Compile the Python sources under ``roots`` to unchecked-hash pycs, in a
+    process pool.
+
+    Unchecked-hash pycs are never validated against their sources, so
+    processes that import from the snapshot neither stat the sources nor try
+    to rewrite the pycs.
+
+    Args:
+        roots: The directories to compile.
+        optimize: The optimization levels to compile for.
+        workers: The number of processes. Default: the number of CPUs.
+        legacy: Write the pycs next to their sources (``module.pyc``) instead of
+            into ``__pycache__``. This is the only layout that `zipimport` reads,
+            and it holds a single optimization level.
+        stripdir, prependdir: Rewrite the source paths recorded in the pycs
+            (see `compileall.compile_file`).
+
+    Returns:
+        Whether all files compiled successfully.
+    """
+    start = time.perf_counter()
+    sources = sorted(_iter_sources(roots))
+    compile_file = functools.partial(
+        compileall.compile_file,
+        force=True,
+        quiet=1,
+        legacy=legacy,
+        # A list of levels is accepted since Python 3.9, but typeshed says int
+        optimize=optimize,  # pyright: ignore[reportArgumentType]
+        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        stripdir=str(stripdir) if stripdir is not None else None,
+        prependdir=str(prependdir) if prependdir is not None else None,
+    )
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(sources) <= 1:
+        results = list(map(compile_file, sources))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(sources) // (workers * 4))
+            results = list(executor.map(compile_file, sources, chunksize=chunksize))
+
+    success = all(results)
+    log.info(
+        f"Compiled {len(sources)} files for optimization levels {optimize} "
+        f"in {time.perf_counter() - start:.2f}s"
+        + ("" if success else " (some files failed to compile)")
+    )
+    return success
@@ -0,0 +1,419 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import datetime
+import hashlib
+import json
+import logging
+import sqlite3
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, ClassVar
+
+from ._util import cache_dir, disk_usage
+
+if TYPE_CHECKING:
+    from ._meta import SnapshotMetadata
+    from ._snapshot import SnapshotModuleInfo
+
+log = logging.getLogger(__name__)
+
+CATALOG_NAME = "catalog.sqlite3"
+
+_SCHEMA_VERSION = 1
+
+# The rollback journal (rather than WAL) is used, since WAL does not work on
+# network filesystems, where home directories often live.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    path TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    created REAL NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    format TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    base_snapshot TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_created ON snapshots (created);
+CREATE TABLE IF NOT EXISTS modules (
+    snapshot TEXT NOT NULL REFERENCES snapshots (path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    git_commit TEXT,
+    git_reference TEXT,
+    PRIMARY KEY (snapshot, name)
+);
+CREATE INDEX IF NOT EXISTS modules_name_commit ON modules (name, git_commit);
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class CatalogEntry:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    snapshot_dir: Path
+    """The snapshot directory."""
+
+    id: str
+    """The name of the snapshot directory (a UUIDv7 for default snapshot directories)."""
+
+    created: datetime.datetime
+    """When the snapshot was created."""
+
+    size: int | None
+    """The disk usage of the snapshot, if it is complete."""
+
+    format: str
+    """The layout of the snapshot (`directory` or `zip`)."""
+
+    config_hash: str
+    """A digest of the snapshot config, excluding the snapshot directory."""
+
+    base_snapshot: Path | None
+    """The snapshot that this snapshot was incrementally derived from, if any."""
+
+    modules: dict[str, str | None]
+    """The modules of the snapshot, and the git commit each one was snapshot from."""
+
+    complete: bool = True
+    """Whether the snapshot was fully created."""
+
+
+def catalog_path() -> Path:
+    return cache_dir() / CATALOG_NAME
+
+
+@contextlib.contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Open the catalog, and commit (or roll back) a transaction on exit."""
+    conn = sqlite3.connect(catalog_path(), timeout=60)
+    try:
+        conn.execute("PRAGMA foreign_keys = ON")
+        if conn.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            conn.executescript(_SCHEMA)
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def config_hash(config: dict[str, Any]) -> str:
+    """Digest a JSON-dumped snapshot config, ignoring its snapshot directory."""
+    config = {key: value for key, value in config.items() if key != "snapshot_dir"}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def _insert_snapshot(
+    conn: sqlite3.Connection,
+    snapshot_dir: Path,
+    created: float,
+    format: str,
+    config: str,
+    base_snapshot: Path | None,
+):
+    # Replaces any previous snapshot in the same directory, with its modules
+    conn.execute("DELETE FROM snapshots WHERE path = ?", (str(snapshot_dir),))
+    conn.execute(
+        "INSERT INTO snapshots (path, id, created, format, config_hash, base_snapshot) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            str(snapshot_dir),
+            snapshot_dir.name,
+            created,
+            format,
+            config,
+            str(base_snapshot) if base_snapshot is not None else None,
+        ),
+    )
+
+
+def _complete_snapshot(
+    conn: sqlite3.Connection,
+    snapshot_dir: Path,
+    modules: Iterable[tuple[str, str | None, str | None]],
+    size: int | None,
+):
+    conn.executemany(
+        "INSERT OR REPLACE INTO modules (snapshot, name, git_commit, git_reference) "
+        "VALUES (?, ?, ?, ?)",
+        [(str(snapshot_dir), *module) for module in modules],
+    )
+    conn.execute(
+        "UPDATE snapshots SET complete = 1, size = ? WHERE path = ?",
+        (size, str(snapshot_dir)),
+    )
+
+
+def record_started(snapshot_dir: Path, meta: SnapshotMetadata):
+    """Add a snapshot that is being created to the catalog."""
+    try:
+        with _connect() as conn:
+            _insert_snapshot(
+                conn,
+                snapshot_dir.absolute(),
+                meta.timestamp.timestamp(),
+                meta.config.format,
+                config_hash(meta.config.model_dump(mode="json")),
+                meta.base_snapshot,
+            )
+    except sqlite3.Error as e:
+        log.warning(f"Failed to add {snapshot_dir} to the snapshot catalog: {e}")
+
+
+def record_completed(snapshot_dir: Path, module_infos: list[SnapshotModuleInfo]):
+    """
+    Record the modules of a snapshot once it is created. Its size is measured
+    when it is first listed, rather than with another walk of the snapshot here.
+    """
+    snapshot_dir = snapshot_dir.absolute()
+    modules = [
+        (info.name, info.git_commit, info.git_reference_used)
+        for info in module_infos
+        if info.status == "success"
+    ]
+    try:
+        with _connect() as conn:
+            _complete_snapshot(conn, snapshot_dir, modules, None)
+    except sqlite3.Error as e:
+        log.warning(f"Failed to update {snapshot_dir} in the snapshot catalog: {e}")
+
+
+def record_existing(snapshot_dir: Path):
+    """Add a complete snapshot that was not created here (e.g., imported) to the catalog."""
+    snapshot_dir = snapshot_dir.absolute()
+    if (snapshot := _scan_snapshot(snapshot_dir)) is None:
+        return
+    base = snapshot["base_snapshot"]
+    try:
+        with _connect() as conn:
+            _insert_snapshot(
+                conn,
+                snapshot_dir,
+                snapshot["created"],
+                snapshot["format"],
+                snapshot["config_hash"],
+                Path(base) if base is not None else None,
+            )
+            if snapshot["modules"] is not None:
+                _complete_snapshot(
+                    conn, snapshot_dir, snapshot["modules"], snapshot["size"]
+                )
+    except sqlite3.Error as e:
+        log.warning(f"Failed to add {snapshot_dir} to the snapshot catalog: {e}")
+
+
+def remove_snapshots(snapshot_dirs: Iterable[Path]):
+    """Remove deleted snapshots from the catalog."""
+    paths = [(str(path.absolute()),) for path in snapshot_dirs]
+    if not paths:
+        return
+    try:
+        with _connect() as conn:
+            conn.executemany("DELETE FROM snapshots WHERE path = ?", paths)
+    except sqlite3.Error as e:
+        log.warning(f"Failed to remove snapshots from the snapshot catalog: {e}")
+
+
+def list_snapshots(
+    *,
+    module: str | None = None,
+    commit: str | None = None,
+    limit: int | None = None,
+    include_incomplete: bool = False,
+) -> list[CatalogEntry]:
+    """
+    Query the snapshot catalog, newest first.
+
+    Args:
+        module: Only return snapshots that include this module.
+        commit: Only return snapshots that include ``module`` (or, if it is not
+            set, any module) snapshot from this git commit. Prefixes of commit
+            hashes are accepted.
+        limit: The maximum number of snapshots to return.
+        include_incomplete: Also return snapshots that are still being created
+            (or whose creation failed).
+    """
+    conditions: list[str] = []
+    params: list[Any] = []
+    if not include_incomplete:
+        conditions.append("complete = 1")
+    if module is not None or commit is not None:
+        module_conditions = ["m.snapshot = s.path"]
+        if module is not None:
+            module_conditions.append("m.name = ?")
+            params.append(module)
+        if commit is not None:
+            # GLOB is case-sensitive, so prefix matches can use the index
+            module_conditions.append("m.git_commit GLOB ?")
+            escaped = "".join(f"[{c}]" if c in "[*?" else c for c in commit)
+            params.append(f"{escaped}*")
+        conditions.append(
+            f"EXISTS (SELECT 1 FROM modules m WHERE {' AND '.join(module_conditions)})"
+        )
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    if limit is not None:
+        params.append(limit)
+
+    query = f"""
+        SELECT s.path, s.id, s.created, s.size, s.format, s.config_hash,
+            s.base_snapshot, s.complete, m.name, m.git_commit
+        FROM (
+            SELECT * FROM snapshots s {where}
+            ORDER BY created DESC {"LIMIT ?" if limit is not None else ""}
+        ) s
+        LEFT JOIN modules m ON m.snapshot = s.path
+        ORDER BY s.created DESC, s.path, m.name
+    """
+    entries: dict[str, CatalogEntry] = {}
+    with _connect() as conn:
+        for row in conn.execute(query, params):
+            (
+                path,
+                id,
+                created,
+                size,
+                format,
+                digest,
+                base,
+                complete,
+                name,
+                git_commit,
+            ) = row
+            if (entry := entries.get(path)) is None:
+                entry = entries[path] = CatalogEntry(
+                    snapshot_dir=Path(path),
+                    id=id,
+                    created=datetime.datetime.fromtimestamp(created),
+                    size=size,
+                    format=format,
+                    config_hash=digest,
+                    base_snapshot=Path(base) if base is not None else None,
+                    modules={},
+                    complete=bool(complete),
+                )
+            if name is not None:
+                entry.modules[name] = git_commit
+    return _measure_sizes(list(entries.values()))
+
+
+def _measure_sizes(entries: list[CatalogEntry]) -> list[CatalogEntry]:
+    """Fill in (and store) the sizes of the complete snapshots that were not measured yet."""
+    unsized = [
+        entry.snapshot_dir
+        for entry in entries
+        if entry.complete and entry.size is None and entry.snapshot_dir.is_dir()
+    ]
+    if not unsized:
+        return entries
+
+    with ThreadPoolExecutor() as executor:
+        sizes = dict(zip(unsized, executor.map(disk_usage, unsized)))
+    try:
+        with _connect() as conn:
+            conn.executemany(
+                "UPDATE snapshots SET size = ? WHERE path = ?",
+                [(size, str(path)) for path, size in sizes.items()],
+            )
+    except sqlite3.Error as e:
+        log.warning(f"Failed to update the sizes in the snapshot catalog: {e}")
+    return [
+        dataclasses.replace(entry, size=sizes[entry.snapshot_dir])
+        if entry.snapshot_dir in sizes
+        else entry
+        for entry in entries
+    ]
+
+
+def _scan_snapshot(snapshot_dir: Path) -> dict[str, Any] | None:
+    """Read the catalog fields of an existing snapshot from its metadata files."""
+    meta_dir = snapshot_dir / ".nshsnapmeta"
+    try:
+        meta = json.loads((meta_dir / "meta.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+    try:
+        module_infos = json.loads((meta_dir / "modules.json").read_text())
+    except (OSError, ValueError):
+        module_infos = None
+
+    config = meta.get("config", {})
+    return {
+        "snapshot_dir": snapshot_dir,
+        "created": datetime.datetime.fromisoformat(meta["timestamp"]).timestamp(),
+        "format": config.get("format", "directory"),
+        "config_hash": config_hash(config),
+        "base_snapshot": meta.get("base_snapshot"),
+        "modules": [
+            (
+                info["name"],
+                info.get("git_commit"),
+                info.get("git_reference_used"),
+            )
+            for info in module_infos
+            if info.get("status") == "success"
+        ]
+        if module_infos is not None
+        else None,
+        "size": disk_usage(snapshot_dir) if module_infos is not None else None,
+    }
+
+
+def rebuild_catalog(
+    snapshots_dirs: list[Path] | None = None,
+    workers: int | None = None,
+) -> int:
+    """
+    Re-index the snapshots in ``snapshots_dirs`` (default: the default snapshot
+    directory) and the snapshots that are already in the catalog, reading
+    their metadata in parallel. Snapshots that no longer exist are removed.
+
+    Returns:
+        The number of snapshots in the catalog.
+    """
+    if snapshots_dirs is None:
+        snapshots_dirs = [cache_dir("snapshots")]
+
+    with _connect() as conn:
+        known = [Path(path) for (path,) in conn.execute("SELECT path FROM snapshots")]
+    candidates = {path.absolute() for path in known}
+    for snapshots_dir in snapshots_dirs:
+        candidates.update(
+            path.absolute()
+            for path in snapshots_dir.iterdir()
+            if path.is_dir() and not path.name.startswith(".")
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scanned = [
+            snapshot
+            for snapshot in executor.map(_scan_snapshot, sorted(candidates))
+            if snapshot is not None
+        ]
+
+    with _connect() as conn:
+        conn.execute("DELETE FROM snapshots")
+        for snapshot in scanned:
+            base = snapshot["base_snapshot"]
+            _insert_snapshot(
+                conn,
+                snapshot["snapshot_dir"],
+                snapshot["created"],
+                snapshot["format"],
+                snapshot["config_hash"],
+                Path(base) if base is not None else None,
+            )
+            if snapshot["modules"] is not None:
+                _complete_snapshot(
+                    conn,
+                    snapshot["snapshot_dir"],
+                    snapshot["modules"],
+                    snapshot["size"],
+                )
+
+    log.info(f"Indexed {len(scanned)} snapshots in the snapshot catalog")
+    return len(scanned)
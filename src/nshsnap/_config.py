@@ -9,8 +9,8 @@ from typing import Annotated, Any, Literal
 import nshconfig as C
 from typing_extensions import TypedDict, assert_never
 
-from ._pip_deps import EditablePackageDependency, current_pip_dependencies
-from ._util import gitignored_dir, snapshot_id
+from ._pip_deps import EditablePackageDependency, EnvironmentInfo, current_environment
+from ._util import cache_dir, gitignored_dir, snapshot_id
 
 log = logging.getLogger(__name__)
 
@@ -27,18 +27,22 @@ class SnapshotResolveModulesConfigKwargsDict(TypedDict, total=False):
 
 
 def _default_snapshot_dir() -> Path:
-    snaps_folder = Path.home() / ".cache" / "nshsnap" / "snapshots"
-    snaps_folder.mkdir(parents=True, exist_ok=True)
-
+    snaps_folder = cache_dir("snapshots")
     return gitignored_dir(snaps_folder / snapshot_id(), create=True)
 
 
-def _editable_modules(on_module_not_found: Literal["raise", "warn"]):
-    for dep in current_pip_dependencies():
+def _editable_modules(
+    on_module_not_found: Literal["raise", "warn"],
+    environment: EnvironmentInfo | None = None,
+):
+    if environment is None:
+        environment = current_environment()
+
+    for dep in environment.dependencies:
         if not isinstance(dep, EditablePackageDependency):
             continue
 
-        if (module_name := dep.importable_module_name()) is None:
+        if (module_name := environment.editable_modules.get(dep.name)) is None:
             msg = (
                 f"Could not find an importable module name for editable package {dep.name}. "
                 "Please double-check to make sure that the package is installed correctly. "
@@ -84,11 +88,95 @@ class SnapshotConfig(C.Config):
     """Git references (branch, tag, commit hash) to use for specific modules.
     Key is the module name, value is the git reference. Default: `{}`."""
 
-    def _resolve_modules(self):
+    copy_strategy: Literal["auto", "rsync", "native", "reflink", "hardlink"] = "auto"
+    """How to copy module files into the snapshot:
+    - `"native"`: Copy files in-process with a thread pool, using
+        `copy_file_range`/`sendfile`. Does not require rsync.
+    - `"rsync"`: Copy with `rsync -a`.
+    - `"reflink"`: Clone files with copy-on-write reflinks (e.g., XFS, Btrfs),
+        falling back to the native copy.
+    - `"hardlink"`: Hardlink files to the source. This is nearly free, but the
+        snapshot shares file contents with the source, so it is only safe if
+        the source files are not modified in place while the snapshot is used.
+    - `"auto"`: Probe each source/destination filesystem pair once and use
+        `"reflink"` if it is supported, `"native"` otherwise.
+    Ignored when `store` is set. Default: `"auto"`."""
+
+    copy_workers: int | None = None
+    """The number of threads used to copy files with the `"native"`, `"reflink"`
+    and `"hardlink"` copy strategies. Default: `None` (Python's
+    `ThreadPoolExecutor` default)."""
+
+    module_workers: int | None = None
+    """The number of modules to snapshot concurrently. Default: `None` (up to 8)."""
+
+    format: Literal["directory", "zip"] = "directory"
+    """How to lay out the snapshotted modules:
+    - `"directory"`: Plain directory trees in the snapshot directory.
+    - `"zip"`: A single uncompressed zip archive (`snapshot.zip`) that is put on
+        `sys.path` directly and imported with `zipimport`. Importing from the
+        archive needs a single open per process instead of a stat/open per file,
+        which greatly reduces the load on shared filesystems (NFS, Lustre).
+    Default: `"directory"`."""
+
+    compile_bytecode: bool = False
+    """Precompile the snapshotted modules to unchecked-hash pycs, so processes
+    that import from the snapshot do not compile (or write) any bytecode. The
+    pycs are only used by the interpreter version that created the snapshot.
+    Default: `False`."""
+
+    compile_optimize: list[int] = [0]
+    """The optimization levels (`0`, `1` and/or `2`, as in `python -O`) to
+    precompile bytecode for. Zip snapshots only support a single level, so
+    only the first one is used. Default: `[0]`."""
+
+    compile_workers: int | None = None
+    """The number of processes used to precompile bytecode. Default: `None`
+    (the number of CPUs)."""
+
+    manifest: bool = False
+    """Write a manifest of every copied file (path, size, mode, mtime and
+    BLAKE2b digest) to `.nshsnapmeta/manifest.tsv`. The files of each module
+    are hashed in a thread pool while the other modules are still being
+    copied. Default: `False`."""
+
+    base_snapshot: Path | Literal["latest"] | None = None
+    """Create an incremental snapshot derived from a previous snapshot: either
+    the path to a snapshot directory, or `"latest"` for the most recent snapshot
+    of the same modules in the same parent directory. For each module, the
+    files that changed since the base was taken (according to `git diff` and
+    the untracked files) are copied, and all other files are hardlinked from
+    the base. Modules that are not in git repositories, use git references, or
+    are not in the base are copied in full. Ignored when `store` is set.
+    Default: `None`."""
+
+    store: bool = False
+    """Store file contents in a shared, content-addressed blob store and
+    materialize the snapshot as hardlinks into it, so files that are unchanged
+    between snapshots are only stored once. Default: `False`."""
+
+    store_dir: Path | None = None
+    """The directory of the blob store. It must be on the same filesystem as the
+    snapshot directory. Default: `~/.cache/nshsnap/store`."""
+
+    staged: bool = True
+    """Freeze the staged copy of each module that is watched by `nshsnap watch`
+    (a hardlink clone of a copy that is kept in sync with the working tree)
+    instead of copying the module. Modules that are not watched, or that use
+    git references, are copied as usual. Ignored when `store` is set.
+    Default: `True`."""
+
+    reuse: bool = False
+    """Reuse an existing snapshot if one was already created for the same modules
+    in the same code state (git HEAD, uncommitted changes, untracked files and git
+    references). Only applies when `snapshot_dir` is not set. Default: `False`."""
+
+    def _resolve_modules(self, environment: EnvironmentInfo | None = None):
         modules = copy.deepcopy(self.modules)
         if self.editable_modules:
             modules = _merge_modules(
-                modules, _editable_modules(self.on_module_not_found)
+                modules,
+                _editable_modules(self.on_module_not_found, environment),
             )
 
         return modules
@@ -97,3 +185,8 @@ class SnapshotConfig(C.Config):
         if self.snapshot_dir is None:
             return _default_snapshot_dir()
         return self.snapshot_dir
+
+    def _resolve_store_dir(self):
+        if self.store_dir is None:
+            return cache_dir("store")
+        return self.store_dir
@@ -0,0 +1,421 @@
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar, Literal, TypeAlias
+
+from typing_extensions import assert_never
+
+from . import _trace
+from ._files import list_source_files, stream_source_manifest, use_git
+from ._util import copy_symlink, link_file
+
+log = logging.getLogger(__name__)
+
+CopyStrategy: TypeAlias = Literal["auto", "rsync", "native", "reflink", "hardlink"]
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+_CHUNK_SIZE = 1024 * 1024
+
+_RSYNC_FILES_FROM_ARGS = [
+    "rsync",
+    "-a",
+    # `--files-from` disables the recursion implied by `-a`, which is only
+    # needed for submodules (listed by git as a single directory).
+    "-r",
+    "--from0",
+    "--files-from=-",
+    # Tracked files that were deleted from the working tree
+    "--ignore-missing-args",
+    "--exclude=.git",
+]
+
+# (source device, destination device) -> resolved strategy, for `auto`
+_probe_cache: dict[tuple[int, int], Literal["native", "reflink"]] = {}
+
+
+@dataclass(slots=True)
+class CopyStats:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    files: int = 0
+    """The number of files copied."""
+
+    bytes: int = 0
+    """The number of bytes copied."""
+
+    seconds: float = 0.0
+    """The wall-clock time spent copying."""
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+    def update(self, other: CopyStats):
+        self.files += other.files
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+
+
+def _copy_rsync(source: Path, location: Path):
+    """
+    Copy files from the source directory to the specified location, excluding ignored files.
+
+    The list of files to copy is streamed from `git ls-files` straight into
+    `rsync --files-from`, so neither the argument list nor the memory use
+    grows with the number of ignored files. Sources outside of git
+    repositories are walked in-process instead.
+
+    Args:
+        source (Path): The path to the source directory.
+        location (Path): The path to the destination directory.
+
+    Raises:
+        CalledProcessError: If the git or rsync command fails.
+
+    """
+    target_root = location / source.name
+    target_root.mkdir(parents=True, exist_ok=True)
+
+    _trace.add_subprocess(_RSYNC_FILES_FROM_ARGS)
+    if not use_git(source):
+        _ = subprocess.run(
+            [*_RSYNC_FILES_FROM_ARGS, f"{source}/", f"{target_root}/"],
+            input=b"\0".join(os.fsencode(rel) for rel in list_source_files(source)),
+            check=True,
+        )
+        return
+
+    manifest = stream_source_manifest(source)
+    try:
+        _ = subprocess.run(
+            [*_RSYNC_FILES_FROM_ARGS, f"{source}/", f"{target_root}/"],
+            stdin=manifest.stdout,
+            check=True,
+        )
+    finally:
+        assert manifest.stdout is not None
+        manifest.stdout.close()
+        returncode = manifest.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, manifest.args)
+
+
+def _ficlone(src_fd: int, dst_fd: int):
+    import fcntl
+
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _copy_contents(src_fd: int, dst_fd: int, size: int):
+    """
+    Copy ``size`` bytes between the file descriptors in the kernel, with
+    ``copy_file_range`` if possible, then ``sendfile``, then a userspace copy.
+    """
+    offset = 0
+    for copy in (_copy_file_range, _sendfile):
+        try:
+            while offset < size:
+                if (copied := copy(src_fd, dst_fd, offset, size - offset)) == 0:
+                    break
+                offset += copied
+            return
+        except (OSError, AttributeError):
+            # Not supported by this platform or filesystem pair. The next
+            # method resumes from `offset`.
+            continue
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while chunk := os.read(src_fd, _CHUNK_SIZE):
+        os.write(dst_fd, chunk)
+
+
+def _create_file(dst: Path):
+    try:
+        return open(dst, "xb")
+    except FileExistsError:
+        # Already copied with an overlapping module, possibly as a link to the
+        # file of a base snapshot, which must not be written through
+        dst.unlink()
+        return open(dst, "xb")
+
+
+def _copy_file(src: Path, dst: Path, *, reflink: bool) -> int:
+    with open(src, "rb") as fsrc, _create_file(dst) as fdst:
+        st = os.fstat(fsrc.fileno())
+        cloned = False
+        if reflink:
+            try:
+                _ficlone(fsrc.fileno(), fdst.fileno())
+                cloned = True
+            except OSError:
+                pass
+        if not cloned:
+            _copy_contents(fsrc.fileno(), fdst.fileno(), st.st_size)
+        os.fchmod(fdst.fileno(), stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return st.st_size
+
+
+def _copy_file_native(src: Path, dst: Path) -> int:
+    """Copy ``src`` to ``dst`` in the kernel, preserving its mode and timestamps."""
+    return _copy_file(src, dst, reflink=False)
+
+
+def _copy_file_reflink(src: Path, dst: Path) -> int:
+    """
+    Clone ``src`` to ``dst`` with a copy-on-write reflink, falling back to an
+    in-kernel copy.
+    """
+    return _copy_file(src, dst, reflink=True)
+
+
+def _copy_file_hardlink(src: Path, dst: Path) -> int:
+    try:
+        link_file(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        return _copy_file_native(src, dst)
+    return dst.stat().st_size
+
+
+def _copy_files(
+    source: Path,
+    location: Path,
+    copy_file: Callable[[Path, Path], int],
+    workers: int | None = None,
+) -> CopyStats:
+    """Copy ``source`` to ``location / source.name`` file by file, in parallel."""
+    start = time.perf_counter()
+    target_root = location / source.name
+    target_root.mkdir(parents=True, exist_ok=True)
+
+    # Directories are created up front, so the workers only copy files.
+    created_dirs = {target_root}
+    jobs: list[tuple[Path, Path]] = []
+    for rel in list_source_files(source):
+        src = source / rel
+        dst = target_root / rel
+        if dst.parent not in created_dirs:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            parent = dst.parent
+            while parent not in created_dirs:
+                created_dirs.add(parent)
+                parent = parent.parent
+
+        if src.is_symlink():
+            copy_symlink(src, dst)
+        else:
+            jobs.append((src, dst))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(lambda job: copy_file(*job), jobs))
+
+    # Like `rsync -a`, directories get the mode and times of the source, once
+    # their files are copied. Children first, so their parents keep their times.
+    for dir in sorted(created_dirs, key=lambda path: len(path.parts), reverse=True):
+        st = (source / dir.relative_to(target_root)).stat()
+        os.chmod(dir, stat.S_IMODE(st.st_mode))
+        os.utime(dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    stats = CopyStats(
+        files=len(jobs),
+        bytes=sum(sizes),
+        seconds=time.perf_counter() - start,
+    )
+    log.info(
+        f"Copied {source}: {stats.files} files, {stats.bytes} bytes in "
+        f"{stats.seconds:.2f}s ({stats.files_per_second:.0f} files/s, "
+        f"{stats.mb_per_second:.1f} MB/s)"
+    )
+    return stats
+
+
+def link_tree(source: Path, destination: Path) -> CopyStats:
+    """
+    Recreate ``source``, a module in a snapshot, at ``destination`` with
+    hardlinks to its files. Unlike `copy_tree`, every file of ``source`` is
+    included, since snapshots have no ignored files.
+    """
+    start = time.perf_counter()
+    stats = CopyStats()
+    destination.mkdir(parents=True, exist_ok=True)
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = destination / os.path.relpath(dirpath, source)
+        for name in dirnames:
+            if (src := Path(dirpath, name)).is_symlink():
+                copy_symlink(src, target / name)
+            else:
+                (target / name).mkdir(exist_ok=True)
+        for name in filenames:
+            if (src := Path(dirpath, name)).is_symlink():
+                copy_symlink(src, target / name)
+            else:
+                stats.files += 1
+                stats.bytes += _copy_file_hardlink(src, target / name)
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+def _supports_reflink(source: Path, location: Path) -> bool:
+    """Try to reflink a file from ``source`` into ``location``."""
+    sample = next(
+        (
+            source / rel
+            for rel in list_source_files(source)
+            if not (source / rel).is_symlink() and (source / rel).stat().st_size > 0
+        ),
+        None,
+    )
+    if sample is None:
+        return False
+
+    location.mkdir(parents=True, exist_ok=True)
+    with open(sample, "rb") as fsrc, tempfile.TemporaryFile(dir=location) as fdst:
+        try:
+            _ficlone(fsrc.fileno(), fdst.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def _resolve_auto_strategy(source: Path, location: Path):
+    location.mkdir(parents=True, exist_ok=True)
+    key = (source.stat().st_dev, location.stat().st_dev)
+    if (strategy := _probe_cache.get(key)) is None:
+        strategy = "reflink" if _supports_reflink(source, location) else "native"
+        _probe_cache[key] = strategy
+        log.info(f"Using the {strategy} copy strategy for {source} -> {location}")
+    return strategy
+
+
+def _unchanged(src: Path, base_file: Path) -> bool:
+    try:
+        src_st = src.stat()
+        base_st = base_file.lstat()
+    except FileNotFoundError:
+        return False
+    return (
+        stat.S_ISREG(base_st.st_mode)
+        and src_st.st_mode == base_st.st_mode
+        and src_st.st_size == base_st.st_size
+        and src_st.st_mtime_ns == base_st.st_mtime_ns
+    )
+
+
+def copy_tree_incremental(
+    source: Path,
+    location: Path,
+    base: Path,
+    changed: set[Path],
+    strategy: CopyStrategy = "auto",
+    workers: int | None = None,
+) -> CopyStats:
+    """
+    Copy the source directory to ``location / source.name``, reusing the
+    unchanged files of ``base``, the copy of the same directory in a previous
+    snapshot.
+
+    Files that are in ``changed`` or whose mode, size or mtime differ from the
+    base copy are copied from the source with the given strategy (`rsync` is
+    replaced by `native`). All other files are hardlinked from the base.
+
+    Args:
+        source (Path): The path to the source directory.
+        location (Path): The path to the destination directory.
+        base (Path): The copy of the source directory in the base snapshot.
+        changed: The paths, relative to ``source``, that changed since the base.
+        strategy: How to copy the changed files.
+        workers: The number of copy threads.
+    """
+    if strategy == "auto":
+        strategy = _resolve_auto_strategy(source, location)
+
+    if strategy in ("rsync", "native"):
+        copy_changed = _copy_file_native
+    elif strategy == "reflink":
+        copy_changed = _copy_file_reflink
+    elif strategy == "hardlink":
+        copy_changed = _copy_file_hardlink
+    else:
+        assert_never(strategy)
+
+    target_root = location / source.name
+    # Appended to by the copy threads
+    reused: list[int] = []
+
+    def copy_file(src: Path, dst: Path) -> int:
+        rel = dst.relative_to(target_root)
+        if rel not in changed and _unchanged(src, base_file := base / rel):
+            reused.append(1)
+            return _copy_file_hardlink(base_file, dst)
+        return copy_changed(src, dst)
+
+    stats = _copy_files(source, location, copy_file, workers)
+    log.info(f"Reused {len(reused)} of {stats.files} files of {source} from {base}")
+    return stats
+
+
+def copy_tree(
+    source: Path,
+    location: Path,
+    strategy: CopyStrategy = "auto",
+    workers: int | None = None,
+) -> CopyStats | None:
+    """
+    Copy the source directory to ``location / source.name``, excluding ignored files.
+
+    Args:
+        source (Path): The path to the source directory.
+        location (Path): The path to the destination directory.
+        strategy: How to copy the files. `hardlink` shares the file contents
+            with the source, so it is only safe if the source does not change
+            while the snapshot is in use. `auto` picks `reflink` if the
+            filesystem supports copy-on-write clones and `native` otherwise.
+        workers: The number of threads used by the in-process copy engines.
+
+    Returns:
+        The copy statistics, or None for the `rsync` strategy.
+    """
+    if strategy == "auto":
+        strategy = _resolve_auto_strategy(source, location)
+
+    if strategy == "rsync":
+        _copy_rsync(source, location)
+        return None
+    elif strategy == "native":
+        return _copy_files(source, location, _copy_file_native, workers)
+    elif strategy == "reflink":
+        return _copy_files(source, location, _copy_file_reflink, workers)
+    elif strategy == "hardlink":
+        return _copy_files(source, location, _copy_file_hardlink, workers)
+    else:
+        assert_never(strategy)
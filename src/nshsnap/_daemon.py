@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, cast
+
+from typing_extensions import override
+
+from ._config import SnapshotConfig
+from ._copy import CopyStats
+from ._lease import hold_lease, release_lease
+from ._snapshot import ActiveSnapshot, SnapshotModuleInfo, _snapshot
+from ._store import StoreStats
+from ._trace import SnapshotTimings
+from ._util import cache_dir
+
+log = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+
+SOCKET_ENV = "NSHSNAP_DAEMON_SOCKET"
+"""Environment variable that overrides the socket of the snapshot daemon."""
+
+
+def daemon_socket_path() -> Path:
+    """
+    The socket of the snapshot daemon. The socket is per host, since the
+    cache directory may be shared between hosts.
+    """
+    if path := os.environ.get(SOCKET_ENV):
+        return Path(path)
+    return cache_dir("daemon") / f"{socket.gethostname()}.sock"
+
+
+def _client_identity() -> dict[str, Any]:
+    """
+    What the daemon must share with a client to snapshot on its behalf. The
+    first entry of `sys.path` is the directory of the running script, which
+    differs between the entry points of the same environment.
+    """
+    from . import __version__
+
+    return {
+        "protocol": PROTOCOL_VERSION,
+        "version": __version__,
+        "executable": sys.executable,
+        "sys_path": sys.path[1:],
+    }
+
+
+def _absolute_config(config: SnapshotConfig) -> SnapshotConfig:
+    """Resolve the relative paths of ``config`` against the working directory."""
+    update: dict[str, Any] = {}
+    for name in ("snapshot_dir", "store_dir", "base_snapshot"):
+        if isinstance(value := getattr(config, name), Path):
+            update[name] = value.absolute()
+    return config.model_copy(update=update)
+
+
+def _encode_snapshot(active: ActiveSnapshot) -> dict[str, Any]:
+    return {
+        "snapshot_dir": str(active.snapshot_dir),
+        "module_infos": [info.to_json_dict() for info in active.module_infos],
+        "store_stats": dataclasses.asdict(active.store_stats)
+        if active.store_stats is not None
+        else None,
+        "copy_stats": dataclasses.asdict(active.copy_stats)
+        if active.copy_stats is not None
+        else None,
+        "reused": active.reused,
+        "base_snapshot": str(active.base_snapshot)
+        if active.base_snapshot is not None
+        else None,
+        "timings": active.timings.to_json_dict()
+        if active.timings is not None
+        else None,
+    }
+
+
+def _decode_snapshot(config: SnapshotConfig, data: dict[str, Any]) -> ActiveSnapshot:
+    return ActiveSnapshot(
+        config,
+        Path(data["snapshot_dir"]),
+        [SnapshotModuleInfo.from_json_dict(info) for info in data["module_infos"]],
+        store_stats=StoreStats(**data["store_stats"])
+        if data["store_stats"] is not None
+        else None,
+        copy_stats=CopyStats(**data["copy_stats"])
+        if data["copy_stats"] is not None
+        else None,
+        reused=data["reused"],
+        base_snapshot=Path(data["base_snapshot"])
+        if data["base_snapshot"] is not None
+        else None,
+        timings=SnapshotTimings.from_json_dict(data["timings"])
+        if data["timings"] is not None
+        else None,
+    )
+
+
+def request_snapshot(
+    config: SnapshotConfig,
+    socket_path: Path | None = None,
+) -> ActiveSnapshot | None:
+    """
+    Ask the snapshot daemon (`nshsnap serve`) to create the snapshot.
+
+    Returns:
+        The snapshot, or None if no compatible daemon is running or it failed
+        to create the snapshot, in which case the caller should create the
+        snapshot in-process.
+    """
+    if socket_path is None:
+        socket_path = daemon_socket_path()
+    if not socket_path.exists():
+        return None
+
+    config = _absolute_config(config)
+    request = {
+        **_client_identity(),
+        "config": config.model_dump(mode="json"),
+    }
+    # The request and the response are each a line of JSON. The daemon holds
+    # its lease on the snapshot until the client acknowledges (with an empty
+    # line) that it holds its own.
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+            if snapshot := response.get("snapshot"):
+                hold_lease(Path(snapshot["snapshot_dir"]))
+                # If this fails, the daemon releases its lease on the disconnect
+                with contextlib.suppress(OSError):
+                    sock.sendall(b"\n")
+    except (OSError, ValueError) as e:
+        log.info(f"The snapshot daemon at {socket_path} is not available: {e}")
+        return None
+
+    if error := response.get("error"):
+        log.warning(f"The snapshot daemon failed: {error}. Snapshotting in-process.")
+        return None
+
+    active = _decode_snapshot(config, response["snapshot"])
+    log.info(
+        f"Snapshot created by the daemon at {socket_path}"
+        + (" (coalesced with a concurrent request)" if response["coalesced"] else "")
+    )
+    return active
+
+
+class _Coalescer:
+    """
+    Runs identical concurrent requests once, and shares the result. ``share``
+    is called with the result once for each request that shares it, before
+    any of them sees it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict[str, Future[dict[str, Any]]] = {}
+        self._waiters: dict[str, int] = {}
+
+    def run(
+        self,
+        key: str,
+        fn: Callable[[], dict[str, Any]],
+        share: Callable[[dict[str, Any]], None],
+    ) -> tuple[dict[str, Any], bool]:
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if future is None:
+                future = self._inflight[key] = Future()
+                self._waiters[key] = 0
+            else:
+                self._waiters[key] += 1
+
+        if owner:
+            try:
+                result = fn()
+            except BaseException as e:
+                with self._lock:
+                    del self._inflight[key], self._waiters[key]
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    for _ in range(self._waiters[key]):
+                        share(result)
+                    del self._inflight[key], self._waiters[key]
+                future.set_result(result)
+        return future.result(), not owner
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path):
+        super().__init__(str(socket_path), _Handler)
+        self.identity = _client_identity()
+        self.coalescer = _Coalescer()
+        self.last_activity = time.monotonic()
+        self.active_requests = 0
+        self.activity_lock = threading.Lock()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    @property
+    def _server(self) -> _Server:
+        return cast(_Server, self.server)
+
+    @override
+    def handle(self):
+        server = self._server
+        with server.activity_lock:
+            server.active_requests += 1
+        response: dict[str, Any]
+        try:
+            response = self._respond(json.loads(self.rfile.readline()))
+        except Exception as e:
+            log.exception("Failed to handle a snapshot request")
+            response = {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            with server.activity_lock:
+                server.active_requests -= 1
+                server.last_activity = time.monotonic()
+
+        snapshot: dict[str, Any] | None = response.get("snapshot")
+        try:
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            if snapshot is not None:
+                # Wait until the client holds its own lease (or disconnects)
+                self.rfile.readline()
+        except OSError as e:
+            log.warning(f"Failed to respond to a snapshot request: {e}")
+        finally:
+            if snapshot is not None:
+                release_lease(Path(snapshot["snapshot_dir"]))
+
+    def _respond(self, request: dict[str, Any]) -> dict[str, Any]:
+        server = self._server
+        identity = {key: request.get(key) for key in server.identity}
+        if identity != server.identity:
+            return {
+                "error": "The daemon runs in a different environment "
+                f"({server.identity['executable']}, "
+                f"nshsnap {server.identity['version']})"
+            }
+
+        # Validated from JSON, which accepts strings for paths in strict mode
+        config = SnapshotConfig.model_validate_json(json.dumps(request["config"]))
+        key = json.dumps(request["config"], sort_keys=True)
+
+        def create() -> dict[str, Any]:
+            start = time.perf_counter()
+            # Pick up modules that were installed since the last request
+            importlib.invalidate_caches()
+            active = _snapshot(config)
+            # Only the new snapshot stays leased until the client holds it
+            if active.base_snapshot is not None:
+                release_lease(active.base_snapshot)
+            log.info(
+                f"Created {active.snapshot_dir} in {time.perf_counter() - start:.2f}s"
+            )
+            return _encode_snapshot(active)
+
+        def share(snapshot: dict[str, Any]):
+            # Each request releases its own lease once its client holds one
+            hold_lease(Path(snapshot["snapshot_dir"]))
+
+        snapshot, coalesced = server.coalescer.run(key, create, share)
+        return {"snapshot": snapshot, "coalesced": coalesced}
+
+
+def _remove_stale_socket(socket_path: Path):
+    """Remove the socket of a daemon that is no longer running."""
+    if not socket_path.exists():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            socket_path.unlink(missing_ok=True)
+            return
+    raise RuntimeError(f"A snapshot daemon is already running at {socket_path}")
+
+
+def serve(socket_path: Path | None = None, idle_timeout: float | None = None):
+    """
+    Run the snapshot daemon, which creates snapshots on behalf of `nshsnap`
+    and `nshsnap-run` in this process. The imports, the environment scan and
+    the tool checks stay warm between requests, and identical concurrent
+    requests are coalesced into a single snapshot.
+
+    Args:
+        socket_path: The Unix socket to listen on. Default: `daemon_socket_path()`.
+        idle_timeout: Exit once no request was received for this many seconds.
+    """
+    from ._pip_deps import current_environment
+
+    if socket_path is None:
+        socket_path = daemon_socket_path()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    _remove_stale_socket(socket_path)
+
+    # Warm up before accepting requests
+    current_environment()
+
+    server = _Server(socket_path)
+    os.chmod(socket_path, 0o600)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    if idle_timeout is not None:
+
+        def watch_idle():
+            while True:
+                time.sleep(min(idle_timeout, 10))
+                with server.activity_lock:
+                    idle = time.monotonic() - server.last_activity
+                    if server.active_requests == 0 and idle >= idle_timeout:
+                        break
+            log.info(f"No requests for {idle_timeout:.0f}s. Exiting.")
+            server.shutdown()
+
+        threading.Thread(target=watch_idle, name="nshsnap-idle", daemon=True).start()
+
+    log.critical(f"Serving snapshot requests at {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+        log.info("The snapshot daemon stopped")
@@ -0,0 +1,356 @@
+from __future__ import annotations
+
+import contextlib
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import IO, BinaryIO, Literal, TypeAlias
+
+from typing_extensions import override
+
+from . import _catalog, _trace
+from ._lease import leased
+from ._util import (
+    SNAPSHOT_ARCHIVE_NAME,
+    cache_dir,
+    create_snapshot_scripts,
+    snapshot_id,
+)
+
+log = logging.getLogger(__name__)
+
+CompressionType: TypeAlias = Literal["zstd", "gzip", "none"]
+
+# The scripts hold absolute paths, so they are regenerated on import
+_EXCLUDED = {".bin"}
+
+_SNAPSHOT_DIR_HEADER = "NSHSNAP.snapshot_dir"
+"""The pax header that records the directory the snapshot was exported from."""
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_GZIP_MAGIC = b"\x1f\x8b"
+
+_CHUNK_SIZE = 1 << 20
+
+try:
+    import zstandard  # pyright: ignore[reportMissingImports]
+except ImportError:
+    zstandard = None
+
+
+def _default_compression() -> CompressionType:
+    if zstandard is not None or shutil.which("zstd") is not None:
+        return "zstd"
+    return "gzip"
+
+
+def _check_returncode(process: subprocess.Popen, command: list[str]):
+    if process.returncode != 0:
+        raise RuntimeError(f"{command[0]} exited with status {process.returncode}")
+
+
+@contextlib.contextmanager
+def _piped_writer(command: list[str], output: BinaryIO) -> Iterator[IO[bytes]]:
+    """Write through ``command`` (e.g., a compressor) to ``output``."""
+    _trace.add_subprocess(command)
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    assert process.stdin is not None and process.stdout is not None
+    stdin = process.stdin
+    pump = threading.Thread(
+        target=shutil.copyfileobj, args=(process.stdout, output, _CHUNK_SIZE)
+    )
+    pump.start()
+    try:
+        yield stdin
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            stdin.close()
+        pump.join()
+        process.wait()
+    _check_returncode(process, command)
+
+
+@contextlib.contextmanager
+def _piped_reader(command: list[str], input: BinaryIO) -> Iterator[IO[bytes]]:
+    """Read ``input`` through ``command`` (e.g., a decompressor)."""
+    _trace.add_subprocess(command)
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    assert process.stdin is not None and process.stdout is not None
+    stdin, stdout = process.stdin, process.stdout
+
+    def feed():
+        try:
+            shutil.copyfileobj(input, stdin, _CHUNK_SIZE)
+        except BrokenPipeError:
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                stdin.close()
+
+    pump = threading.Thread(target=feed)
+    pump.start()
+    try:
+        yield stdout
+        # The tar stream ends before its padding, and errors show up at the end
+        while stdout.read(_CHUNK_SIZE):
+            pass
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        stdout.close()
+        pump.join()
+        process.wait()
+    _check_returncode(process, command)
+
+
+@contextlib.contextmanager
+def _compressed_writer(
+    output: BinaryIO,
+    compression: CompressionType,
+    threads: int | None,
+) -> Iterator[IO[bytes]]:
+    """
+    A stream that compresses into ``output``. Compression runs on all cores
+    (or ``threads``) with the `zstandard` module, or the `zstd` and `pigz`
+    binaries, and falls back to single-threaded gzip otherwise.
+    """
+    if compression == "none":
+        yield output
+    elif compression == "zstd" and zstandard is not None:
+        compressor = zstandard.ZstdCompressor(threads=threads or -1)
+        with compressor.stream_writer(output, closefd=False) as writer:
+            yield writer
+    elif compression == "zstd":
+        if shutil.which("zstd") is None:
+            raise RuntimeError(
+                "zstd compression requires the zstandard module or the zstd binary"
+            )
+        with _piped_writer(["zstd", "-q", "-c", f"-T{threads or 0}"], output) as w:
+            yield w
+    elif compression == "gzip" and shutil.which("pigz") is not None:
+        command = ["pigz", "-c"] + (["-p", str(threads)] if threads else [])
+        with _piped_writer(command, output) as writer:
+            yield writer
+    elif compression == "gzip":
+        with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=6) as writer:
+            yield writer  # pyright: ignore[reportReturnType]
+    else:
+        raise ValueError(f"Unknown compression: {compression}")
+
+
+class _Prefixed(io.RawIOBase):
+    """``stream``, with ``prefix`` (which was already read from it) put back."""
+
+    def __init__(self, prefix: bytes, stream: BinaryIO):
+        self._prefix = prefix
+        self._stream = stream
+
+    @override
+    def readable(self) -> bool:
+        return True
+
+    @override
+    def readinto(self, buffer) -> int:
+        if self._prefix:
+            n = min(len(buffer), len(self._prefix))
+            buffer[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        data = self._stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+@contextlib.contextmanager
+def _decompressed_reader(input: BinaryIO) -> Iterator[IO[bytes]]:
+    """A stream that decompresses ``input``, detecting its compression."""
+    magic = input.read(4)
+    stream = io.BufferedReader(_Prefixed(magic, input), _CHUNK_SIZE)
+    if magic.startswith(_ZSTD_MAGIC) and zstandard is not None:
+        with zstandard.ZstdDecompressor().stream_reader(stream) as reader:
+            yield reader
+    elif magic.startswith(_ZSTD_MAGIC):
+        if shutil.which("zstd") is None:
+            raise RuntimeError(
+                "zstd decompression requires the zstandard module or the zstd binary"
+            )
+        with _piped_reader(["zstd", "-q", "-d", "-c"], stream) as reader:
+            yield reader
+    elif magic.startswith(_GZIP_MAGIC):
+        with gzip.GzipFile(fileobj=stream, mode="rb") as reader:
+            yield reader  # pyright: ignore[reportReturnType]
+    else:
+        yield stream
+
+
+def _normalize(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+    # The owner on this host means nothing on the host that imports it
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+
+def export_snapshot(
+    snapshot_dir: Path,
+    output: BinaryIO | Path,
+    compression: CompressionType | None = None,
+    threads: int | None = None,
+) -> int:
+    """
+    Stream the snapshot (its modules and its `.nshsnapmeta` metadata) as a
+    compressed tar archive, which `import_snapshot()` (or `nshsnap import`)
+    turns back into a snapshot elsewhere, e.g., on another host. The archive
+    is written as it is read, so memory use does not grow with the snapshot.
+    Hardlinked files are stored once. The scripts in `.bin` are not exported,
+    since they refer to the path of the snapshot.
+
+    Args:
+        snapshot_dir: The snapshot to export.
+        output: The file (or stream, e.g., `sys.stdout.buffer`) to write to.
+        compression: "zstd", "gzip", or "none". Default: "zstd" if the
+            `zstandard` module or the `zstd` binary is available, else "gzip".
+        threads: The number of compression threads. Default: all cores.
+
+    Returns:
+        The number of files that were exported.
+
+    Raises:
+        ValueError: If ``snapshot_dir`` is not a complete snapshot.
+    """
+    snapshot_dir = snapshot_dir.absolute()
+    if not (snapshot_dir / ".nshsnapmeta" / "modules.json").is_file():
+        raise ValueError(f"{snapshot_dir} is not a complete snapshot")
+    if compression is None:
+        compression = _default_compression()
+
+    if isinstance(output, Path):
+        with output.open("wb") as f:
+            return export_snapshot(snapshot_dir, f, compression, threads)
+
+    start = time.perf_counter()
+    files = 0
+    # Keep `nshsnap gc` from removing the snapshot while it is exported
+    with leased(snapshot_dir):
+        with _compressed_writer(output, compression, threads) as stream:
+            with tarfile.open(
+                fileobj=stream,
+                mode="w|",
+                format=tarfile.PAX_FORMAT,
+                pax_headers={_SNAPSHOT_DIR_HEADER: str(snapshot_dir)},
+                bufsize=_CHUNK_SIZE,
+            ) as tar:
+                for name in sorted(os.listdir(snapshot_dir)):
+                    if name in _EXCLUDED:
+                        continue
+                    tar.add(snapshot_dir / name, arcname=name, filter=_normalize)
+                files = sum(1 for member in tar.getmembers() if not member.isdir())
+        output.flush()
+
+    log.info(
+        f"Exported {snapshot_dir} ({files} files, {compression}) "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return files
+
+
+def _relocate_module_infos(
+    extracted_dir: Path,
+    snapshot_dir: Path,
+    source_dir: str | None,
+):
+    """Point the module destinations that were under ``source_dir`` into ``snapshot_dir``."""
+    if source_dir is None:
+        return
+    path = extracted_dir / ".nshsnapmeta" / "modules.json"
+    module_infos = json.loads(path.read_text())
+    for info in module_infos:
+        if (destination := info.get("destination")) is None:
+            continue
+        rel = os.path.relpath(destination, source_dir)
+        if rel != os.pardir and not rel.startswith(os.pardir + os.sep):
+            info["destination"] = str(snapshot_dir / rel)
+    path.write_text(json.dumps(module_infos, indent=4))
+
+
+def import_snapshot(
+    input: BinaryIO | Path,
+    destination: Path | None = None,
+) -> Path:
+    """
+    Create a snapshot from an archive of `export_snapshot()` (or `nshsnap
+    export`), read as a stream from a file or, e.g., `sys.stdin.buffer`. The
+    compression is detected from the archive. The scripts of the snapshot are
+    created for its new location, and it is added to the snapshot catalog.
+
+    Args:
+        input: The archive to read.
+        destination: The directory to create the snapshot in. Default: a new
+            directory in the default snapshot directory.
+
+    Returns:
+        The directory of the imported snapshot.
+
+    Raises:
+        FileExistsError: If ``destination`` exists and is not empty.
+        ValueError: If the archive is not an exported snapshot.
+    """
+    if destination is None:
+        destination = cache_dir("snapshots") / snapshot_id()
+    destination = destination.absolute()
+    if destination.exists() and any(destination.iterdir()):
+        raise FileExistsError(f"{destination} already exists and is not empty")
+
+    if isinstance(input, Path):
+        with input.open("rb") as f:
+            return import_snapshot(f, destination)
+
+    start = time.perf_counter()
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    partial = destination.parent / f".{destination.name}.partial-{os.getpid()}"
+    try:
+        with _decompressed_reader(input) as stream:
+            with tarfile.open(fileobj=stream, mode="r|", bufsize=_CHUNK_SIZE) as tar:
+                # Rejects absolute paths and links that point out of the snapshot
+                tar.extractall(partial, filter="data")
+                source_dir = tar.pax_headers.get(_SNAPSHOT_DIR_HEADER)
+                files = sum(1 for member in tar.getmembers() if not member.isdir())
+
+        if not (partial / ".nshsnapmeta" / "modules.json").is_file():
+            raise ValueError("The archive is not an exported snapshot")
+        _relocate_module_infos(partial, destination, source_dir)
+
+        # The scripts refer to the final location of the snapshot
+        script_dir = partial / ".bin"
+        script_dir.mkdir()
+        python_path = None
+        if (partial / SNAPSHOT_ARCHIVE_NAME).is_file():
+            python_path = destination / SNAPSHOT_ARCHIVE_NAME
+        create_snapshot_scripts(destination, script_dir, python_path)
+
+        if destination.exists():
+            destination.rmdir()
+        os.replace(partial, destination)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    _catalog.record_existing(destination)
+    log.info(
+        f"Imported {files} files to {destination}"
+        + (f" (exported from {source_dir})" if source_dir else "")
+        + f" in {time.perf_counter() - start:.2f}s"
+    )
+    return destination
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+from collections.abc import Iterator
+from pathlib import Path
+from typing import IO
+
+from . import _trace
+from ._ignore import walk_source_files
+from ._util import is_git_repository
+
+log = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _git_ls_files_command(source: Path) -> list[str]:
+    return [
+        "git",
+        "-C",
+        str(source),
+        "ls-files",
+        "-z",
+        "--cached",
+        "--others",
+        "--exclude-standard",
+    ]
+
+
+def use_git(source: Path) -> bool:
+    """Whether the files of ``source`` are listed by git (rather than `walk_source_files`)."""
+    return shutil.which("git") is not None and is_git_repository(source)
+
+
+def stream_source_manifest(source: Path) -> subprocess.Popen[bytes]:
+    """
+    Start streaming the NUL-delimited list of the files under ``source`` that
+    belong in a snapshot (see `list_source_files`) on the returned process's
+    stdout. The caller must wait for the process and check its return code.
+
+    Only for sources in git repositories (see `use_git`).
+    """
+    command = _git_ls_files_command(source)
+    _trace.add_subprocess(command)
+    return subprocess.Popen(command, stdout=subprocess.PIPE)
+
+
+def _iter_nul_delimited(stream: IO[bytes]) -> Iterator[bytes]:
+    pending = b""
+    while chunk := stream.read(_CHUNK_SIZE):
+        *entries, pending = (pending + chunk).split(b"\0")
+        yield from entries
+    if pending:
+        yield pending
+
+
+def list_source_files(source: Path) -> Iterator[Path]:
+    """
+    List the files under ``source`` that belong in a snapshot.
+
+    This is the tracked and untracked-but-not-ignored files reported by git,
+    i.e., the same set of files that `rsync` copies when the ignored files are
+    excluded. Paths are yielded relative to ``source`` as they are streamed
+    from git, so memory use does not grow with the size of the repository.
+
+    Sources outside of git repositories (or without a git binary) are walked
+    instead, applying their `.gitignore` files (see `walk_source_files`).
+
+    Args:
+        source (Path): The path to the source directory.
+
+    Raises:
+        CalledProcessError: If the git command fails.
+    """
+    if not use_git(source):
+        yield from walk_source_files(source)
+        return
+
+    process = stream_source_manifest(source)
+    assert process.stdout is not None
+    completed = False
+    try:
+        previous = None
+        for raw in _iter_nul_delimited(process.stdout):
+            # Tracked files are listed once per merge stage during a conflict.
+            if not raw or raw == previous:
+                continue
+            previous = raw
+
+            rel = os.fsdecode(raw)
+            path = source / rel
+            if path.is_symlink() or path.is_file():
+                yield Path(rel)
+            elif path.is_dir():
+                # Submodules are listed as a single (gitlink) entry.
+                for root, dirs, files in os.walk(path):
+                    dirs[:] = [d for d in dirs if d != ".git"]
+                    for name in files:
+                        yield Path(root, name).relative_to(source)
+            else:
+                # Tracked files that were deleted from the working tree.
+                log.debug(f"Skipping missing file {path}")
+        completed = True
+    finally:
+        process.stdout.close()
+        if not completed:
+            # The consumer stopped early (or failed), so git may be blocked on the pipe.
+            process.kill()
+        returncode = process.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, process.args)
+
+
+def file_digest(path: Path) -> str:
+    """Return the hex digest of the contents of the file at ``path``."""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file_digest(source: Path, destination: IO[bytes]) -> str:
+    """
+    Copy the contents of the file at ``source`` to ``destination``, and return
+    the hex digest (as `file_digest`) of the bytes that were copied.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(source, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            digest.update(chunk)
+            destination.write(chunk)
+    return digest.hexdigest()
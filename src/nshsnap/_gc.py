@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import ClassVar
+
+from ._catalog import remove_snapshots
+from ._lease import DEFAULT_LEASE_TTL_SECONDS, LAST_USED_NAME, read_leases
+from ._util import cache_dir, disk_usage, file_lock
+
+log = logging.getLogger(__name__)
+
+_TRASH_PREFIX = ".nshsnap-trash-"
+
+
+@dataclass(frozen=True, slots=True)
+class _Candidate:
+    path: Path
+    last_used: float
+    size: int
+    complete: bool
+
+
+@dataclass(slots=True)
+class GCResult:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    removed: list[Path] = field(default_factory=list)
+    """The snapshots that were removed (or would be, for a dry run)."""
+
+    bytes_freed: int = 0
+    """The disk usage of the removed snapshots."""
+
+    kept: int = 0
+    """The number of snapshots that were kept."""
+
+    bytes_kept: int = 0
+    """The disk usage of the snapshots that were kept."""
+
+    leased: list[Path] = field(default_factory=list)
+    """The snapshots that were kept because they are in use by running jobs."""
+
+    blobs_removed: int = 0
+    """The number of unreferenced blobs removed from the snapshot store."""
+
+    blob_bytes_freed: int = 0
+    """The size of the unreferenced blobs removed from the snapshot store."""
+
+
+def _last_used(path: Path) -> float:
+    mtimes = [path.stat().st_mtime]
+    for name in (LAST_USED_NAME, "modules.json"):
+        try:
+            mtimes.append((path / ".nshsnapmeta" / name).stat().st_mtime)
+        except OSError:
+            pass
+    return max(mtimes)
+
+
+def _candidate(path: Path) -> _Candidate:
+    return _Candidate(
+        path,
+        _last_used(path),
+        disk_usage(path),
+        (path / ".nshsnapmeta" / "modules.json").is_file(),
+    )
+
+
+def _unlink_all(paths: list[str]):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_tree(path: Path, executor: Executor):
+    """
+    Remove the directory tree at ``path``, unlinking the files of different
+    directories in parallel.
+    """
+    directories: list[str] = []
+    jobs: list[list[str]] = []
+    stack = [str(path)]
+    while stack:
+        directory = stack.pop()
+        directories.append(directory)
+        files: list[str] = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+        if files:
+            jobs.append(files)
+
+    for _ in executor.map(_unlink_all, jobs):
+        pass
+    # Every directory is listed before its subdirectories
+    for directory in reversed(directories):
+        os.rmdir(directory)
+
+
+def _is_leased(path: Path, ttl: float) -> bool:
+    key = str(path.absolute())
+    return any(
+        str(lease.snapshot_dir) == key and lease.is_alive(ttl)
+        for lease in read_leases()
+    )
+
+
+def _evict(path: Path, ttl: float, executor: Executor) -> bool:
+    # A job may have started using the snapshot since the scan
+    if _is_leased(path, ttl):
+        return False
+
+    # Renamed first, so that the snapshot disappears atomically and a partial
+    # removal is finished by the next collection.
+    trash = path.with_name(f"{_TRASH_PREFIX}{uuid.uuid4().hex}")
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        return False
+    remove_tree(trash, executor)
+    return True
+
+
+def _collect_store(store_dir: Path, dry_run: bool) -> tuple[int, int]:
+    """Remove the blobs of the store that are no longer linked from any snapshot."""
+    removed = 0
+    freed = 0
+    objects_dir = store_dir / "objects"
+    if not objects_dir.is_dir():
+        return removed, freed
+
+    for prefix in objects_dir.iterdir():
+        if not prefix.is_dir():
+            continue
+        for blob in prefix.iterdir():
+            try:
+                st = blob.lstat()
+            except FileNotFoundError:
+                continue
+            if st.st_nlink != 1:
+                continue
+            if not dry_run:
+                blob.unlink(missing_ok=True)
+            removed += 1
+            freed += st.st_size
+    return removed, freed
+
+
+def _collect_reuse_entries():
+    """Remove the published reusable snapshots that no longer exist."""
+    for entry in cache_dir("reuse").iterdir():
+        if (
+            entry.is_symlink()
+            and not (entry / ".nshsnapmeta" / "modules.json").is_file()
+        ):
+            entry.unlink(missing_ok=True)
+
+
+def _collect_leases(ttl: float):
+    for lease in read_leases():
+        if not lease.is_alive(ttl):
+            lease.path.unlink(missing_ok=True)
+
+
+def gc_snapshots(
+    *,
+    max_bytes: int | None = None,
+    max_count: int | None = None,
+    max_age: float | None = None,
+    snapshots_dir: Path | None = None,
+    store_dir: Path | None = None,
+    lease_ttl: float = DEFAULT_LEASE_TTL_SECONDS,
+    workers: int | None = None,
+    dry_run: bool = False,
+) -> GCResult:
+    """
+    Remove the least recently used snapshots until the remaining snapshots fit
+    in the given budgets.
+
+    Snapshots that are leased by running jobs (see `load_existing_snapshot`,
+    `nshsnap-run` and `.bin/execute`) are never removed, but they count toward
+    the budgets.
+
+    Args:
+        max_bytes: The maximum total disk usage of the snapshots.
+        max_count: The maximum number of snapshots.
+        max_age: Remove snapshots that were not used for this many seconds.
+        snapshots_dir: The directory that holds the snapshots. Default:
+            `~/.cache/nshsnap/snapshots`.
+        store_dir: The snapshot store to remove unreferenced blobs from.
+            Default: `~/.cache/nshsnap/store`, if it exists.
+        lease_ttl: How long a lease from another host is honored after its
+            last refresh, in seconds.
+        workers: The number of threads used to scan and remove snapshots.
+        dry_run: Only report what would be removed.
+    """
+    if snapshots_dir is None:
+        snapshots_dir = cache_dir("snapshots")
+    if store_dir is None:
+        store_dir = cache_dir("store", create=False)
+
+    result = GCResult()
+    removed = "Would remove" if dry_run else "Removed"
+    with file_lock(cache_dir() / "gc.lock"):
+        if not dry_run:
+            _collect_leases(lease_ttl)
+
+        leased = {
+            str(lease.snapshot_dir)
+            for lease in read_leases()
+            if lease.is_alive(lease_ttl)
+        }
+        now = time.time()
+
+        paths = [
+            path
+            for path in sorted(snapshots_dir.iterdir())
+            if path.is_dir() and not path.is_symlink() and not path.name.startswith(".")
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Finish the removals that were interrupted
+            if not dry_run:
+                for trash in snapshots_dir.glob(f"{_TRASH_PREFIX}*"):
+                    remove_tree(trash, executor)
+
+            candidates = sorted(
+                executor.map(_candidate, paths), key=lambda c: c.last_used
+            )
+            count = len(candidates)
+            total = sum(candidate.size for candidate in candidates)
+
+            for candidate in candidates:
+                if str(candidate.path.absolute()) in leased:
+                    result.leased.append(candidate.path)
+                    result.kept += 1
+                    result.bytes_kept += candidate.size
+                    continue
+
+                age = now - candidate.last_used
+                evict = (
+                    (max_age is not None and age > max_age)
+                    or (max_count is not None and count > max_count)
+                    or (max_bytes is not None and total > max_bytes)
+                )
+                # Snapshots that are still being created are not leased yet
+                if not candidate.complete and age < lease_ttl:
+                    evict = False
+
+                if evict and (dry_run or _evict(candidate.path, lease_ttl, executor)):
+                    log.info(
+                        f"{removed} snapshot {candidate.path} ({candidate.size} bytes)"
+                    )
+                    result.removed.append(candidate.path)
+                    result.bytes_freed += candidate.size
+                    count -= 1
+                    total -= candidate.size
+                else:
+                    result.kept += 1
+                    result.bytes_kept += candidate.size
+
+        if not dry_run:
+            remove_snapshots(result.removed)
+            _collect_reuse_entries()
+        if store_dir.is_dir():
+            result.blobs_removed, result.blob_bytes_freed = _collect_store(
+                store_dir, dry_run
+            )
+
+    log.info(
+        f"{removed} {len(result.removed)} snapshots ({result.bytes_freed} bytes) and "
+        f"{result.blobs_removed} store blobs ({result.blob_bytes_freed} bytes). "
+        f"Kept {result.kept} snapshots ({result.bytes_kept} bytes), "
+        f"{len(result.leased)} of which are in use."
+    )
+    return result
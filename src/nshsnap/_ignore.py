@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import os
+import re
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar
+
+IGNORE_FILE_NAME = ".gitignore"
+
+
+def _translate_class(pattern: str, i: int) -> tuple[str, int] | None:
+    """Translate the bracket expression starting at ``pattern[i] == "["``."""
+    j = i + 1
+    if j < len(pattern) and pattern[j] in "!^":
+        j += 1
+    if j < len(pattern) and pattern[j] == "]":
+        j += 1
+    while j < len(pattern) and pattern[j] != "]":
+        j += 1
+    if j >= len(pattern):
+        return None
+
+    body = pattern[i + 1 : j]
+    negate = body[:1] in ("!", "^")
+    if negate:
+        body = body[1:]
+    body = body.replace("\\", "\\\\").replace("[", "\\[")
+    return f"[{'^/' if negate else ''}{body}]", j + 1
+
+
+def _translate(pattern: str) -> str:
+    """Translate a gitignore glob (without its leading and trailing slashes) to a regex."""
+    out: list[str] = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if (
+                pattern.startswith("**", i)
+                and (i == 0 or pattern[i - 1] == "/")
+                and (i + 2 == n or pattern[i + 2] == "/")
+            ):
+                if i + 2 == n:
+                    # Trailing `/**`: everything inside
+                    out.append(".*")
+                    i += 2
+                else:
+                    # Leading `**/` or `/**/`: zero or more directories
+                    out.append("(?:.*/)?")
+                    i += 3
+                continue
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and (translated := _translate_class(pattern, i)) is not None:
+            out.append(translated[0])
+            i = translated[1]
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+@dataclass(frozen=True, slots=True)
+class IgnoreRule:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    regex: re.Pattern[str]
+    """Matches the paths (relative to the directory of the ignore file) of the rule."""
+
+    negate: bool
+    """Whether the rule re-includes the paths it matches (`!pattern`)."""
+
+    dir_only: bool
+    """Whether the rule only matches directories (`pattern/`)."""
+
+    @classmethod
+    def parse(cls, line: str) -> IgnoreRule | None:
+        """Compile a line of a gitignore file, or return None for blank lines and comments."""
+        # Trailing spaces are ignored unless they are escaped
+        line = line.rstrip("\n")
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and len(stripped) < len(line):
+            stripped += " "
+        line = stripped
+
+        if not line or line.startswith("#"):
+            return None
+
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+
+        # A pattern with a slash (other than a trailing one) is relative to the
+        # directory of the ignore file. Otherwise, it matches at any depth.
+        anchored = "/" in line
+        regex = _translate(line.lstrip("/"))
+        if not anchored:
+            regex = f"(?:.*/)?{regex}"
+        return cls(re.compile(regex, re.DOTALL), negate, dir_only)
+
+
+@dataclass(frozen=True, slots=True)
+class IgnoreRules:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    rules: list[IgnoreRule]
+    """The rules of the ignore file, in order."""
+
+    @classmethod
+    def from_lines(cls, lines: list[str]):
+        return cls([rule for line in lines if (rule := IgnoreRule.parse(line))])
+
+    @classmethod
+    def from_file(cls, path: Path) -> IgnoreRules | None:
+        try:
+            text = path.read_text(errors="surrogateescape")
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return cls.from_lines(text.splitlines()) or None
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, path: str, is_dir: bool) -> bool | None:
+        """
+        Return whether ``path`` (relative to the directory of the ignore file) is
+        ignored, or None if no rule matches it. As in git, the last matching rule wins.
+        """
+        for rule in reversed(self.rules):
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.fullmatch(path):
+                return not rule.negate
+        return None
+
+
+def _is_ignored(stack: list[tuple[str, IgnoreRules]], path: str, is_dir: bool):
+    # Rules in deeper directories take precedence
+    for base, rules in reversed(stack):
+        if (ignored := rules.match(path[len(base) :], is_dir)) is not None:
+            return ignored
+    return False
+
+
+def walk_source_files(source: Path) -> Iterator[Path]:
+    """
+    List the files under ``source`` that are not excluded by its `.gitignore`
+    files, with a single `os.scandir` pass and without git.
+
+    Ignored directories are not descended into, so (as in git) their files
+    cannot be re-included. Paths are relative to ``source``, in a
+    deterministic order.
+    """
+
+    def walk(
+        directory: str,
+        rel: str,
+        stack: list[tuple[str, IgnoreRules]],
+    ) -> Iterator[Path]:
+        if rules := IgnoreRules.from_file(Path(directory, IGNORE_FILE_NAME)):
+            stack = [*stack, (rel, rules)]
+
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name == ".git":
+                continue
+            path = f"{rel}{entry.name}"
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if _is_ignored(stack, path, is_dir):
+                continue
+            if is_dir:
+                yield from walk(entry.path, f"{path}/", stack)
+            else:
+                yield Path(path)
+
+    return walk(str(source), "", [])
+
+
+class IgnoreMatcher:
+    """
+    Match single paths against the `.gitignore` files of a tree, with the
+    same rules as `walk_source_files`. The ignore files are read once.
+    """
+
+    def __init__(self, source: Path):
+        self.source = source
+        self._rules: dict[str, IgnoreRules | None] = {}
+
+    def _rules_of(self, directory: str) -> IgnoreRules | None:
+        if directory not in self._rules:
+            self._rules[directory] = IgnoreRules.from_file(
+                self.source / directory / IGNORE_FILE_NAME
+            )
+        return self._rules[directory]
+
+    def is_ignored(self, path: str, is_dir: bool) -> bool:
+        """Whether ``path`` (relative to the source) or any of its parents is ignored."""
+        stack: list[tuple[str, IgnoreRules]] = []
+        directory = ""
+        parts = path.split("/")
+        for i, part in enumerate(parts):
+            if rules := self._rules_of(directory):
+                stack = [*stack, (directory, rules)]
+            current = f"{directory}{part}"
+            last = i == len(parts) - 1
+            if part == ".git" or _is_ignored(stack, current, is_dir or not last):
+                return True
+            directory = f"{current}/"
+        return False
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import subprocess
+from collections import Counter
+from pathlib import Path
+from typing import Literal
+
+from . import _trace
+
+log = logging.getLogger(__name__)
+
+
+def _snapshot_modules(snapshot_dir: Path) -> list[dict] | None:
+    try:
+        return json.loads((snapshot_dir / ".nshsnapmeta" / "modules.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _latest_snapshot(parent: Path, modules: list[str], exclude: Path) -> Path | None:
+    """Find the most recent complete directory snapshot of ``modules`` in ``parent``."""
+    candidates: list[tuple[int, Path]] = []
+    for snapshot_dir in parent.iterdir():
+        if snapshot_dir == exclude or not snapshot_dir.is_dir():
+            continue
+        modules_json = snapshot_dir / ".nshsnapmeta" / "modules.json"
+        try:
+            candidates.append((modules_json.stat().st_mtime_ns, snapshot_dir))
+        except OSError:
+            continue
+
+    wanted = sorted(modules)
+    for _, snapshot_dir in sorted(candidates, reverse=True):
+        if (infos := _snapshot_modules(snapshot_dir)) is None:
+            continue
+        if sorted(info["name"] for info in infos) != wanted:
+            continue
+        # Zip snapshots have no files to link from
+        if any(
+            info.get("destination") and not Path(info["destination"]).is_dir()
+            for info in infos
+        ):
+            continue
+        return snapshot_dir
+    return None
+
+
+def resolve_base_snapshot(
+    base_snapshot: Path | Literal["latest"] | None,
+    snapshot_dir: Path,
+    modules: list[str],
+) -> Path | None:
+    """
+    Resolve the snapshot that an incremental snapshot is derived from.
+
+    ``"latest"`` is the most recent snapshot of the same set of modules next
+    to ``snapshot_dir`` (e.g., in the default snapshot directory).
+    """
+    if base_snapshot is None:
+        return None
+
+    snapshot_dir = snapshot_dir.absolute()
+    if base_snapshot == "latest":
+        base = _latest_snapshot(snapshot_dir.parent, modules, exclude=snapshot_dir)
+        if base is None:
+            log.info(
+                f"No previous snapshot of {modules=} in {snapshot_dir.parent}. "
+                "Creating a full snapshot."
+            )
+        return base
+
+    base = base_snapshot.absolute()
+    if _snapshot_modules(base) is None:
+        raise ValueError(f"Base snapshot {base} is not a valid snapshot directory.")
+    return base
+
+
+def changed_files(location: Path, commit: str) -> set[Path] | None:
+    """
+    List the files under ``location`` that may differ from their contents at
+    ``commit``: files that were modified, added or deleted since the commit
+    (in the working tree, staged or not), and all untracked files.
+
+    Returns:
+        The paths relative to ``location``, or None if they cannot be
+        determined (e.g., the commit is not in the repository).
+    """
+
+    def git(*args: str) -> list[str]:
+        _trace.add_subprocess(["git"])
+        output = subprocess.run(
+            ["git", "-C", str(location), *args],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        ).stdout
+        return [os.fsdecode(raw) for raw in output.split(b"\0") if raw]
+
+    try:
+        diff = git(
+            "diff",
+            "--name-status",
+            "--no-renames",
+            "--relative",
+            "-z",
+            commit,
+            "--",
+            ".",
+        )
+        untracked = git("ls-files", "-z", "--others", "--exclude-standard")
+    except subprocess.CalledProcessError as e:
+        log.info(f"Cannot diff {location} against {commit}: {e.stderr.decode()}")
+        return None
+
+    # `--name-status -z` alternates between the status and the path
+    statuses = Counter(status[0] for status in diff[0::2])
+    changed = {Path(path) for path in diff[1::2]}
+    changed.update(Path(path) for path in untracked)
+    log.info(
+        f"{location} since {commit[:12]}: {statuses['M'] + statuses['T']} modified, "
+        f"{statuses['A']} added, {statuses['D']} deleted, {len(untracked)} untracked"
+    )
+    return changed
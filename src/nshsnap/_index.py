@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import zipimport
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from types import ModuleType
+from typing import TypedDict
+
+from typing_extensions import override
+
+log = logging.getLogger(__name__)
+
+MODULE_INDEX_NAME = "module_index.json"
+
+_INDEX_VERSION = 1
+
+
+class ModuleIndexEntry(TypedDict):
+    origin: str | None
+    """The file of the module, relative to the snapshot root (None for namespace packages)."""
+
+    package: bool
+    """Whether the module is a (regular or namespace) package."""
+
+
+def _suffix_priority() -> list[str]:
+    # The same order as the path-based finder: extensions, sources, bytecode
+    return [
+        *importlib.machinery.EXTENSION_SUFFIXES,
+        *importlib.machinery.SOURCE_SUFFIXES,
+        *importlib.machinery.BYTECODE_SUFFIXES,
+    ]
+
+
+def _module_files(filenames: Iterable[str], suffixes: list[str]) -> dict[str, str]:
+    """Map each module name in a directory to its highest-priority file."""
+    modules: dict[str, tuple[int, str]] = {}
+    for filename in filenames:
+        for priority, suffix in enumerate(suffixes):
+            if not filename.endswith(suffix):
+                continue
+            name = filename[: -len(suffix)]
+            if name.isidentifier() and (
+                name not in modules or priority < modules[name][0]
+            ):
+                modules[name] = (priority, filename)
+            break
+    return {name: filename for name, (_, filename) in modules.items()}
+
+
+def build_module_index(
+    snapshot_dir: Path,
+    top_level_names: Iterable[str],
+) -> dict[str, ModuleIndexEntry]:
+    """
+    Index every importable module under the given top-level packages of the
+    snapshot directory, by fully qualified name.
+    """
+    suffixes = _suffix_priority()
+    index: dict[str, ModuleIndexEntry] = {}
+    for top_level_name in sorted(set(top_level_names)):
+        for dirpath, dirnames, filenames in os.walk(snapshot_dir / top_level_name):
+            rel_dir = Path(dirpath).relative_to(snapshot_dir)
+            package = ".".join(rel_dir.parts)
+            # Only descend into directories that can be imported as packages
+            dirnames[:] = sorted(
+                d for d in dirnames if d.isidentifier() and d != "__pycache__"
+            )
+
+            files = _module_files(filenames, suffixes)
+            init = files.pop("__init__", None)
+            index[package] = {
+                "origin": (rel_dir / init).as_posix() if init is not None else None,
+                "package": True,
+            }
+            for name, filename in files.items():
+                index[f"{package}.{name}"] = {
+                    "origin": (rel_dir / filename).as_posix(),
+                    "package": False,
+                }
+    return index
+
+
+def write_module_index(snapshot_dir: Path, top_level_names: Iterable[str]):
+    """Write the module index of the snapshot to ``.nshsnapmeta``."""
+    index = build_module_index(snapshot_dir, top_level_names)
+    (snapshot_dir / ".nshsnapmeta" / MODULE_INDEX_NAME).write_text(
+        json.dumps({"version": _INDEX_VERSION, "modules": index})
+    )
+    log.info(f"Indexed {len(index)} modules in {snapshot_dir}")
+
+
+def read_module_index(snapshot_dir: Path) -> dict[str, ModuleIndexEntry] | None:
+    """Read the module index of the snapshot, or return None if it has none."""
+    try:
+        data = json.loads(
+            (snapshot_dir / ".nshsnapmeta" / MODULE_INDEX_NAME).read_text()
+        )
+    except FileNotFoundError:
+        return None
+
+    if data.get("version") != _INDEX_VERSION:
+        log.warning(f"Ignoring the module index of {snapshot_dir} (unknown version)")
+        return None
+    return data["modules"]
+
+
+class SnapshotModuleFinder(importlib.abc.MetaPathFinder):
+    """
+    A meta-path finder that resolves the modules of a snapshot from its
+    module index, without touching the filesystem, and declines every other
+    module with a single dictionary lookup.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        index: dict[str, ModuleIndexEntry],
+        archive: Path | None = None,
+    ):
+        super().__init__()
+
+        self.root = root
+        """The snapshot directory, or the snapshot archive for zip snapshots."""
+
+        self.index = index
+        self.archive = archive
+        self._zip_importers: dict[str, zipimport.zipimporter] = {}
+
+    @classmethod
+    def from_python_path(cls, python_path: Path):
+        """
+        Create a finder for the snapshot whose `sys.path` entry is
+        ``python_path``, or return None if the snapshot has no module index.
+        """
+        is_archive = python_path.is_file()
+        snapshot_dir = python_path.parent if is_archive else python_path
+        if (index := read_module_index(snapshot_dir)) is None:
+            return None
+        return cls(python_path, index, archive=python_path if is_archive else None)
+
+    def _find_zip_spec(self, fullname: str):
+        # Like the path-based finder, the module is found by the importer of
+        # the directory that contains it.
+        parent = "/".join(fullname.split(".")[:-1])
+        if (importer := self._zip_importers.get(parent)) is None:
+            prefix = f"{self.root}/{parent}/" if parent else str(self.root)
+            importer = self._zip_importers[parent] = zipimport.zipimporter(prefix)
+        return importer.find_spec(fullname)
+
+    @override
+    def find_spec(
+        self,
+        fullname: str,
+        path: Sequence[str] | None = None,
+        target: ModuleType | None = None,
+    ):
+        if (entry := self.index.get(fullname)) is None:
+            return None
+
+        if self.archive is not None:
+            return self._find_zip_spec(fullname)
+
+        search_location = self.root.joinpath(*fullname.split("."))
+        if entry["origin"] is None:
+            # Namespace package
+            spec = importlib.machinery.ModuleSpec(fullname, None, is_package=True)
+            spec.submodule_search_locations = [str(search_location)]
+            return spec
+
+        return importlib.util.spec_from_file_location(
+            fullname,
+            self.root / entry["origin"],
+            submodule_search_locations=[str(search_location)]
+            if entry["package"]
+            else None,
+        )
+
+    @override
+    def __repr__(self):
+        return f"{type(self).__name__}({str(self.root)!r})"
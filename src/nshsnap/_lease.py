@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import atexit
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shlex
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar
+
+from ._util import cache_dir
+
+log = logging.getLogger(__name__)
+
+LEASE_HEARTBEAT_SECONDS = 300
+"""How often the leases of running jobs are refreshed."""
+
+DEFAULT_LEASE_TTL_SECONDS = 3600
+"""How long a lease from another host is honored after its last refresh."""
+
+LAST_USED_NAME = "last_used"
+"""The file in `.nshsnapmeta` whose mtime records when the snapshot was last used."""
+
+_BOOT_ID_PATH = Path("/proc/sys/kernel/random/boot_id")
+
+# The leases held by this process, by snapshot directory, and how many times
+# each one is held. The lease file is removed once the last holder releases it.
+_held: dict[str, Path] = {}
+_holders: dict[str, int] = {}
+_held_lock = threading.Lock()
+_heartbeat: threading.Thread | None = None
+
+
+def lease_dir() -> Path:
+    return cache_dir("leases")
+
+
+def lease_key(snapshot_dir: Path) -> str:
+    return hashlib.sha256(str(snapshot_dir.absolute()).encode()).hexdigest()[:16]
+
+
+def _boot_id() -> str:
+    try:
+        return _BOOT_ID_PATH.read_text().strip()
+    except OSError:
+        return ""
+
+
+@dataclass(frozen=True, slots=True)
+class SnapshotLease:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    path: Path
+    """The lease file."""
+
+    snapshot_dir: Path
+    """The snapshot that is in use."""
+
+    host: str
+    """The host of the process that uses the snapshot."""
+
+    pid: int
+    """The process that uses the snapshot."""
+
+    boot_id: str
+    """The boot ID of the host, to detect PIDs from before a reboot."""
+
+    refreshed: float
+    """When the lease was last refreshed (its mtime)."""
+
+    @classmethod
+    def read(cls, path: Path) -> SnapshotLease | None:
+        try:
+            data = json.loads(path.read_text())
+            refreshed = path.stat().st_mtime
+            return cls(
+                path,
+                Path(data["snapshot_dir"]),
+                data["host"],
+                int(data["pid"]),
+                data.get("boot_id", ""),
+                refreshed,
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.debug(f"Ignoring invalid lease {path}: {e}")
+            return None
+
+    def is_alive(self, ttl: float = DEFAULT_LEASE_TTL_SECONDS) -> bool:
+        """
+        Whether the process holding the lease may still be running. Leases of
+        this host are checked by PID, and leases of other hosts expire if they
+        are not refreshed within ``ttl`` seconds.
+        """
+        if self.host != socket.gethostname():
+            return time.time() - self.refreshed < ttl
+        if self.boot_id and self.boot_id != _boot_id():
+            # The host was rebooted since
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+
+def read_leases() -> list[SnapshotLease]:
+    """Read all lease files."""
+    return [
+        lease
+        for path in sorted(lease_dir().glob("*.json"))
+        if (lease := SnapshotLease.read(path)) is not None
+    ]
+
+
+def mark_used(snapshot_dir: Path):
+    """Record that the snapshot was used now, for LRU eviction."""
+    path = snapshot_dir / ".nshsnapmeta" / LAST_USED_NAME
+    try:
+        path.touch()
+    except OSError as e:
+        log.debug(f"Failed to mark {snapshot_dir} as used: {e}")
+
+
+def _refresh_leases():
+    while True:
+        time.sleep(LEASE_HEARTBEAT_SECONDS)
+        with _held_lock:
+            paths = list(_held.values())
+        for path in paths:
+            with contextlib.suppress(OSError):
+                os.utime(path)
+
+
+def _release_leases():
+    with _held_lock:
+        for path in _held.values():
+            path.unlink(missing_ok=True)
+        _held.clear()
+        _holders.clear()
+
+
+def hold_lease(snapshot_dir: Path):
+    """
+    Register a lease on ``snapshot_dir`` for the rest of the lifetime of this
+    process (or until it is released by `release_lease`), so that `nshsnap gc`
+    does not remove it. Leases are counted: the lease is held until it was
+    released as many times as it was held.
+    """
+    global _heartbeat
+
+    snapshot_dir = snapshot_dir.absolute()
+    mark_used(snapshot_dir)
+
+    with _held_lock:
+        if str(snapshot_dir) in _held:
+            _holders[str(snapshot_dir)] += 1
+            return
+
+        host = socket.gethostname()
+        pid = os.getpid()
+        path = lease_dir() / f"{lease_key(snapshot_dir)}-{host}-{pid}.json"
+        data = {
+            "snapshot_dir": str(snapshot_dir),
+            "host": host,
+            "pid": pid,
+            "boot_id": _boot_id(),
+        }
+        try:
+            path.write_text(json.dumps(data))
+        except OSError as e:
+            log.warning(f"Failed to register a lease on {snapshot_dir}: {e}")
+            return
+        _held[str(snapshot_dir)] = path
+        _holders[str(snapshot_dir)] = 1
+
+        if _heartbeat is None:
+            atexit.register(_release_leases)
+            _heartbeat = threading.Thread(
+                target=_refresh_leases, name="nshsnap-lease", daemon=True
+            )
+            _heartbeat.start()
+
+
+def release_lease(snapshot_dir: Path):
+    """
+    Release one hold of this process on the lease of ``snapshot_dir``, and
+    remove the lease once it is no longer held.
+    """
+    key = str(snapshot_dir.absolute())
+    with _held_lock:
+        if key not in _held:
+            return
+        _holders[key] -= 1
+        if _holders[key] == 0:
+            del _holders[key]
+            _held.pop(key).unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def leased(snapshot_dir: Path):
+    """Hold a lease on ``snapshot_dir`` for the duration of the context."""
+    hold_lease(snapshot_dir)
+    try:
+        yield
+    finally:
+        release_lease(snapshot_dir)
+
+
+def lease_script(snapshot_dir: Path) -> str:
+    """
+    A bash snippet that registers a lease on ``snapshot_dir`` for the shell
+    process (and the command it `exec`s), refreshes it while the process is
+    running, and releases it once it exits.
+    """
+    snapshot_dir = snapshot_dir.absolute()
+    directory = lease_dir()
+    lease_file = f"{directory}/{lease_key(snapshot_dir)}-$HOSTNAME-$$.json"
+    snapshot_json = json.dumps(str(snapshot_dir))
+    last_used = snapshot_dir / ".nshsnapmeta" / LAST_USED_NAME
+    return f"""# Register a lease on the snapshot while the command runs, so that
+# `nshsnap gc` does not remove it
+lease_file="{lease_file}"
+if mkdir -p {shlex.quote(str(directory))} 2>/dev/null; then
+    touch {shlex.quote(str(last_used))} 2>/dev/null
+    printf '{{"snapshot_dir": %s, "host": "%s", "pid": %d, "boot_id": "%s"}}\\n' \\
+        {shlex.quote(snapshot_json)} "$HOSTNAME" "$$" \\
+        "$(cat {_BOOT_ID_PATH} 2>/dev/null)" > "$lease_file"
+    (
+        while kill -0 $$ 2>/dev/null; do
+            touch "$lease_file"
+            sleep {LEASE_HEARTBEAT_SECONDS}
+        done
+        rm -f "$lease_file"
+    ) </dev/null >/dev/null 2>&1 &
+fi
+"""
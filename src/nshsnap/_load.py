@@ -3,6 +3,7 @@ from __future__ import annotations
 import contextlib
 import importlib
 import importlib.util
+import json
 import logging
 import os
 import shutil
@@ -14,11 +15,18 @@ from typing import Literal, TypeAlias
 
 from typing_extensions import assert_never, final, override
 
+from ._index import SnapshotModuleFinder
+from ._lease import hold_lease
+from ._util import snapshot_python_path
+
 log = logging.getLogger(__name__)
 
 
 ACTIVE_SNAPSHOT_ENV_VAR = "NSHSNAP_ACTIVE_SNAPSHOT_DIR"
 
+# The module index finders installed in place of `sys.path` entries
+_active_finders: dict[str, SnapshotModuleFinder] = {}
+
 OnErrorType: TypeAlias = Literal["warn", "raise"]
 OnExistingSnapshotType: TypeAlias = Literal[
     "warn_and_overwrite",
@@ -38,12 +46,14 @@ class LoadExistingSnapshotContext(contextlib.AbstractContextManager):
         snapshot_dirs: list[Path],
         on_existing_snapshot: OnExistingSnapshotType,
         remove_paths: list[Path] = [],
+        use_module_index: bool = False,
     ):
         super().__init__()
 
         self.snapshot_dirs = [dir.absolute() for dir in snapshot_dirs]
         self.on_existing_snapshot = on_existing_snapshot
         self.remove_paths = remove_paths
+        self.use_module_index = use_module_index
 
         self.__enter__()
 
@@ -66,13 +76,26 @@ class LoadExistingSnapshotContext(contextlib.AbstractContextManager):
     def _load_snapshots(
         self, snapshot_dir_strs: list[str], reset_import_cache: bool = True
     ):
+        modified_sys_path = False
         for snapshot_dir_str in snapshot_dir_strs:
+            # Resolve the snapshot modules from the module index, if possible,
+            # so that other imports do not probe the snapshot directory.
+            if self.use_module_index and (
+                finder := SnapshotModuleFinder.from_python_path(Path(snapshot_dir_str))
+            ):
+                sys.meta_path.insert(0, finder)
+                _active_finders[snapshot_dir_str] = finder
+                log.info(f"Added a module index finder for {snapshot_dir_str}.")
+                continue
+
             sys.path.insert(0, snapshot_dir_str)
+            modified_sys_path = True
+            log.info(f"Added {snapshot_dir_str} to sys.path.")
         self._set_snapshot_dirs(snapshot_dir_strs)
-        log.info(f"Added {', '.join(snapshot_dir_strs)} to sys.path.")
 
-        # Reset the import cache to ensure that the new modules are imported
-        if reset_import_cache:
+        # Reset the import cache to ensure that the new modules are imported.
+        # The module index finders do not use the cache.
+        if reset_import_cache and modified_sys_path:
             importlib.invalidate_caches()
 
     def _unload_snapshots(
@@ -87,6 +110,11 @@ class LoadExistingSnapshotContext(contextlib.AbstractContextManager):
 
         # Remove from sys path, or raise an error if it's not there
         for snapshot_dir_str in snapshot_dir_strs:
+            if (finder := _active_finders.pop(snapshot_dir_str, None)) is not None:
+                with contextlib.suppress(ValueError):
+                    sys.meta_path.remove(finder)
+                continue
+
             try:
                 sys.path.remove(snapshot_dir_str)
             except ValueError:
@@ -206,10 +234,13 @@ def _enter_snapshot(
     modules_list_snapshot: list[tuple[str, Path]],
     modules_list_original: list[tuple[str, Path]],
     on_existing_snapshot: OnExistingSnapshotType,
+    use_module_index: bool = False,
 ):
     if not modules_list_original:
         _validate_snapshot(snapshot_dir, modules_list_snapshot)
-        return LoadExistingSnapshotContext([snapshot_dir], on_existing_snapshot)
+        return LoadExistingSnapshotContext(
+            [snapshot_dir], on_existing_snapshot, use_module_index=use_module_index
+        )
 
     # Otherwise, we need to create a new temporary directory to store the original modules
     # and then add the snapshot directory to the Python path.
@@ -228,18 +259,37 @@ def _enter_snapshot(
         [snapshot_dir, original_dir],
         on_existing_snapshot,
         remove_paths=[original_dir],
+        use_module_index=use_module_index,
     )
 
 
+def _check_bytecode_cache_tag(snapshot_dir: Path):
+    """Warn if the snapshot bytecode was compiled for a different interpreter."""
+    try:
+        meta = json.loads((snapshot_dir / ".nshsnapmeta" / "meta.json").read_text())
+    except (OSError, ValueError):
+        return
+
+    cache_tag = meta.get("bytecode_cache_tag")
+    if cache_tag is not None and cache_tag != sys.implementation.cache_tag:
+        log.warning(
+            f"The bytecode in snapshot {snapshot_dir} was compiled for {cache_tag}, "
+            f"but the running interpreter is {sys.implementation.cache_tag}. "
+            "The precompiled bytecode will not be used."
+        )
+
+
 def load_existing_snapshot(
     snapshot_dir: Path,
     *,
     on_error: OnErrorType = "raise",
     on_existing_snapshot: OnExistingSnapshotType = "raise",
     preserve_original_modules: bool = False,
+    use_module_index: bool = False,
 ):
     """
-    Add the snapshot directory to PYTHONPATH.
+    Add the snapshot directory (or, for `format="zip"` snapshots, the snapshot
+    archive) to PYTHONPATH.
 
     If `preserve_original_modules` is True, we will store the original module
     as `{module_name}_original`, so the user can access the original module
@@ -248,21 +298,43 @@ def load_existing_snapshot(
     module uses absolute imports for its own submodules, as this will import
     the snapshot submodules instead.
 
+    If `use_module_index` is True and the snapshot has a module index, a
+    meta-path finder resolves the snapshot modules from the index instead of
+    adding the snapshot to `sys.path`. Other imports are then declined without
+    touching the (possibly slow, shared) snapshot filesystem.
+
+    The snapshot is leased for the rest of the lifetime of the process, so
+    that `nshsnap gc` does not remove it while it is in use.
+
     Warns on:
+    - Snapshots with bytecode that was precompiled for a different interpreter.
     - Modules within the snapshot directory that have already been imported
         (and thus any previously imported module will not be updated).
     """
 
     snapshot_dir = snapshot_dir.absolute()
+    hold_lease(snapshot_dir)
+    _check_bytecode_cache_tag(snapshot_dir)
+
+    # Snapshots created with `format="zip"` are imported from the archive
+    python_path = snapshot_python_path(snapshot_dir)
+    if python_path != snapshot_dir:
+        from ._archive import archive_module_names
+
+        module_dirs = [python_path / name for name in archive_module_names(python_path)]
+    else:
+        module_dirs = [
+            module_dir
+            for module_dir in snapshot_dir.iterdir()
+            # Skip the metadata and script directories (`.nshsnapmeta`, `.bin`)
+            if module_dir.is_dir() and not module_dir.name.startswith(".")
+        ]
 
     # Iterate through all the modules within the snapshot directory
     modules_list_snapshot: list[tuple[str, Path]] = []
     modules_list_original: list[tuple[str, Path]] = []
     errors: list[str] = []
-    for module_dir in snapshot_dir.iterdir():
-        if not module_dir.is_dir():
-            continue
-
+    for module_dir in module_dirs:
         module_dir = module_dir.absolute()
 
         # Check if the module exists in the filesystem
@@ -301,8 +373,9 @@ def load_existing_snapshot(
 
     # Enter the snapshot context
     return _enter_snapshot(
-        snapshot_dir,
+        python_path,
         modules_list_snapshot=modules_list_snapshot,
         modules_list_original=modules_list_original,
         on_existing_snapshot=on_existing_snapshot,
+        use_module_index=use_module_index,
     )
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import mmap
+import os
+import stat
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.tsv"
+
+_HEADER = b"# nshsnap manifest v1: path, size, mode, mtime_ns, blake2b\n"
+
+# Paths are escaped so that every entry is a single line of tab-separated fields
+_ESCAPES = {b"\\": b"\\\\", b"\t": b"\\t", b"\n": b"\\n"}
+_UNESCAPES = {b"\\": b"\\", b"t": b"\t", b"n": b"\n"}
+
+
+@dataclass(frozen=True, slots=True)
+class ManifestEntry:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    path: str
+    """The path of the file, relative to the snapshot directory."""
+
+    size: int
+    """The size of the file in bytes (for symlinks, the length of the target)."""
+
+    mode: int
+    """The `st_mode` of the file."""
+
+    mtime_ns: int
+    """The modification time of the file, in nanoseconds."""
+
+    digest: str
+    """The BLAKE2b digest of the contents of the file (for symlinks, of the target)."""
+
+
+def manifest_path(snapshot_dir: Path) -> Path:
+    return snapshot_dir / ".nshsnapmeta" / MANIFEST_NAME
+
+
+def _escape(path: str) -> bytes:
+    raw = os.fsencode(path)
+    for char, escaped in _ESCAPES.items():
+        raw = raw.replace(char, escaped)
+    return raw
+
+
+def _unescape(raw: bytes) -> str:
+    if b"\\" not in raw:
+        return os.fsdecode(raw)
+
+    out = bytearray()
+    i = 0
+    while i < len(raw):
+        if raw[i : i + 1] == b"\\":
+            out += _UNESCAPES[raw[i + 1 : i + 2]]
+            i += 2
+        else:
+            out += raw[i : i + 1]
+            i += 1
+    return os.fsdecode(bytes(out))
+
+
+def _format_line(path: bytes, st: os.stat_result, digest: str) -> bytes:
+    return b"%s\t%d\t%o\t%d\t%s\n" % (
+        path,
+        st.st_size,
+        st.st_mode,
+        st.st_mtime_ns,
+        digest.encode(),
+    )
+
+
+def _parse_line(line: bytes) -> ManifestEntry:
+    path, size, mode, mtime_ns, digest = line.rstrip(b"\n").split(b"\t")
+    return ManifestEntry(
+        path=_unescape(path),
+        size=int(size),
+        mode=int(mode, 8),
+        mtime_ns=int(mtime_ns),
+        digest=digest.decode(),
+    )
+
+
+def _digest(path: Path, st: os.stat_result) -> str:
+    """Hash the file with a single memory-mapped read, which releases the GIL."""
+    digest = hashlib.blake2b(digest_size=32)
+    if stat.S_ISLNK(st.st_mode):
+        digest.update(os.fsencode(os.readlink(path)))
+    elif st.st_size > 0:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+    return digest.hexdigest()
+
+
+def _hash_files(snapshot_dir: Path, paths: list[Path]) -> list[bytes]:
+    lines: list[bytes] = []
+    for path in paths:
+        st = path.lstat()
+        rel = _escape(path.relative_to(snapshot_dir).as_posix())
+        lines.append(_format_line(rel, st, _digest(path, st)))
+    return lines
+
+
+class ManifestBuilder:
+    """
+    Builds the manifest of a snapshot in the background.
+
+    Each module is handed to `add_tree` as soon as it has been copied, and
+    its files are hashed in a thread pool while the other modules are still
+    being copied.
+    """
+
+    def __init__(self, snapshot_dir: Path, workers: int | None = None):
+        self.snapshot_dir = snapshot_dir
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="nshsnap-manifest"
+        )
+        self._futures: list[Future[list[bytes]]] = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add_tree(self, root: Path):
+        """Queue every file under ``root`` (a directory in the snapshot) for hashing."""
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            # Symlinks to directories are recorded as symlinks, not walked
+            paths = [
+                Path(dirpath, name)
+                for name in (
+                    *filenames,
+                    *(d for d in dirnames if os.path.islink(os.path.join(dirpath, d))),
+                )
+            ]
+            if not paths:
+                continue
+            future = self._executor.submit(_hash_files, self.snapshot_dir, paths)
+            with self._lock:
+                self._futures.append(future)
+
+    def cancel(self):
+        """Stop hashing, once the files that are being hashed are done."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def write(self) -> Path:
+        """Wait for all files to be hashed, and write the sorted manifest."""
+        try:
+            lines = [line for future in self._futures for line in future.result()]
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        # Escaped paths contain no tabs, so this sorts the entries by path
+        lines.sort()
+
+        path = manifest_path(self.snapshot_dir)
+        tmp = path.with_name(f"{path.name}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(_HEADER)
+            f.writelines(lines)
+        os.replace(tmp, path)
+
+        log.info(
+            f"Wrote the manifest of {len(lines)} files to {path} "
+            f"({time.perf_counter() - self._start:.2f}s after the copy started)"
+        )
+        return path
+
+
+def read_manifest(snapshot_dir: Path) -> Iterator[ManifestEntry]:
+    """Stream the entries of the snapshot manifest, sorted by path."""
+    with open(manifest_path(snapshot_dir), "rb") as f:
+        for line in f:
+            if line == _HEADER:
+                continue
+            yield _parse_line(line)
+
+
+def lookup_manifest(snapshot_dir: Path, path: str) -> ManifestEntry | None:
+    """
+    Find the manifest entry of ``path`` (relative to the snapshot directory)
+    with a binary search over the memory-mapped manifest, without reading
+    the whole manifest.
+    """
+    key = _escape(path) + b"\t"
+    with open(manifest_path(snapshot_dir), "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        # `lo` and `hi` are always at the start of a line
+        lo = len(_HEADER) if mm[: len(_HEADER)] == _HEADER else 0
+        hi = len(mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b"\n", lo, mid) + 1 or lo
+            end = mm.find(b"\n", start) + 1 or len(mm)
+            line = mm[start:end]
+            if line.startswith(key):
+                return _parse_line(line)
+            elif line < key:
+                lo = end
+            else:
+                hi = start
+    return None
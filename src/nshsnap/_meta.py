@@ -1,6 +1,9 @@
 from __future__ import annotations
 
 import datetime
+import sys
+from pathlib import Path
+from typing import Any
 
 import nshconfig as C
 
@@ -16,13 +19,25 @@ class SnapshotMetadata(C.Config):
     """The timestamp of the snapshot."""
 
     pip_dependencies: PipDependencies | None
-    """The parsed dependencies from the output of `pip list --format=json`."""
+    """The installed packages, equivalent to the output of `pip list --format=json`."""
+
+    bytecode_cache_tag: str | None = None
+    """The interpreter cache tag (`sys.implementation.cache_tag`) that the
+    bytecode in the snapshot was compiled for, if `config.compile_bytecode` is set."""
+
+    base_snapshot: Path | None = None
+    """The snapshot that this snapshot was incrementally derived from, if any."""
+
+    timings: dict[str, Any] | None = None
+    """The duration of each phase of the snapshot (see `SnapshotTimings`), which
+    is added once the snapshot is created."""
 
     @classmethod
     def create(
         cls,
         config: SnapshotConfig,
         pip_dependencies: PipDependencies | None = None,
+        base_snapshot: Path | None = None,
     ):
         if pip_dependencies is None:
             pip_dependencies = current_pip_dependencies()
@@ -30,4 +45,8 @@ class SnapshotMetadata(C.Config):
             config=config,
             timestamp=datetime.datetime.now(),
             pip_dependencies=pip_dependencies,
+            bytecode_cache_tag=sys.implementation.cache_tag
+            if config.compile_bytecode
+            else None,
+            base_snapshot=base_snapshot,
         )
@@ -1,13 +1,32 @@
 from __future__ import annotations
 
+import hashlib
 import importlib.metadata
 import importlib.util
-import subprocess
+import json
+import logging
+import os
+import re
+import site
+import sys
 from collections.abc import Mapping
-from typing import Annotated, Any, Literal, TypeAlias
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Annotated, Any, ClassVar, Literal, TypeAlias
+from urllib.parse import unquote, urlparse
 
 import nshconfig as C
 
+from ._util import cache_dir
+
+log = logging.getLogger(__name__)
+
+# Packages that `pip freeze` leaves out of its output by default
+_FREEZE_EXCLUDED = {"pip", "setuptools", "wheel", "distribute"}
+
+# Entries of a `sys.path` directory that describe installed packages
+_METADATA_SUFFIXES = (".dist-info", ".egg-info", ".egg-link", ".pth")
+
 
 class BasePackageDependency(C.Config):
     name: str
@@ -67,12 +86,222 @@ PackageDependency: TypeAlias = Annotated[
 PipDependencies: TypeAlias = list[PackageDependency]
 
 
-def current_pip_dependencies():
-    return C.TypeAdapter(PipDependencies).validate_json(
-        subprocess.run(
-            ["pip", "list", "--format=json"],
-            check=True,
-            stdout=subprocess.PIPE,
-            text=True,
-        ).stdout
+@dataclass(frozen=True, slots=True)
+class EnvironmentInfo:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    dependencies: PipDependencies
+    """The installed packages, equivalent to `pip list --format=json`."""
+
+    requirements: str
+    """The contents of a requirements.txt file, equivalent to `pip freeze`."""
+
+    editable_modules: dict[str, str | None]
+    """The importable module name of each editable package (None if not found)."""
+
+
+def _canonical_name(name: str) -> str:
+    # PEP 503 normalization
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _url_to_path(url: str) -> str:
+    return unquote(urlparse(url).path)
+
+
+def _egg_links() -> dict[str, str]:
+    """Map legacy (``setup.py develop``) editable installs to their locations."""
+    site_dirs = [*site.getsitepackages(), site.getusersitepackages()]
+    links: dict[str, str] = {}
+    for site_dir in site_dirs:
+        for egg_link in Path(site_dir).glob("*.egg-link"):
+            try:
+                location = egg_link.read_text().splitlines()[0].strip()
+            except (OSError, IndexError):
+                continue
+            links.setdefault(_canonical_name(egg_link.stem), location)
+    return links
+
+
+def _direct_url(dist: importlib.metadata.Distribution) -> dict[str, Any] | None:
+    """Read the PEP 610 ``direct_url.json`` of the distribution, if any."""
+    if not (text := dist.read_text("direct_url.json")):
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        log.debug(f"Invalid direct_url.json for {dist.metadata['Name']}")
+        return None
+
+
+def _direct_url_requirement(name: str, direct_url: dict[str, Any]) -> str:
+    url = direct_url["url"]
+    if vcs_info := direct_url.get("vcs_info"):
+        return f"{name} @ {vcs_info['vcs']}+{url}@{vcs_info['commit_id']}"
+    return f"{name} @ {url}"
+
+
+def _scan_environment() -> EnvironmentInfo:
+    """
+    Introspect the installed packages in-process with `importlib.metadata`,
+    instead of running `pip list` and `pip freeze` in subprocesses.
+    """
+    egg_links = _egg_links()
+
+    dependencies: list[RegularPackageDependency | EditablePackageDependency] = []
+    requirements: list[str] = []
+    seen = set[str]()
+    for dist in importlib.metadata.distributions():
+        if not (name := dist.metadata["Name"]):
+            continue
+
+        # Like the import system, the first distribution on `sys.path` wins.
+        if (canonical_name := _canonical_name(name)) in seen:
+            continue
+        seen.add(canonical_name)
+
+        direct_url = _direct_url(dist)
+        if direct_url is not None and direct_url.get("dir_info", {}).get("editable"):
+            editable_location = _url_to_path(direct_url["url"])
+        else:
+            editable_location = egg_links.get(canonical_name)
+
+        if editable_location is not None:
+            dependencies.append(
+                EditablePackageDependency(
+                    name=name,
+                    version=dist.version,
+                    editable_project_location=editable_location,
+                )
+            )
+            requirement = f"-e {editable_location}"
+        else:
+            dependencies.append(
+                RegularPackageDependency(name=name, version=dist.version)
+            )
+            if direct_url is not None:
+                requirement = _direct_url_requirement(name, direct_url)
+            else:
+                requirement = f"{name}=={dist.version}"
+
+        if canonical_name not in _FREEZE_EXCLUDED:
+            requirements.append(requirement)
+
+    dependencies.sort(key=lambda dep: dep.name.lower())
+    requirements.sort(key=lambda req: req.lower())
+    return EnvironmentInfo(
+        dependencies=dependencies,
+        requirements="".join(f"{requirement}\n" for requirement in requirements),
+        editable_modules={
+            dep.name: dep.importable_module_name()
+            for dep in dependencies
+            if isinstance(dep, EditablePackageDependency)
+        },
     )
+
+
+_memoized_environment: tuple[str, EnvironmentInfo] | None = None
+
+
+def _environment_fingerprint() -> str:
+    """
+    Fingerprint the installed packages from the interpreter and the mtimes and
+    package metadata listings of the `sys.path` directories. Installing or
+    removing a package changes at least one of these.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{sys.executable}\0{sys.version}\0".encode())
+    for entry in sys.path:
+        path = Path(entry or os.getcwd())
+        try:
+            st = path.stat()
+            if not path.is_dir():
+                digest.update(f"{path}\0{st.st_mtime_ns}\0".encode())
+                continue
+            names = sorted(
+                name for name in os.listdir(path) if name.endswith(_METADATA_SUFFIXES)
+            )
+        except OSError:
+            continue
+        digest.update(f"{path}\0{st.st_mtime_ns}\0".encode())
+        digest.update("\0".join(names).encode())
+    return digest.hexdigest()
+
+
+def _environment_cache_path() -> Path:
+    key = hashlib.sha256(f"{sys.executable}\0{sys.prefix}".encode()).hexdigest()
+    return cache_dir("environments") / f"{key[:32]}.json"
+
+
+def _load_cached_environment(path: Path, fingerprint: str) -> EnvironmentInfo | None:
+    try:
+        data = json.loads(path.read_text())
+        if data.get("fingerprint") != fingerprint:
+            return None
+        return EnvironmentInfo(
+            dependencies=C.TypeAdapter(PipDependencies).validate_python(
+                data["dependencies"]
+            ),
+            requirements=data["requirements"],
+            editable_modules=data["editable_modules"],
+        )
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.debug(f"Ignoring invalid environment cache {path}: {e}")
+        return None
+
+
+def _save_cached_environment(
+    path: Path,
+    fingerprint: str,
+    environment: EnvironmentInfo,
+):
+    data = {
+        "fingerprint": fingerprint,
+        "dependencies": C.TypeAdapter(PipDependencies).dump_python(
+            environment.dependencies, mode="json"
+        ),
+        "requirements": environment.requirements,
+        "editable_modules": environment.editable_modules,
+    }
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, path)
+    except OSError as e:
+        log.debug(f"Failed to save the environment cache {path}: {e}")
+        tmp.unlink(missing_ok=True)
+
+
+def current_environment(*, use_cache: bool = True) -> EnvironmentInfo:
+    """
+    Return the installed packages of the current environment.
+
+    The result is cached on disk (and in memory), keyed by the interpreter and
+    a fingerprint of the `sys.path` directories, so the environment is only
+    scanned again after packages are installed or removed.
+    """
+    if not use_cache:
+        return _scan_environment()
+
+    global _memoized_environment
+
+    fingerprint = _environment_fingerprint()
+    if _memoized_environment is not None and _memoized_environment[0] == fingerprint:
+        return _memoized_environment[1]
+
+    path = _environment_cache_path()
+    if (environment := _load_cached_environment(path, fingerprint)) is None:
+        environment = _scan_environment()
+        _save_cached_environment(path, fingerprint, environment)
+    else:
+        log.debug(f"Loaded the environment from the cache {path}")
+
+    # Long-lived processes (e.g., `nshsnap serve`) skip the cache file as well
+    _memoized_environment = (fingerprint, environment)
+    return environment
+
+
+def current_pip_dependencies() -> PipDependencies:
+    return current_environment().dependencies
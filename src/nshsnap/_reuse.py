@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+from pathlib import Path
+
+from . import _trace
+from ._config import SnapshotConfig
+from ._statcache import tree_digest
+from ._util import cache_dir, is_git_repository
+
+log = logging.getLogger(__name__)
+
+_KEY_VERSION = 2
+
+
+def _git(location: Path, *args: str) -> bytes:
+    _trace.add_subprocess(["git"])
+    return subprocess.run(
+        ["git", "-C", str(location), *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ).stdout
+
+
+def _untracked_state(location: Path) -> str:
+    """Hash the (path, size, mtime) of every untracked, non-ignored file."""
+    digest = hashlib.sha256()
+    output = _git(location, "ls-files", "-z", "--others", "--exclude-standard")
+    for raw in sorted(output.split(b"\0")):
+        if not raw:
+            continue
+        try:
+            st = (location / os.fsdecode(raw)).lstat()
+        except FileNotFoundError:
+            continue
+        digest.update(raw + b"\0%d\0%d\0" % (st.st_size, st.st_mtime_ns))
+    return digest.hexdigest()
+
+
+def _module_state(location: Path, git_reference: str | None) -> dict[str, str] | None:
+    """
+    Describe the code state of the module at ``location``, or return None if
+    it cannot be determined.
+    """
+    if not is_git_repository(location):
+        if git_reference is not None:
+            return None
+        # Without git, the state is the contents of the files, which are only
+        # read again if their stat information changed.
+        return {"location": str(location), "tree": tree_digest(location)}
+
+    try:
+        if git_reference is not None:
+            # Git references are extracted from the object store, so the state
+            # of the working tree does not matter.
+            return {
+                "location": str(location),
+                "git_reference": git_reference,
+                "git_reference_commit": _git(
+                    location, "rev-parse", "--verify", f"{git_reference}^{{commit}}"
+                )
+                .decode()
+                .strip(),
+            }
+
+        state = {
+            "location": str(location),
+            "head": _git(location, "rev-parse", "HEAD").decode().strip(),
+            # `git diff HEAD` covers both staged and unstaged changes
+            "diff": hashlib.sha256(
+                _git(location, "diff", "HEAD", "--binary", "--", ".")
+            ).hexdigest(),
+            "untracked": _untracked_state(location),
+        }
+    except subprocess.CalledProcessError as e:
+        log.debug(f"Failed to determine the git state of {location}: {e}")
+        return None
+
+    return state
+
+
+def snapshot_key(
+    config: SnapshotConfig,
+    module_locations: dict[str, Path | None],
+) -> str | None:
+    """
+    Compute a deterministic key for a snapshot of the given modules in their
+    current code state, or return None if the state of any module cannot be
+    determined.
+    """
+    modules: dict[str, dict[str, str] | None] = {}
+    for module, location in module_locations.items():
+        if location is None:
+            modules[module] = None
+            continue
+
+        state = _module_state(location, config.git_references.get(module))
+        if state is None:
+            log.info(
+                f"Cannot determine the code state of module {module} at {location}. "
+                "Snapshot reuse is disabled for this snapshot."
+            )
+            return None
+        modules[module] = state
+
+    payload = {
+        "version": _KEY_VERSION,
+        "config": config.model_dump(mode="json"),
+        "modules": modules,
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _entry_path(key: str) -> Path:
+    return cache_dir("reuse") / key
+
+
+def lock_path(key: str) -> Path:
+    """The lock file that coordinates concurrent creators of the same snapshot."""
+    return cache_dir("reuse") / f"{key}.lock"
+
+
+def lookup(key: str) -> Path | None:
+    """Return the published snapshot directory for ``key``, if it still exists."""
+    entry = _entry_path(key)
+    if not entry.is_symlink():
+        return None
+
+    snapshot_dir = Path(os.readlink(entry))
+    if not (snapshot_dir / ".nshsnapmeta" / "modules.json").is_file():
+        log.info(f"Reusable snapshot {snapshot_dir} no longer exists. Discarding it.")
+        entry.unlink(missing_ok=True)
+        return None
+
+    return snapshot_dir
+
+
+def publish(key: str, snapshot_dir: Path):
+    """Atomically publish ``snapshot_dir`` as the snapshot for ``key``."""
+    entry = _entry_path(key)
+    tmp = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+    tmp.unlink(missing_ok=True)
+    tmp.symlink_to(snapshot_dir.absolute())
+    os.replace(tmp, entry)
@@ -1,24 +1,54 @@
 from __future__ import annotations
 
+import dataclasses
+import functools
 import importlib.util
+import json
 import logging
+import os
+import shutil
 import subprocess
-from collections.abc import Iterable
+import threading
+import time
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import TYPE_CHECKING, ClassVar, Literal
+from typing import TYPE_CHECKING, Any, ClassVar, Literal
 
 from typing_extensions import assert_never
 
+from . import _reuse, _trace
+from ._bytecode import compile_bytecode
 from ._config import SnapshotConfig
+from ._copy import (
+    CopyStats,
+    CopyStrategy,
+    _copy_rsync,
+    copy_tree,
+    copy_tree_incremental,
+)
+from ._incremental import changed_files, resolve_base_snapshot
+from ._index import write_module_index
+from ._lease import hold_lease
+from ._manifest import ManifestBuilder
 from ._meta import SnapshotMetadata
+from ._pip_deps import EnvironmentInfo, current_environment
+from ._store import SnapshotStore, StoreStats
 from ._util import (
-    checkout_git_reference,
+    SNAPSHOT_ARCHIVE_NAME,
+    Step,
     create_snapshot_scripts,
+    extract_git_reference_steps,
+    file_lock,
+    get_current_git_reference_steps,
+    get_git_commit_steps,
     gitignored_dir,
-    is_git_repository,
-    restore_git_reference,
+    is_git_repository_steps,
+    run_steps,
+    snapshot_python_path,
 )
+from ._watch import freeze_staged, is_watched
 
 if TYPE_CHECKING:
     from . import configs
@@ -26,49 +56,6 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 
 
-def _copy(source: Path, location: Path):
-    """
-    Copy files from the source directory to the specified location, excluding ignored files.
-
-    Args:
-        source (Path): The path to the source directory.
-        location (Path): The path to the destination directory.
-
-    Raises:
-        CalledProcessError: If the rsync command fails.
-
-    """
-    ignored_files = (
-        subprocess.check_output(
-            [
-                "git",
-                "-C",
-                str(source),
-                "ls-files",
-                "--exclude-standard",
-                "-oi",
-                "--directory",
-            ]
-        )
-        .decode("utf-8")
-        .splitlines()
-    )
-
-    # run rsync with .git folder and `ignored_files` excluded
-    _ = subprocess.run(
-        [
-            "rsync",
-            "-a",
-            "--exclude",
-            ".git",
-            *(f"--exclude={file}" for file in ignored_files),
-            str(source),
-            str(location),
-        ],
-        check=True,
-    )
-
-
 @dataclass(frozen=True, slots=True)
 class SnapshotModuleInfo:
     __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
@@ -94,6 +81,23 @@ class SnapshotModuleInfo:
     git_reference_used: str | None = None
     """The git reference that was actually used for snapshotting."""
 
+    git_commit: str | None = None
+    """The commit that the module was snapshot from: HEAD of its repository, or
+    the commit of the git reference that was used."""
+
+    def to_json_dict(self):
+        return {
+            field.name: str(value) if isinstance(value, Path) else value
+            for field in dataclasses.fields(self)
+            if (value := getattr(self, field.name)) is not None
+        }
+
+    @classmethod
+    def from_json_dict(cls, data: dict):
+        for key in ("location", "destination"):
+            data[key] = Path(data[key]) if data.get(key) is not None else None
+        return cls(**data)
+
 
 @dataclass(frozen=True, slots=True)
 class ActiveSnapshot:
@@ -108,6 +112,22 @@ class ActiveSnapshot:
     module_infos: list[SnapshotModuleInfo]
     """Information about the modules included in the snapshot."""
 
+    store_stats: StoreStats | None = None
+    """Bytes written to versus linked from the blob store, if `config.store` is set."""
+
+    copy_stats: CopyStats | None = None
+    """Files and bytes copied and the copy throughput, for the in-process copy engines."""
+
+    reused: bool = False
+    """Whether an existing snapshot of the same code state was reused."""
+
+    base_snapshot: Path | None = None
+    """The snapshot that this snapshot was incrementally derived from, if any."""
+
+    timings: _trace.SnapshotTimings | None = None
+    """The duration of each phase of the snapshot, the subprocesses it started,
+    and the files and bytes it copied."""
+
     @property
     def modules(self) -> list[str]:
         """The list of modules included in the snapshot."""
@@ -115,6 +135,11 @@ class ActiveSnapshot:
             module.name for module in self.module_infos if module.status == "success"
         ]
 
+    @property
+    def python_path(self) -> Path:
+        """The entry to put on `sys.path` (or `PYTHONPATH`) to import from the snapshot."""
+        return snapshot_python_path(self.snapshot_dir)
+
 
 def _normalize_module_locations(
     module: str,
@@ -155,20 +180,323 @@ def _normalize_module_locations(
     return locations
 
 
+def _module_location(module: str) -> Path | None:
+    """
+    Find the directory of the given module.
+
+    Returns:
+        The directory of the module, or None if the module was not found.
+
+    Raises:
+        ValueError: If the module has no importable directory locations.
+    """
+    if (spec := importlib.util.find_spec(module)) is None:
+        return None
+
+    raw_search_locations = spec.submodule_search_locations or []
+    locations = _normalize_module_locations(module, raw_search_locations)
+    if not locations:
+        raise ValueError(
+            f"Module {module!r} has no importable directory locations "
+            f"({raw_search_locations})"
+        )
+
+    if len(locations) > 1:
+        log.warning(
+            "Module %s is a namespace package with multiple locations: %s. "
+            "Using the first location %s.",
+            module,
+            locations,
+            locations[0],
+        )
+    return locations[0]
+
+
+def _changed_since_base(
+    location: Path,
+    git_commit: str | None,
+    base_commit: str | None,
+) -> set[Path] | None:
+    """
+    List the files of ``location`` that may have changed since its copy in the
+    base snapshot, or return None if the base cannot be used.
+    """
+    if git_commit is None and base_commit is None:
+        # Not a git repository: the files are compared with the base copy by
+        # their stat information only.
+        return set()
+    if git_commit is None or base_commit is None:
+        return None
+    return changed_files(location, base_commit)
+
+
+def _create_parent_packages(
+    snapshot_dir: Path, module: str, parents_lock: threading.Lock
+) -> Path:
+    """Create the parent packages of ``module``, and return the innermost one."""
+    # Parent packages may be shared between modules (e.g., `a.b` and `a.c`)
+    destination = snapshot_dir
+    with parents_lock:
+        for part in module.split(".")[:-1]:
+            destination = destination / part
+            destination.mkdir(parents=True, exist_ok=True)
+            (destination / "__init__.py").touch(exist_ok=True)
+    return destination
+
+
+def _snapshot_module_steps(
+    snapshot_dir: Path,
+    module: str,
+    location: Path,
+    git_ref_requested: str | None,
+    parents_lock: threading.Lock,
+    store: SnapshotStore | None,
+    copy_strategy: CopyStrategy,
+    copy_workers: int | None,
+    base: tuple[Path, str | None] | None = None,
+    staged: bool = False,
+) -> Generator[
+    Step, Any, tuple[SnapshotModuleInfo, StoreStats | None, CopyStats | None]
+]:
+    """
+    Snapshot a single module that was found at ``location``, as a step
+    generator (see `run_steps`) that `snapshot` and `asnapshot` both run.
+
+    ``base`` is the copy of the module in a previous snapshot and the commit
+    it was taken from. If given, only the files that changed since then are
+    copied.
+    """
+    if git_ref_requested and not (yield from is_git_repository_steps(location)):
+        msg = (
+            f"Module {module} at {location} is not a git repository, "
+            f"but git reference '{git_ref_requested}' was specified. "
+            "Only git repositories support git references."
+        )
+        log.error(msg)
+        info = SnapshotModuleInfo(
+            name=module,
+            status="git_reference_failed",
+            location=location,
+            destination=None,
+            git_reference_requested=git_ref_requested,
+        )
+        return info, None, None
+
+    module_name = module.split(".")[-1]
+    destination = _create_parent_packages(snapshot_dir, module, parents_lock)
+
+    git_ref_original = None
+    git_ref_used = None
+    git_commit = None
+    store_stats = None
+    copy_stats = None
+
+    if git_ref_requested:
+        try:
+            with _trace.phase("git.extract", module=module, ref=git_ref_requested):
+                git_ref_original = yield from get_current_git_reference_steps(location)
+                git_commit = yield from extract_git_reference_steps(
+                    location, git_ref_requested, destination / module_name
+                )
+            git_ref_used = git_ref_requested
+            log.info(
+                f"Extracted {module} at '{git_ref_requested}' "
+                f"(working tree is at '{git_ref_original}')"
+            )
+        except subprocess.CalledProcessError as e:
+            msg = f"Failed to extract git reference '{git_ref_requested}' for module {module}: {e}"
+            log.error(msg)
+            shutil.rmtree(destination / module_name, ignore_errors=True)
+            info = SnapshotModuleInfo(
+                name=module,
+                status="git_reference_failed",
+                location=location,
+                destination=None,
+                git_reference_requested=git_ref_requested,
+                git_reference_original=git_ref_original,
+            )
+            return info, None, None
+    else:
+        # Resolved before copying, so that it never includes later commits
+        with _trace.phase("git.commit", module=module):
+            git_commit = yield from get_git_commit_steps(location)
+
+        # Watched modules are frozen from their staged copy (`nshsnap watch`)
+        frozen = staged and store is None and is_watched(module, location)
+        changed = None
+        if store is None and base is not None and not frozen:
+            with _trace.phase("git.changed_files", module=module):
+                changed = yield (_changed_since_base, (location, git_commit, base[1]))
+
+        with _trace.phase("copy", module=module, strategy=copy_strategy) as args:
+            if frozen and (
+                copy_stats := (
+                    yield (
+                        freeze_staged,
+                        (module, location, destination / location.name),
+                    )
+                )
+            ):
+                args["strategy"] = "staged"
+            elif changed is not None:
+                assert base is not None
+                copy_stats = yield (
+                    copy_tree_incremental,
+                    (
+                        location,
+                        destination,
+                        base[0],
+                        changed,
+                        copy_strategy,
+                        copy_workers,
+                    ),
+                )
+            elif store is not None:
+                args["strategy"] = "store"
+                store_stats = yield (store.materialize, (location, destination))
+                args["files"] = store_stats.files_written + store_stats.files_linked
+                args["bytes"] = store_stats.bytes_written + store_stats.bytes_linked
+            elif copy_strategy == "rsync":
+                # A separate step, so that `asnapshot` runs it as a subprocess
+                yield (_copy_rsync, (location, destination))
+            else:
+                copy_stats = yield (
+                    copy_tree,
+                    (location, destination, copy_strategy, copy_workers),
+                )
+            if copy_stats is not None:
+                args["files"] = copy_stats.files
+                args["bytes"] = copy_stats.bytes
+            _trace.add_copied(args.get("files", 0), args.get("bytes", 0))
+
+    destination = destination / module_name
+    log.info(f"Moved {location} to {destination} for {module=}")
+    info = SnapshotModuleInfo(
+        name=module,
+        status="success",
+        location=location,
+        destination=destination,
+        git_reference_requested=git_ref_requested,
+        git_reference_original=git_ref_original,
+        git_reference_used=git_ref_used,
+        git_commit=git_commit,
+    )
+    return info, store_stats, copy_stats
+
+
+def _snapshot_module(
+    *args: Any,
+    **kwargs: Any,
+) -> tuple[SnapshotModuleInfo, StoreStats | None, CopyStats | None]:
+    """Run `_snapshot_module_steps` synchronously."""
+    return run_steps(_snapshot_module_steps(*args, **kwargs))
+
+
+def _find_modules(
+    modules: list[str],
+    on_module_not_found: Literal["raise", "warn"],
+    git_references: dict[str, str],
+) -> tuple[list[SnapshotModuleInfo | None], list[tuple[int, str, Path]]]:
+    """
+    Resolve the locations of ``modules``. Returns the infos of the modules
+    that were not found (with None placeholders for the others, in order)
+    and the index, name and location of each module that was found.
+    """
+    # Resolve all modules before copying anything, so that a missing module
+    # fails the snapshot the same way as when modules are snapshot one by one.
+    module_infos: list[SnapshotModuleInfo | None] = []
+    found: list[tuple[int, str, Path]] = []
+    for module in modules:
+        if (location := _module_location(module)) is None:
+            msg = f"Module {module} not found"
+            if on_module_not_found == "raise":
+                raise ValueError(msg)
+            elif on_module_not_found == "warn":
+                log.warning(msg)
+                module_infos.append(
+                    SnapshotModuleInfo(
+                        name=module,
+                        status="not_found",
+                        location=None,
+                        destination=None,
+                        git_reference_requested=git_references.get(module),
+                    )
+                )
+                continue
+            else:
+                assert_never(on_module_not_found)
+
+        found.append((len(module_infos), module, location))
+        module_infos.append(None)
+
+    return module_infos, found
+
+
+def _base_module_resolver(
+    base_snapshot: Path | None,
+) -> Callable[[str, Path], tuple[Path, str | None] | None]:
+    """
+    Return a function that finds the copy of a module in ``base_snapshot``,
+    and the commit it was taken from, if the module can be derived from it.
+    """
+    base_infos = (
+        {info.name: info for info in _load_module_infos(base_snapshot)}
+        if base_snapshot is not None
+        else {}
+    )
+
+    def base_module(module: str, location: Path) -> tuple[Path, str | None] | None:
+        if base_snapshot is None or (info := base_infos.get(module)) is None:
+            return None
+        base_dir = base_snapshot.joinpath(*module.split("."))
+        if (
+            info.status != "success"
+            or info.location != location
+            or info.git_reference_used is not None
+            or not base_dir.is_dir()
+        ):
+            log.info(f"Cannot derive {module} from {base_snapshot}. Copying it fully.")
+            return None
+        return base_dir, info.git_commit
+
+    return base_module
+
+
 def _snapshot_modules(
     snapshot_dir: Path,
     modules: list[str],
     on_module_not_found: Literal["raise", "warn"],
     git_references: dict[str, str] | None = None,
+    store: SnapshotStore | None = None,
+    copy_strategy: CopyStrategy = "auto",
+    copy_workers: int | None = None,
+    module_workers: int | None = None,
+    manifest: ManifestBuilder | None = None,
+    base_snapshot: Path | None = None,
+    staged: bool = False,
 ):
     """
     Snapshot the specified modules to the given directory.
 
+    Modules are snapshot concurrently. Modules with a git reference are
+    extracted directly from the git object store, without touching the
+    working tree of the repository.
+
     Args:
         snapshot_dir (Path): The directory where the modules will be snapshot.
         modules (Sequence[str]): A sequence of module names to be snapshot.
         on_module_not_found: What to do when a module is not found.
         git_references: Optional mapping of module names to git references.
+        store: Optional blob store to materialize the modules from, instead of copying.
+        copy_strategy: How to copy the modules, if no store is given.
+        copy_workers: The number of threads used by the in-process copy engines.
+        module_workers: The number of modules to snapshot concurrently.
+        manifest: Optional manifest builder, which starts hashing the files of
+            each module as soon as it has been copied.
+        base_snapshot: Optional previous snapshot to derive this snapshot from.
+            Only the files of each module that changed since the base are copied.
+        staged: Freeze the staged copies of the modules that are watched by
+            `nshsnap watch`, instead of copying them.
 
     Returns:
         Path: The path to the snapshot directory.
@@ -182,161 +510,110 @@ def _snapshot_modules(
 
     log.critical(f"Snapshotting {modules=} to {snapshot_dir}")
 
-    module_infos: list[SnapshotModuleInfo] = []
-    git_restore_info: dict[Path, str] = {}  # path -> original_reference
-
-    try:
-        for module in modules:
-            git_ref_requested = git_references.get(module)
-
-            if (spec := importlib.util.find_spec(module)) is None:
-                msg = f"Module {module} not found"
-                if on_module_not_found == "raise":
-                    raise ValueError(msg)
-                elif on_module_not_found == "warn":
-                    log.warning(msg)
-                    module_infos.append(
-                        SnapshotModuleInfo(
-                            name=module,
-                            status="not_found",
-                            location=None,
-                            destination=None,
-                            git_reference_requested=git_ref_requested,
-                        )
-                    )
-                    continue
-                else:
-                    assert_never(on_module_not_found)
-
-            raw_search_locations = spec.submodule_search_locations or []
-            locations = _normalize_module_locations(module, raw_search_locations)
-            if not locations:
-                raise ValueError(
-                    f"Module {module!r} has no importable directory locations "
-                    f"({raw_search_locations})"
-                )
-
-            if len(locations) > 1:
-                log.warning(
-                    "Module %s is a namespace package with multiple locations: %s. "
-                    "Using the first location %s.",
-                    module,
-                    locations,
-                    locations[0],
-                )
-            location = locations[0]
-            # Normalize the location to ensure unique keys in git_restore_info
-            normalized_location = location.resolve()
-
-            git_ref_original = None
-            git_ref_used = None
-
-            # Handle git reference if specified
-            if git_ref_requested:
-                if not is_git_repository(location):
-                    msg = (
-                        f"Module {module} at {location} is not a git repository, "
-                        f"but git reference '{git_ref_requested}' was specified. "
-                        "Only git repositories support git references."
-                    )
-                    log.error(msg)
-                    module_infos.append(
-                        SnapshotModuleInfo(
-                            name=module,
-                            status="git_reference_failed",
-                            location=location,
-                            destination=None,
-                            git_reference_requested=git_ref_requested,
-                        )
-                    )
-                    continue
-
-                try:
-                    # Get current reference and checkout the requested one
-                    git_ref_original = checkout_git_reference(
-                        location, git_ref_requested
-                    )
-                    # Only store the original reference if we haven't seen this location before
-                    if normalized_location not in git_restore_info:
-                        git_restore_info[normalized_location] = git_ref_original
-                    git_ref_used = git_ref_requested
-                    log.info(
-                        f"Switched {module} from '{git_ref_original}' to '{git_ref_requested}'"
-                    )
-                except subprocess.CalledProcessError as e:
-                    msg = f"Failed to checkout git reference '{git_ref_requested}' for module {module}: {e}"
-                    log.error(msg)
-                    module_infos.append(
-                        SnapshotModuleInfo(
-                            name=module,
-                            status="git_reference_failed",
-                            location=location,
-                            destination=None,
-                            git_reference_requested=git_ref_requested,
-                            git_reference_original=git_ref_original,
-                        )
-                    )
-                    continue
-
-            (*parent_modules, module_name) = module.split(".")
-
-            destination = snapshot_dir
-            for part in parent_modules:
-                destination = destination / part
-                destination.mkdir(parents=True, exist_ok=True)
-                (destination / "__init__.py").touch(exist_ok=True)
-
-            _copy(location, destination)
-
-            destination = destination / module_name
-            log.info(f"Moved {location} to {destination} for {module=}")
-            module_infos.append(
-                SnapshotModuleInfo(
-                    name=module,
-                    status="success",
-                    location=location,
-                    destination=destination,
-                    git_reference_requested=git_ref_requested,
-                    git_reference_original=git_ref_original,
-                    git_reference_used=git_ref_used,
-                )
+    module_infos, found = _find_modules(modules, on_module_not_found, git_references)
+
+    store_stats = StoreStats() if store is not None else None
+    copy_stats: CopyStats | None = None
+    parents_lock = threading.Lock()
+
+    base_module = _base_module_resolver(base_snapshot)
+
+    if module_workers is None:
+        module_workers = min(8, len(found)) or 1
+    start = time.perf_counter()
+
+    def snapshot_module(item: tuple[int, str, Path]):
+        _, module, location = item
+        with _trace.phase("module", module=module):
+            result = _snapshot_module(
+                snapshot_dir,
+                module,
+                location,
+                git_references.get(module),
+                parents_lock,
+                store,
+                copy_strategy,
+                copy_workers,
+                base_module(module, location),
+                staged,
             )
-    finally:
-        # Restore all git repositories to their original references
-        for location, original_ref in git_restore_info.items():
-            restore_git_reference(location, original_ref)
-
-    return snapshot_dir.absolute(), module_infos
+        if manifest is not None and (destination := result[0].destination):
+            manifest.add_tree(destination)
+        return result
+
+    with ThreadPoolExecutor(max_workers=module_workers) as executor:
+        # Propagated, so that the modules are traced from the pool's threads
+        results = executor.map(_trace.propagate(snapshot_module), found)
+        # `map` yields in submission order, so the output is deterministic.
+        for (index, _, _), (info, module_store_stats, module_copy_stats) in zip(
+            found, results
+        ):
+            module_infos[index] = info
+            if store_stats is not None and module_store_stats is not None:
+                store_stats.update(module_store_stats)
+            if module_copy_stats is not None:
+                copy_stats = copy_stats or CopyStats()
+                copy_stats.update(module_copy_stats)
+
+    if copy_stats is not None:
+        # Modules are copied concurrently, so report the wall-clock time.
+        copy_stats.seconds = time.perf_counter() - start
+
+    return (
+        snapshot_dir.absolute(),
+        [info for info in module_infos if info is not None],
+        store_stats,
+        copy_stats,
+    )
 
 
-def _ensure_supported():
-    # Make sure we have git and rsync installed
+@functools.cache
+def _rsync_installed() -> bool:
+    # Cached, so that long-lived processes (e.g., `nshsnap serve`) check once
+    _trace.add_subprocess(["rsync"])
     try:
         subprocess.run(
-            ["git", "--version"],
+            ["rsync", "--version"],
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
     except FileNotFoundError:
-        raise FileNotFoundError(
-            "git is not installed. Please install git to use snapshot."
-        )
+        return False
+    return True
 
-    try:
-        subprocess.run(
-            ["rsync", "--version"],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+
+def _ensure_supported(config: SnapshotConfig):
+    # Make sure we have git installed if git references are used, and rsync if
+    # it is used to copy
+    if shutil.which("git") is None:
+        if config.git_references:
+            raise FileNotFoundError(
+                "git is not installed. Please install git to use git references."
+            )
+        log.warning(
+            "git is not installed. Modules will be treated as plain directories "
+            "and filtered with their .gitignore files."
         )
-    except FileNotFoundError:
+
+    # The other copy engines and the blob store do not need rsync
+    if config.store or config.copy_strategy != "rsync":
+        return
+
+    if not _rsync_installed():
         raise FileNotFoundError(
             "rsync is not installed. Please install rsync to use snapshot."
         )
 
 
-def _snapshot_meta(config: SnapshotConfig, snapshot_dir: Path):
+def _snapshot_meta(
+    config: SnapshotConfig,
+    snapshot_dir: Path,
+    environment: EnvironmentInfo | None = None,
+    base_snapshot: Path | None = None,
+):
+    from . import _catalog
+
     meta_dir = snapshot_dir / ".nshsnapmeta"
     meta_dir.mkdir(exist_ok=True)
 
@@ -344,48 +621,283 @@ def _snapshot_meta(config: SnapshotConfig, snapshot_dir: Path):
     (meta_dir / "config.json").write_text(config.model_dump_json(indent=4))
 
     # Dump the current pip environment and save it
-    try:
-        pip_freeze = subprocess.run(
-            ["pip", "freeze", "--local"],
-            check=True,
-            stdout=subprocess.PIPE,
-            text=True,
-        ).stdout
-        (meta_dir / "requirements.txt").write_text(pip_freeze)
-    except BaseException as e:
-        log.warning(f"Failed to dump pip environment: {e}")
-        pip_freeze = None
+    if environment is None:
+        environment = current_environment()
+    (meta_dir / "requirements.txt").write_text(environment.requirements)
 
     # Save the metadata
-    meta = SnapshotMetadata.create(config)
+    meta = SnapshotMetadata.create(
+        config,
+        pip_dependencies=environment.dependencies,
+        base_snapshot=base_snapshot,
+    )
     (meta_dir / "meta.json").write_text(meta.model_dump_json(indent=4))
+    _catalog.record_started(snapshot_dir, meta)
 
     # Create the activation and execution scripts
     script_dir = snapshot_dir / ".bin"
     script_dir.mkdir(exist_ok=True)
-    create_snapshot_scripts(snapshot_dir, script_dir)
+    python_path = None
+    if config.format == "zip":
+        python_path = snapshot_dir.absolute() / SNAPSHOT_ARCHIVE_NAME
+    create_snapshot_scripts(snapshot_dir, script_dir, python_path)
+
+
+def _save_timings(snapshot_dir: Path, timings: _trace.SnapshotTimings):
+    """
+    Add the timings of the snapshot to its metadata, once it is created. The
+    snapshot may already be in use (e.g., published for reuse), so the file is
+    replaced atomically rather than rewritten in place.
+    """
+    path = snapshot_dir / ".nshsnapmeta" / "meta.json"
+    meta = json.loads(path.read_text())
+    meta["timings"] = timings.to_json_dict()
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        tmp.write_text(json.dumps(meta, indent=4))
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _save_module_infos(snapshot_dir: Path, module_infos: list[SnapshotModuleInfo]):
+    (snapshot_dir / ".nshsnapmeta" / "modules.json").write_text(
+        json.dumps([info.to_json_dict() for info in module_infos], indent=4)
+    )
+
+
+def _load_module_infos(snapshot_dir: Path) -> list[SnapshotModuleInfo]:
+    return [
+        SnapshotModuleInfo.from_json_dict(data)
+        for data in json.loads(
+            (snapshot_dir / ".nshsnapmeta" / "modules.json").read_text()
+        )
+    ]
 
 
-def _snapshot(config: SnapshotConfig):
-    _ensure_supported()
+def _top_level_names(module_infos: list[SnapshotModuleInfo]) -> list[str]:
+    """The top-level entries of the snapshot directory that hold the modules."""
+    return [
+        info.name.split(".")[0] for info in module_infos if info.destination is not None
+    ]
 
+
+def _compile_snapshot(
+    config: SnapshotConfig,
+    snapshot_dir: Path,
+    module_infos: list[SnapshotModuleInfo],
+):
+    """Precompile the bytecode of the snapshotted modules."""
+    roots = [
+        info.destination.absolute()
+        for info in module_infos
+        if info.destination is not None
+    ]
+    if config.format == "zip":
+        # `zipimport` only reads legacy pycs, which hold a single level.
+        if len(config.compile_optimize) > 1:
+            log.warning(
+                "Zip snapshots only support a single bytecode optimization level. "
+                f"Compiling for level {config.compile_optimize[0]} only."
+            )
+        compile_bytecode(
+            roots,
+            config.compile_optimize[:1],
+            workers=config.compile_workers,
+            legacy=True,
+            # Record the source paths inside the archive
+            stripdir=snapshot_dir,
+            prependdir=snapshot_dir / SNAPSHOT_ARCHIVE_NAME,
+        )
+    else:
+        compile_bytecode(roots, config.compile_optimize, workers=config.compile_workers)
+
+
+def _archive_snapshot(
+    snapshot_dir: Path,
+    module_infos: list[SnapshotModuleInfo],
+) -> list[SnapshotModuleInfo]:
+    """
+    Move the snapshotted modules into the snapshot archive, and point their
+    destinations into it.
+    """
+    from ._archive import archive_modules
+
+    archive = archive_modules(snapshot_dir, _top_level_names(module_infos))
+    return [
+        dataclasses.replace(
+            info,
+            destination=archive / info.destination.absolute().relative_to(snapshot_dir),
+        )
+        if info.destination is not None
+        else info
+        for info in module_infos
+    ]
+
+
+def _finish_snapshot(
+    config: SnapshotConfig,
+    snapshot_dir: Path,
+    module_infos: list[SnapshotModuleInfo],
+    manifest: ManifestBuilder | None,
+) -> list[SnapshotModuleInfo]:
+    """
+    Post-process the copied modules (bytecode, index, manifest, archive), and
+    save the module infos, which marks the snapshot as complete.
+    """
+    from . import _catalog
+
+    if config.compile_bytecode:
+        with _trace.phase("compile_bytecode"):
+            _compile_snapshot(config, snapshot_dir, module_infos)
+    with _trace.phase("module_index"):
+        write_module_index(snapshot_dir, _top_level_names(module_infos))
+    if manifest is not None:
+        with _trace.phase("manifest"):
+            manifest.write()
+    if config.format == "zip":
+        with _trace.phase("archive"):
+            module_infos = _archive_snapshot(snapshot_dir, module_infos)
+    elif config.format != "directory":
+        assert_never(config.format)
+    with _trace.phase("metadata.modules"):
+        _save_module_infos(snapshot_dir, module_infos)
+        _catalog.record_completed(snapshot_dir, module_infos)
+    return module_infos
+
+
+def _create_snapshot(
+    config: SnapshotConfig,
+    modules: list[str],
+    environment: EnvironmentInfo,
+):
     snapshot_dir = config._resolve_snapshot_dir()
-    modules = config._resolve_modules()
 
     gitignored_dir(snapshot_dir)
-    _snapshot_meta(config, snapshot_dir)
-
-    snapshot_dir, modules = _snapshot_modules(
-        snapshot_dir, modules, config.on_module_not_found, config.git_references
+    # Leased before anything is written, so that `nshsnap gc` leaves the
+    # snapshot (and its base) alone while it is being created and used.
+    hold_lease(snapshot_dir)
+    with _trace.phase("base_snapshot"):
+        base_snapshot = resolve_base_snapshot(
+            config.base_snapshot, snapshot_dir, modules
+        )
+    if base_snapshot is not None:
+        hold_lease(base_snapshot)
+    with _trace.phase("metadata"):
+        _snapshot_meta(config, snapshot_dir, environment, base_snapshot)
+
+    store = SnapshotStore(config._resolve_store_dir()) if config.store else None
+    manifest = ManifestBuilder(snapshot_dir) if config.manifest else None
+    snapshot_dir, module_infos, store_stats, copy_stats = _snapshot_modules(
+        snapshot_dir,
+        modules,
+        config.on_module_not_found,
+        config.git_references,
+        store=store,
+        copy_strategy=config.copy_strategy,
+        copy_workers=config.copy_workers,
+        module_workers=config.module_workers,
+        manifest=manifest,
+        base_snapshot=base_snapshot,
+        staged=config.staged,
     )
-    return ActiveSnapshot(config, snapshot_dir, modules)
+    module_infos = _finish_snapshot(config, snapshot_dir, module_infos, manifest)
+    return ActiveSnapshot(
+        config,
+        snapshot_dir,
+        module_infos,
+        store_stats=store_stats,
+        copy_stats=copy_stats,
+        base_snapshot=base_snapshot,
+    )
+
+
+def _reuse_or_create_snapshot(
+    config: SnapshotConfig,
+    modules: list[str],
+    environment: EnvironmentInfo,
+):
+    with _trace.phase("reuse_key"):
+        key = _reuse.snapshot_key(
+            config, {module: _module_location(module) for module in modules}
+        )
+    if key is None:
+        return _create_snapshot(config, modules, environment)
+
+    # Concurrent creators of the same snapshot wait here, and all but the
+    # first one find the published snapshot once they get the lock.
+    with file_lock(_reuse.lock_path(key)):
+        if (snapshot_dir := _reuse.lookup(key)) is not None:
+            hold_lease(snapshot_dir)
+            log.critical(f"Reusing existing snapshot {snapshot_dir} for {modules=}")
+            return ActiveSnapshot(
+                config, snapshot_dir, _load_module_infos(snapshot_dir), reused=True
+            )
+
+        active = _create_snapshot(config, modules, environment)
+        _reuse.publish(key, active.snapshot_dir)
+        return active
+
+
+def _snapshot_traced(config: SnapshotConfig):
+    _ensure_supported(config)
 
+    # Scan the environment once, and share it between module resolution and
+    # the snapshot metadata.
+    with _trace.phase("environment"):
+        environment = current_environment()
+    with _trace.phase("resolve_modules"):
+        modules = config._resolve_modules(environment)
 
-def snapshot(config: configs.SnapshotConfigInstanceOrDict | None = None, /):
+    if config.reuse:
+        if config.snapshot_dir is None:
+            return _reuse_or_create_snapshot(config, modules, environment)
+        log.warning(
+            "Snapshot reuse is only supported for the default snapshot directory. "
+            f"Creating a new snapshot in {config.snapshot_dir}."
+        )
+
+    return _create_snapshot(config, modules, environment)
+
+
+def _snapshot(
+    config: SnapshotConfig,
+    on_trace_event: _trace.TraceCallback | None = None,
+):
+    tracer = _trace.SnapshotTracer(on_trace_event)
+    with tracer.activate():
+        active = _snapshot_traced(config)
+    timings = tracer.finish()
+
+    if not active.reused:
+        try:
+            _save_timings(active.snapshot_dir, timings)
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to save the timings of {active.snapshot_dir}: {e}")
+    return dataclasses.replace(active, timings=timings)
+
+
+def snapshot(
+    config: configs.SnapshotConfigInstanceOrDict | None = None,
+    /,
+    *,
+    on_trace_event: _trace.TraceCallback | None = None,
+):
+    """
+    Snapshot the configured modules.
+
+    Args:
+        config: The snapshot configuration.
+        on_trace_event: Optional callback, which is called with a `TraceEvent`
+            as each phase of the snapshot finishes (from the thread that ran
+            the phase). The collected timings are also available as
+            `ActiveSnapshot.timings`.
+    """
     from . import configs
 
     if config is None:
         config = SnapshotConfig()
 
     config = configs.CreateSnapshotConfig(config)
-    return _snapshot(config)
+    return _snapshot(config, on_trace_event)
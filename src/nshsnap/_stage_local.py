@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ._copy import _copy_file_native
+from ._manifest import _digest, manifest_path, read_manifest
+from ._util import copy_symlink, file_lock, snapshot_python_path
+
+log = logging.getLogger(__name__)
+
+STAGE_DIR_ENV = "NSHSNAP_STAGE_DIR"
+"""Environment variable that overrides the node-local directory of staged snapshots."""
+
+_STAGED_NAME = ".nshsnap-staged.json"
+"""The record of a verified local copy, which lists its files and their sizes."""
+
+# The scripts refer to the snapshot on the shared filesystem
+_EXCLUDED = {".bin"}
+
+
+def local_stage_dir() -> Path:
+    """
+    The node-local directory that snapshots are staged in: `$NSHSNAP_STAGE_DIR`,
+    `$TMPDIR`, `/dev/shm`, or the system temporary directory, in that order.
+    """
+    if path := os.environ.get(STAGE_DIR_ENV):
+        return Path(path)
+    if path := os.environ.get("TMPDIR"):
+        root = Path(path)
+    elif os.access("/dev/shm", os.W_OK):
+        root = Path("/dev/shm")
+    else:
+        root = Path(tempfile.gettempdir())
+    return root / f"nshsnap-{os.getuid()}"
+
+
+def _check_stage_dir(stage_dir: Path):
+    """
+    Check that only this user can write to ``stage_dir``. It is usually in a
+    directory that all users share (e.g., `/dev/shm`), where another user may
+    have created it first to plant files in the copies of our snapshots.
+
+    Raises:
+        RuntimeError: If ``stage_dir`` is not a directory that this user owns
+            and that no one else can access.
+    """
+    st = stage_dir.lstat()
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(
+            f"The stage directory {stage_dir} is not a directory (e.g., a symlink)"
+        )
+    if st.st_uid != os.getuid():
+        raise RuntimeError(
+            f"The stage directory {stage_dir} is owned by another user (uid {st.st_uid})"
+        )
+    if st.st_mode & 0o077:
+        raise RuntimeError(
+            f"The stage directory {stage_dir} is accessible by other users "
+            f"(mode {stat.S_IMODE(st.st_mode):o})"
+        )
+
+
+def _stage_key(snapshot_dir: Path) -> str:
+    """
+    Identify the contents of the snapshot. The module infos are written once
+    the snapshot is complete, so a snapshot that is recreated at the same path
+    gets a new key.
+    """
+    try:
+        st = (snapshot_dir / ".nshsnapmeta" / "modules.json").stat()
+    except FileNotFoundError:
+        raise ValueError(f"{snapshot_dir} is not a complete snapshot")
+    key = f"{snapshot_dir}\0{st.st_mtime_ns}\0{st.st_size}"
+    return f"{snapshot_dir.name}-{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+
+def _local_files(root: Path) -> dict[str, int]:
+    files: dict[str, int] = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames + [d for d in dirnames if Path(dirpath, d).is_symlink()]:
+            path = Path(dirpath, name)
+            files[path.relative_to(root).as_posix()] = path.lstat().st_size
+    files.pop(_STAGED_NAME, None)
+    return files
+
+
+def _is_staged(local_dir: Path) -> bool:
+    """
+    Whether ``local_dir`` still holds all the files of the copy (e.g., the
+    temporary directory was not partially cleaned up). Files that were added
+    since (e.g., bytecode that was written on import) are ignored.
+    """
+    try:
+        record = json.loads((local_dir / _STAGED_NAME).read_text())
+        return all(
+            (local_dir / rel).lstat().st_size == size
+            for rel, size in record["files"].items()
+        )
+    except (OSError, ValueError):
+        return False
+
+
+def _copy_snapshot(
+    snapshot_dir: Path,
+    destination: Path,
+    workers: int | None,
+) -> dict[str, int]:
+    """Copy the snapshot (except its scripts), and return the size of each file."""
+    destination.mkdir(parents=True)
+    jobs: list[tuple[str, Path, Path]] = []
+    files: dict[str, int] = {}
+    for dirpath, dirnames, filenames in os.walk(snapshot_dir):
+        if Path(dirpath) == snapshot_dir:
+            dirnames[:] = [d for d in dirnames if d not in _EXCLUDED]
+        target = destination / os.path.relpath(dirpath, snapshot_dir)
+        for name in dirnames + filenames:
+            src = Path(dirpath, name)
+            rel = (target / name).relative_to(destination).as_posix()
+            if src.is_symlink():
+                copy_symlink(src, target / name)
+                files[rel] = (target / name).lstat().st_size
+            elif name in dirnames:
+                (target / name).mkdir()
+            else:
+                jobs.append((rel, src, target / name))
+
+    # Many small files on a shared filesystem are latency-bound, not throughput-bound
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = executor.map(lambda job: _copy_file_native(job[1], job[2]), jobs)
+        files.update((rel, size) for (rel, _, _), size in zip(jobs, sizes))
+    return files
+
+
+def _verify(snapshot_dir: Path, local_dir: Path, files: dict[str, int]):
+    """
+    Check that every file was copied in full, and that the contents of the
+    modules match the manifest of the snapshot, if it has one.
+
+    Raises:
+        RuntimeError: If the copy does not match the snapshot.
+    """
+    if (local := _local_files(local_dir)) != files:
+        mismatched = sorted(set(local.items()) ^ set(files.items()))
+        raise RuntimeError(
+            f"The local copy of {snapshot_dir} is incomplete (e.g., {mismatched[0][0]})"
+        )
+
+    if not manifest_path(snapshot_dir).is_file():
+        return
+    # Zip snapshots hold the files of the manifest inside of their archive
+    entries = [entry for entry in read_manifest(snapshot_dir) if entry.path in files]
+
+    def matches(entry) -> bool:
+        path = local_dir / entry.path
+        return _digest(path, path.lstat()) == entry.digest
+
+    with ThreadPoolExecutor() as executor:
+        for entry, ok in zip(entries, executor.map(matches, entries)):
+            if not ok:
+                raise RuntimeError(
+                    f"The local copy of {snapshot_dir / entry.path} does not "
+                    "match the manifest of the snapshot"
+                )
+
+
+def _remove_stale(stage_dir: Path):
+    """
+    Remove the local copies of snapshots that no longer exist (e.g., that
+    `nshsnap gc` removed). Their leases have expired, so no job uses them.
+    """
+    for local_dir in stage_dir.iterdir():
+        try:
+            record = json.loads((local_dir / _STAGED_NAME).read_text())
+        except (OSError, ValueError):
+            continue
+        if not Path(record["source"]).is_dir():
+            log.info(f"Removing the local copy {local_dir} of a removed snapshot")
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+
+def stage_locally(
+    snapshot_dir: Path,
+    stage_dir: Path | None = None,
+    workers: int | None = None,
+) -> Path:
+    """
+    Copy the snapshot to node-local storage, once per node, and return the
+    entry to put on `sys.path` (or `PYTHONPATH`) to import from the copy.
+
+    Concurrent callers on the same node (e.g., the ranks of a job) wait for
+    the first one to copy the snapshot, and later jobs reuse its copy. Each
+    copy is verified against the sizes of the files of the snapshot, and the
+    digests of its manifest if it has one, before it is used.
+
+    Args:
+        snapshot_dir: The snapshot to stage.
+        stage_dir: The node-local directory to stage in. Default: `local_stage_dir()`.
+        workers: The number of threads that copy files.
+
+    Raises:
+        ValueError: If ``snapshot_dir`` is not a complete snapshot.
+        RuntimeError: If the copy does not match the snapshot, or if
+            ``stage_dir`` is not private to this user.
+    """
+    snapshot_dir = snapshot_dir.absolute()
+    if stage_dir is None:
+        stage_dir = local_stage_dir()
+    key = _stage_key(snapshot_dir)
+    local_dir = stage_dir / key
+
+    stage_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    _check_stage_dir(stage_dir)
+    with file_lock(stage_dir / f"{key}.lock"):
+        if _is_staged(local_dir):
+            log.info(f"Using the local copy {local_dir} of {snapshot_dir}")
+            return snapshot_python_path(local_dir)
+
+        if local_dir.exists():
+            log.warning(f"Replacing the incomplete local copy {local_dir}")
+            shutil.rmtree(local_dir)
+        _remove_stale(stage_dir)
+
+        start = time.perf_counter()
+        partial = stage_dir / f".{key}.partial-{os.getpid()}"
+        try:
+            files = _copy_snapshot(snapshot_dir, partial, workers)
+            _verify(snapshot_dir, partial, files)
+            (partial / _STAGED_NAME).write_text(
+                json.dumps({"source": str(snapshot_dir), "files": files})
+            )
+            os.replace(partial, local_dir)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+
+    log.info(
+        f"Staged {snapshot_dir} at {local_dir} ({len(files)} files, "
+        f"{sum(files.values())} bytes) in {time.perf_counter() - start:.2f}s"
+    )
+    return snapshot_python_path(local_dir)
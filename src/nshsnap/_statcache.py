@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import stat
+import time
+from pathlib import Path
+
+from ._files import file_digest, list_source_files
+from ._util import cache_dir
+
+log = logging.getLogger(__name__)
+
+_CACHE_VERSION = 1
+
+# Files modified this close to (or after) the time the cache was saved may have
+# been modified again within the same mtime tick, so their entries are not
+# trusted (git's "racily clean" entries). Some filesystems have 2s mtimes.
+_RACY_WINDOW_NS = 2_000_000_000
+
+
+class StatCache:
+    """
+    A persistent cache of the content digests of the files of a source tree,
+    keyed by their (size, mtime, inode), similar to git's index.
+
+    Files whose stat information did not change since they were last hashed
+    are not read again.
+    """
+
+    def __init__(self, source: Path):
+        self.source = source.absolute()
+        key = hashlib.sha256(str(self.source).encode()).hexdigest()[:32]
+        self.path = cache_dir("statcache") / f"{key}.json"
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: dict[str, list] = {}
+        self._trusted_before_ns = 0
+        self._dirty = False
+        try:
+            data = json.loads(self.path.read_text())
+            if data["version"] == _CACHE_VERSION and data["source"] == str(self.source):
+                self._entries = data["entries"]
+                self._trusted_before_ns = data["saved_ns"] - _RACY_WINDOW_NS
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug(f"Ignoring invalid stat cache {self.path}: {e}")
+
+    def digest(self, rel: str, st: os.stat_result | None = None) -> str:
+        """
+        Return the content digest of the file ``rel`` (relative to the source),
+        hashing it only if its stat information changed.
+        """
+        path = self.source / rel
+        if st is None:
+            st = path.stat()
+
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        if (
+            (entry := self._entries.get(rel)) is not None
+            and entry[:3] == key
+            and st.st_mtime_ns < self._trusted_before_ns
+        ):
+            self.hits += 1
+            return entry[3]
+
+        self.misses += 1
+        digest = file_digest(path)
+        self._entries[rel] = [*key, digest]
+        self._dirty = True
+        return digest
+
+    def retain(self, rels: set[str]):
+        """Forget the entries of all files other than ``rels``."""
+        if len(self._entries) != len(rels):
+            self._entries = {
+                rel: entry for rel, entry in self._entries.items() if rel in rels
+            }
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        data = {
+            "version": _CACHE_VERSION,
+            "source": str(self.source),
+            "saved_ns": time.time_ns(),
+            "entries": self._entries,
+        }
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps(data))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.debug(f"Failed to save the stat cache {self.path}: {e}")
+            tmp.unlink(missing_ok=True)
+        self._dirty = False
+
+
+def tree_digest(source: Path) -> str:
+    """
+    Digest the contents of the files of ``source`` that belong in a snapshot
+    (see `list_source_files`), using the stat cache to skip unchanged files.
+    """
+    cache = StatCache(source)
+    digest = hashlib.sha256()
+    seen = set[str]()
+    for rel in list_source_files(source):
+        rel = rel.as_posix()
+        path = source / rel
+        try:
+            st = path.lstat()
+        except FileNotFoundError:
+            continue
+        seen.add(rel)
+
+        if stat.S_ISLNK(st.st_mode):
+            content = hashlib.sha256(os.fsencode(os.readlink(path))).hexdigest()
+        else:
+            content = cache.digest(rel, st)
+        digest.update(f"{rel}\0{st.st_mode:o}\0{content}\0".encode())
+
+    # Forget the files that no longer exist
+    cache.retain(seen)
+    cache.save()
+
+    log.info(
+        f"Digested {source}: {cache.hits} files unchanged, {cache.misses} files hashed"
+    )
+    return digest.hexdigest()
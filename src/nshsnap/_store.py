@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import shutil
+import stat
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar
+
+from ._files import copy_file_digest, file_digest, list_source_files
+from ._statcache import StatCache
+from ._util import copy_symlink, link_file
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class StoreStats:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    files_written: int = 0
+    """The number of files whose contents were newly written to the store."""
+
+    bytes_written: int = 0
+    """The number of bytes newly written to the store."""
+
+    files_linked: int = 0
+    """The number of files that were linked to an existing blob."""
+
+    bytes_linked: int = 0
+    """The number of bytes that were linked to an existing blob."""
+
+    def update(self, other: StoreStats):
+        self.files_written += other.files_written
+        self.bytes_written += other.bytes_written
+        self.files_linked += other.files_linked
+        self.bytes_linked += other.bytes_linked
+
+
+class SnapshotStore:
+    """
+    A content-addressed blob store.
+
+    Every file is stored once under ``objects/`` keyed by the digest of its
+    contents (and its executable bit), and snapshot directories are
+    materialized as hardlinks to these blobs. Blobs are made read-only, so
+    a snapshot file cannot be modified in place without affecting every
+    snapshot that shares it.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.objects_dir = root / "objects"
+        self.tmp_dir = root / "tmp"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest: str, executable: bool) -> Path:
+        suffix = "x" if executable else "r"
+        return self.objects_dir / digest[:2] / f"{digest[2:]}.{suffix}"
+
+    def _write_blob(self, source: Path, executable: bool) -> Path:
+        """
+        Write the contents of ``source`` to the store, and return its blob.
+        The blob is keyed by the digest of the bytes that were written, so a
+        file that changes while it is stored is never stored under the
+        digest of other contents.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                digest = copy_file_digest(source, f)
+            os.chmod(tmp, 0o555 if executable else 0o444)
+            blob = self.blob_path(digest, executable)
+            blob.parent.mkdir(exist_ok=True)
+            # Atomic, so concurrent writers of the same blob never see a partial file.
+            os.replace(tmp, blob)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        return blob
+
+    def add(
+        self,
+        source: Path,
+        destination: Path,
+        digest: str | None = None,
+    ) -> StoreStats:
+        """
+        Materialize ``source`` at ``destination`` as a link into the store,
+        writing a new blob only if the store does not already have it.
+
+        ``digest`` is the digest of the contents of ``source``, if known.
+        """
+        stats = StoreStats()
+
+        st = source.stat()
+        executable = bool(st.st_mode & stat.S_IXUSR)
+        if digest is None:
+            digest = file_digest(source)
+        blob = self.blob_path(digest, executable)
+
+        if blob.exists():
+            stats.files_linked += 1
+            stats.bytes_linked += st.st_size
+        else:
+            blob = self._write_blob(source, executable)
+            stats.files_written += 1
+            stats.bytes_written += st.st_size
+
+        try:
+            link_file(blob, destination)
+        except OSError as e:
+            if e.errno in (errno.EMLINK, errno.ENOENT):
+                # The blob hit the filesystem's hardlink limit, or `nshsnap gc`
+                # removed it since it was checked. Replace it with a fresh copy;
+                # existing links keep pointing at the old inode.
+                blob = self._write_blob(source, executable)
+                link_file(blob, destination)
+            elif e.errno == errno.EXDEV:
+                log.warning(
+                    f"Store {self.root} is on a different filesystem than {destination}. "
+                    "Falling back to copying."
+                )
+                shutil.copy2(source, destination)
+            else:
+                raise
+
+        return stats
+
+    def materialize(self, source: Path, location: Path) -> StoreStats:
+        """
+        Materialize the directory ``source`` as ``location / source.name``,
+        mirroring the layout produced by ``rsync -a source location``.
+        """
+        stats = StoreStats()
+        target_root = location / source.name
+        target_root.mkdir(parents=True, exist_ok=True)
+
+        # Unchanged files are not hashed again
+        stat_cache = StatCache(source)
+        for rel in list_source_files(source):
+            src = source / rel
+            dst = target_root / rel
+            dst.parent.mkdir(parents=True, exist_ok=True)
+
+            if src.is_symlink():
+                copy_symlink(src, dst)
+                continue
+
+            stats.update(self.add(src, dst, stat_cache.digest(rel.as_posix())))
+        stat_cache.save()
+
+        log.info(
+            f"Materialized {source} from store {self.root}: "
+            f"{stats.bytes_written} bytes written ({stats.files_written} files), "
+            f"{stats.bytes_linked} bytes linked ({stats.files_linked} files)"
+        )
+        return stats
@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Iterator, Sequence
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, ClassVar, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TraceCallback = Callable[["TraceEvent"], None]
+
+_current: contextvars.ContextVar[SnapshotTracer | None] = contextvars.ContextVar(
+    "nshsnap_tracer", default=None
+)
+
+
+@dataclass(frozen=True, slots=True)
+class TraceEvent:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    name: str
+    """The name of the phase. The part before the first `.` is its category
+    (e.g., `git.commit` is in the `git` category)."""
+
+    start: float
+    """The start of the phase, in seconds since the snapshot started."""
+
+    duration: float
+    """The duration of the phase, in seconds."""
+
+    thread: int
+    """The thread that ran the phase (0 is the thread that called `snapshot`)."""
+
+    module: str | None = None
+    """The module that the phase belongs to, if any."""
+
+    args: dict[str, Any] = field(default_factory=dict)
+    """Additional information about the phase (e.g., the number of files copied)."""
+
+    @property
+    def category(self) -> str:
+        return self.name.split(".", 1)[0]
+
+
+@dataclass(frozen=True, slots=True)
+class SnapshotTimings:
+    __nshconfig_config__: ClassVar = {"disable_typed_dict_generation": True}
+
+    total: float
+    """The wall-clock duration of the snapshot, in seconds."""
+
+    phases: dict[str, float]
+    """The total duration of each phase, in seconds. Phases that run
+    concurrently (e.g., once per module) are added up."""
+
+    modules: dict[str, float]
+    """The wall-clock duration of the snapshot of each module, in seconds. For
+    batches (`snapshot_many`), the durations in all snapshots are added up."""
+
+    subprocesses: dict[str, int]
+    """The number of subprocesses started, by executable (e.g., `git`)."""
+
+    files_copied: int
+    """The number of files copied (or linked) into the snapshot, for the
+    in-process copy engines and the snapshot store."""
+
+    bytes_copied: int
+    """The number of bytes copied (or linked) into the snapshot."""
+
+    events: list[TraceEvent]
+    """Every traced phase, in the order they finished."""
+
+    def categories(self) -> dict[str, float]:
+        """The total duration of the phases of each category, in seconds."""
+        totals: dict[str, float] = {}
+        for event in self.events:
+            totals[event.category] = totals.get(event.category, 0.0) + event.duration
+        return totals
+
+    def to_json_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_json_dict(cls, data: dict[str, Any]):
+        data = {**data, "events": [TraceEvent(**event) for event in data["events"]]}
+        return cls(**data)
+
+    def to_chrome_trace(self) -> dict[str, Any]:
+        """
+        Convert the timings to the Chrome trace event format, which can be
+        opened in `chrome://tracing` or https://ui.perfetto.dev.
+        """
+        pid = os.getpid()
+        events: list[dict[str, Any]] = [
+            {
+                "name": "snapshot",
+                "cat": "snapshot",
+                "ph": "X",
+                "ts": 0,
+                "dur": self.total * 1e6,
+                "pid": pid,
+                "tid": 0,
+                "args": {"subprocesses": self.subprocesses},
+            }
+        ]
+        for event in self.events:
+            args = dict(event.args)
+            if event.module is not None:
+                args["module"] = event.module
+            events.append(
+                {
+                    "name": f"{event.name} {event.module}"
+                    if event.module is not None
+                    else event.name,
+                    "cat": event.category,
+                    "ph": "X",
+                    "ts": event.start * 1e6,
+                    "dur": event.duration * 1e6,
+                    "pid": pid,
+                    "tid": event.thread,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: Path):
+        path.write_text(json.dumps(self.to_chrome_trace()))
+
+
+class SnapshotTracer:
+    """
+    Collects the phases of a snapshot. The tracer is active in the context
+    (and the threads started through `propagate`) that `activate` it.
+    """
+
+    def __init__(self, callback: TraceCallback | None = None):
+        self.callback = callback
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events: list[TraceEvent] = []
+        self._threads = {threading.get_ident(): 0}
+        self._subprocesses = Counter[str]()
+        self._files_copied = 0
+        self._bytes_copied = 0
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator[SnapshotTracer]:
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def _thread(self) -> int:
+        ident = threading.get_ident()
+        if (thread := self._threads.get(ident)) is None:
+            thread = self._threads[ident] = len(self._threads)
+        return thread
+
+    def add_event(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        module: str | None,
+        args: dict[str, Any],
+    ):
+        with self._lock:
+            event = TraceEvent(
+                name,
+                start - self._start,
+                end - start,
+                self._thread(),
+                module,
+                args,
+            )
+            self._events.append(event)
+
+        if (callback := self.callback) is not None:
+            try:
+                callback(event)
+            except Exception:
+                # A broken callback must not fail the snapshot, nor flood the log
+                log.exception(
+                    f"Trace callback failed for the {name} phase. "
+                    "It will not be called again for this snapshot."
+                )
+                self.callback = None
+
+    def add_subprocess(self, executable: str):
+        with self._lock:
+            self._subprocesses[executable] += 1
+
+    def add_copied(self, files: int, bytes: int):
+        with self._lock:
+            self._files_copied += files
+            self._bytes_copied += bytes
+
+    def finish(self) -> SnapshotTimings:
+        total = time.perf_counter() - self._start
+        with self._lock:
+            events = list(self._events)
+            phases: dict[str, float] = {}
+            modules: dict[str, float] = {}
+            for event in events:
+                phases[event.name] = phases.get(event.name, 0.0) + event.duration
+                if event.name == "module" and event.module is not None:
+                    modules[event.module] = (
+                        modules.get(event.module, 0.0) + event.duration
+                    )
+            return SnapshotTimings(
+                total=total,
+                phases=phases,
+                modules=modules,
+                subprocesses=dict(self._subprocesses),
+                files_copied=self._files_copied,
+                bytes_copied=self._bytes_copied,
+                events=events,
+            )
+
+
+@contextlib.contextmanager
+def phase(name: str, *, module: str | None = None, **args: Any) -> Iterator[dict]:
+    """
+    Trace the duration of the enclosed block as the phase ``name``, if a
+    snapshot is being traced. The yielded dict can be updated with more
+    information about the phase.
+    """
+    if (tracer := _current.get()) is None:
+        yield args
+        return
+
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        tracer.add_event(name, start, time.perf_counter(), module, args)
+
+
+def add_copied(files: int, bytes: int):
+    """Record files copied into the snapshot, if a snapshot is being traced."""
+    if (tracer := _current.get()) is not None:
+        tracer.add_copied(files, bytes)
+
+
+def add_subprocess(command: Sequence[str]):
+    """
+    Record a subprocess that is started for the snapshot, by the name of its
+    executable, if a snapshot is being traced.
+    """
+    if (tracer := _current.get()) is not None:
+        tracer.add_subprocess(os.path.basename(command[0]))
+
+
+def propagate(fn: Callable[..., T]) -> Callable[..., T]:
+    """
+    Wrap ``fn`` to run in (a copy of) the current context, so that calls from
+    a thread pool are traced.
+    """
+    context = contextvars.copy_context()
+
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
@@ -1,13 +1,104 @@
 from __future__ import annotations
 
+import contextlib
 import logging
+import os
+import shlex
 import subprocess
+import sys
+import tempfile
+import threading
+from collections.abc import Callable, Generator, Iterable
 from pathlib import Path
+from typing import Any, TypeAlias, TypeVar
 
 from uuid_extensions import uuid7str
 
+from . import _trace
+
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+SNAPSHOT_ARCHIVE_NAME = "snapshot.zip"
+"""The name of the module archive of snapshots created with `format="zip"`."""
+
+
+def cache_dir(*parts: str, create: bool = True) -> Path:
+    """Return a directory inside the nshsnap cache (``~/.cache/nshsnap``)."""
+    path = Path.home() / ".cache" / "nshsnap"
+    path = path.joinpath(*parts)
+    if create:
+        path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def file_lock(path: Path):
+    """
+    Hold an exclusive advisory lock on the file at ``path`` (created if needed)
+    for the duration of the context, blocking until it is available.
+    """
+    import fcntl
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _temporary_name(destination: Path) -> Path:
+    """A name next to ``destination`` that no other process or thread uses."""
+    return destination.with_name(
+        f".{destination.name}.{os.getpid()}-{threading.get_ident()}.tmp"
+    )
+
+
+def link_file(source: Path, destination: Path):
+    """
+    Hardlink ``source`` at ``destination``, replacing the file that is already
+    there (e.g., the copy of a parent module that holds the same file), as
+    `rsync` does.
+    """
+    try:
+        os.link(source, destination)
+        return
+    except FileExistsError:
+        pass
+
+    # Link under a temporary name and rename it over the existing file
+    tmp = _temporary_name(destination)
+    os.link(source, tmp)
+    try:
+        os.replace(tmp, destination)
+    finally:
+        # Renaming a link over another link of the same file is a no-op
+        tmp.unlink(missing_ok=True)
+
+
+def copy_symlink(source: Path, destination: Path):
+    """
+    Recreate the symlink ``source`` at ``destination``, replacing the entry
+    that is already there, as `link_file` does.
+    """
+    target = os.readlink(source)
+    try:
+        os.symlink(target, destination)
+        return
+    except FileExistsError:
+        pass
+
+    tmp = _temporary_name(destination)
+    os.symlink(target, tmp)
+    try:
+        os.replace(tmp, destination)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
 
 def gitignored_dir(path: Path, *, create: bool = True) -> Path:
     if create:
@@ -81,17 +172,37 @@ Write-Host "Snapshot environment activated. Use 'deactivate' to exit."
             fp.chmod(0o755)
 
 
-def _create_execution_script(snapshot_dir: Path, script_dir: Path):
+def _create_execution_script(
+    snapshot_dir: Path,
+    script_dir: Path,
+    lease_snapshot_dir: Path,
+):
+    from ._lease import lease_script
+
     execute_script = script_dir / "execute"
     script_content = f"""#!/bin/bash
 
+# With --stage-local, import from a node-local copy of the snapshot
+stage_local=0
+if [ "$1" = "--stage-local" ]; then
+    stage_local=1
+    shift
+fi
+
 if [ "$#" -eq 0 ]; then
-    echo "Usage: $0 <command> [args...]"
+    echo "Usage: $0 [--stage-local] <command> [args...]"
     exit 1
 fi
 
+{lease_script(lease_snapshot_dir)}
+
 # Add the snapshot directory to PYTHONPATH
-export PYTHONPATH="{snapshot_dir}:$PYTHONPATH"
+python_path="{snapshot_dir}"
+if [ "$stage_local" -eq 1 ]; then
+    python_path="$({shlex.quote(sys.executable)} -m nshsnap stage-local \\
+        {shlex.quote(str(lease_snapshot_dir.absolute()))})" || exit 1
+fi
+export PYTHONPATH="$python_path:$PYTHONPATH"
 
 # Execute the given command
 exec "$@"
@@ -100,119 +211,243 @@ exec "$@"
     execute_script.chmod(0o755)  # Make the script executable
 
 
-def create_snapshot_scripts(snapshot_dir: Path, script_dir: Path):
+def create_snapshot_scripts(
+    snapshot_dir: Path,
+    script_dir: Path,
+    python_path: Path | None = None,
+):
+    # The entry to add to PYTHONPATH (e.g., the archive of a zip snapshot)
+    if python_path is None:
+        python_path = snapshot_dir
+
     # Create the activation script
-    _create_activation_script(snapshot_dir, script_dir)
+    _create_activation_script(python_path, script_dir)
 
     # Create the execution script
-    _create_execution_script(snapshot_dir, script_dir)
+    _create_execution_script(python_path, script_dir, snapshot_dir)
+
+
+def snapshot_python_path(snapshot_dir: Path) -> Path:
+    """Return the entry to put on `sys.path` to import from the snapshot."""
+    if (archive := snapshot_dir / SNAPSHOT_ARCHIVE_NAME).is_file():
+        return archive
+    return snapshot_dir
+
+
+def disk_usage(path: Path) -> int:
+    """The disk usage of the tree at ``path``, counting hardlinked files once."""
+    total = 0
+    seen = set[tuple[int, int]]()
+    stack = [str(path)]
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                total += getattr(st, "st_blocks", 0) * 512 or st.st_size
+    return total
 
 
 def snapshot_id():
     return uuid7str()
 
 
-def is_git_repository(path: Path) -> bool:
-    """Check if the given path is a git repository."""
+Step: TypeAlias = tuple[Callable[..., Any], tuple[Any, ...]]
+"""A blocking call that a step generator asks its runner to make."""
+
+
+def run_steps(steps: Generator[Step, Any, T]) -> T:
+    """
+    Run a step generator: make each call that it yields, in order, and send
+    back its result (or throw its exception into the generator).
+
+    Step generators hold logic that is shared between the synchronous and the
+    asynchronous snapshot paths. `asnapshot` runs the same generators with
+    `_async._run_steps`, which runs the git and rsync subprocesses as asyncio
+    subprocesses and the other calls in threads.
+    """
+    result: Any = None
+    error: Exception | None = None
+    try:
+        while True:
+            try:
+                if error is not None:
+                    fn, args = steps.throw(error)
+                else:
+                    fn, args = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = fn(*args), None
+            except Exception as e:
+                result, error = None, e
+    finally:
+        steps.close()
+
+
+def run_git(
+    path: Path,
+    args: tuple[str, ...],
+    env: dict[str, str] | None = None,
+    input: str | None = None,
+) -> str:
+    """
+    Run ``git -C path *args``, and return its stripped stdout.
+
+    Raises:
+        subprocess.CalledProcessError: If the command fails.
+    """
+    _trace.add_subprocess(["git"])
+    return subprocess.run(
+        ["git", "-C", str(path), *args],
+        check=True,
+        input=input,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=env,
+    ).stdout.strip()
+
+
+def _git_steps(
+    path: Path,
+    *args: str,
+    env: dict[str, str] | None = None,
+    input: str | None = None,
+) -> Generator[Step, Any, str]:
+    return (yield (run_git, (path, args, env, input)))
+
+
+def is_git_repository_steps(path: Path) -> Generator[Step, Any, bool]:
     try:
-        subprocess.run(
-            ["git", "-C", str(path), "rev-parse", "--git-dir"],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        yield from _git_steps(path, "rev-parse", "--git-dir")
         return True
     except (subprocess.CalledProcessError, FileNotFoundError):
         return False
 
 
-def get_current_git_reference(path: Path) -> str:
-    """Get the current git reference (branch or commit hash) of the repository."""
+def is_git_repository(path: Path) -> bool:
+    """Check if the given path is a git repository."""
+    return run_steps(is_git_repository_steps(path))
+
+
+def get_git_commit_steps(path: Path) -> Generator[Step, Any, str | None]:
+    try:
+        return (yield from _git_steps(path, "rev-parse", "--verify", "HEAD"))
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def get_git_commit(path: Path) -> str | None:
+    """Get the commit hash of HEAD, or None if it cannot be determined."""
+    return run_steps(get_git_commit_steps(path))
+
+
+def get_current_git_reference_steps(path: Path) -> Generator[Step, Any, str]:
     try:
         # Try to get the current branch name
-        result = subprocess.run(
-            ["git", "-C", str(path), "symbolic-ref", "--short", "HEAD"],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-        return result.stdout.strip()
+        return (yield from _git_steps(path, "symbolic-ref", "--short", "HEAD"))
     except subprocess.CalledProcessError:
         # If not on a branch, get the commit hash
-        result = subprocess.run(
-            ["git", "-C", str(path), "rev-parse", "HEAD"],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-        return result.stdout.strip()
-
+        return (yield from _git_steps(path, "rev-parse", "HEAD"))
 
-def checkout_git_reference(path: Path, reference: str) -> str:
-    """
-    Checkout the specified git reference and return the previous reference.
 
-    Args:
-        path: The path to the git repository
-        reference: The git reference to checkout (branch, tag, or commit hash)
+def get_current_git_reference(path: Path) -> str:
+    """Get the current git reference (branch or commit hash) of the repository."""
+    return run_steps(get_current_git_reference_steps(path))
 
-    Returns:
-        The previous git reference that was checked out
 
-    Raises:
-        subprocess.CalledProcessError: If the git operation fails
-        ValueError: If the path is not a git repository
-    """
-    if not is_git_repository(path):
+def extract_git_reference_steps(
+    path: Path,
+    reference: str,
+    destination: Path,
+    paths: Iterable[str] | None = None,
+) -> Generator[Step, Any, str]:
+    """The step generator of `extract_git_reference`."""
+    if not (yield from is_git_repository_steps(path)):
         raise ValueError(f"Path {path} is not a git repository")
 
-    # Get the current reference before switching
-    current_ref = get_current_git_reference(path)
-
-    try:
-        # Checkout the specified reference
-        subprocess.run(
-            ["git", "-C", str(path), "checkout", reference],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        log.info(f"Checked out git reference '{reference}' in {path}")
-        return current_ref
-    except subprocess.CalledProcessError as e:
-        stderr = e.stderr.decode() if e.stderr else ""
-        raise subprocess.CalledProcessError(
-            e.returncode,
-            e.cmd,
-            f"Failed to checkout git reference '{reference}' in {path}: {stderr}",
-        )
-
-
-def restore_git_reference(path: Path, reference: str) -> None:
+    commit = yield from _git_steps(
+        path, "rev-parse", "--verify", f"{reference}^{{commit}}"
+    )
+    prefix = yield from _git_steps(path, "rev-parse", "--show-prefix")
+    toplevel = Path((yield from _git_steps(path, "rev-parse", "--show-toplevel")))
+
+    destination.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="nshsnap_index_") as tmp_dir:
+        # Use a throwaway index, so the repository's own index is never modified.
+        env = {**os.environ, "GIT_INDEX_FILE": str(Path(tmp_dir) / "index")}
+        # The index holds the subtree of `path` only, so it must be checked out
+        # from the top level of the repository.
+        yield from _git_steps(toplevel, "read-tree", f"{commit}:{prefix}", env=env)
+        if paths is None:
+            yield from _git_steps(
+                toplevel,
+                "checkout-index",
+                "--all",
+                "--force",
+                f"--prefix={destination}/",
+                env=env,
+            )
+        else:
+            yield from _git_steps(
+                toplevel,
+                "checkout-index",
+                "--force",
+                f"--prefix={destination}/",
+                "-z",
+                "--stdin",
+                env=env,
+                input="".join(f"{rel}\0" for rel in paths),
+            )
+
+    log.info(
+        f"Extracted git reference '{reference}' ({commit}) of {path} to {destination}"
+    )
+    return commit
+
+
+def extract_git_reference(
+    path: Path,
+    reference: str,
+    destination: Path,
+    paths: Iterable[str] | None = None,
+) -> str:
     """
-    Restore the git repository to the specified reference.
+    Extract the contents of the directory at ``path`` as of the specified git
+    reference into ``destination``, directly from the git object store.
+
+    The working tree and the index of the repository are not touched, so this
+    is safe to run on a dirty working tree and concurrently with other
+    extractions from the same repository.
 
     Args:
-        path: The path to the git repository
-        reference: The git reference to restore to
+        path: The path to a directory inside a git repository
+        reference: The git reference to extract (branch, tag, or commit hash)
+        destination: The directory to extract into
+        paths: Only extract these files (relative to ``path``). Default: all files.
+
+    Returns:
+        The commit hash that the reference resolved to
 
     Raises:
         subprocess.CalledProcessError: If the git operation fails
+        ValueError: If the path is not a git repository
     """
-    try:
-        subprocess.run(
-            ["git", "-C", str(path), "checkout", reference],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        log.info(f"Restored git reference '{reference}' in {path}")
-    except subprocess.CalledProcessError as e:
-        stderr = e.stderr.decode() if e.stderr else ""
-        log.error(f"Failed to restore git reference '{reference}' in {path}: {stderr}")
-        # Don't raise here as this is a cleanup operation
+    return run_steps(extract_git_reference_steps(path, reference, destination, paths))
 
 
 def print_snapshot_usage(snapshot_dir: Path) -> None:
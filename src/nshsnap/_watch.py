@@ -0,0 +1,629 @@
+from __future__ import annotations
+
+import ctypes
+import errno
+import hashlib
+import json
+import logging
+import os
+import selectors
+import shutil
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from ._config import SnapshotConfig
+from ._copy import CopyStats, _copy_file_native
+from ._files import list_source_files, use_git
+from ._ignore import IGNORE_FILE_NAME, IgnoreMatcher
+from ._pip_deps import current_environment
+from ._util import cache_dir, copy_symlink, link_file, run_git
+
+log = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_EXCL_UNLINK = 0x04000000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (
+    _IN_MODIFY
+    | _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+    | _IN_ONLYDIR
+    | _IN_EXCL_UNLINK
+)
+
+_EVENT = struct.Struct("iIII")
+
+_DEBOUNCE_SECONDS = 0.1
+"""How long the tree must be quiet before changes are copied to the stage."""
+
+_FREEZE_TIMEOUT_SECONDS = 300
+
+
+def _stage_key(module: str, location: Path) -> str:
+    # Per host, since the cache directory may be shared between hosts
+    key = f"{socket.gethostname()}\0{module}\0{location}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def stage_dir(module: str, location: Path) -> Path:
+    """The directory that holds the staged copy of a module, and its watcher's socket."""
+    return cache_dir("staging", create=False) / _stage_key(module, location)
+
+
+class _Inotify:
+    """A minimal inotify binding through ctypes."""
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_init1 failed: {os.strerror(e)}")
+
+    def add_watch(self, path: Path) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"Failed to watch {path}: {os.strerror(e)}")
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._rm_watch(self.fd, wd)
+
+    def read(self) -> list[tuple[int, int, str]]:
+        """Read the queued events (watch, mask, name) without blocking."""
+        events: list[tuple[int, int, str]] = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _stamp(st: os.stat_result) -> tuple[int, int, int]:
+    return st.st_size, st.st_mtime_ns, st.st_mode
+
+
+def _stage_file(src: Path, dst: Path):
+    """
+    Copy ``src`` to ``dst`` through a new inode, so that snapshots that were
+    frozen from the previous copy (by hardlinks) never change.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f".{dst.name}.nshsnap-tmp")
+    tmp.unlink(missing_ok=True)
+    if src.is_symlink():
+        os.symlink(os.readlink(src), tmp)
+    else:
+        _copy_file_native(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _make_dir(path: Path, created: list[Path]):
+    try:
+        path.mkdir()
+    except FileExistsError:
+        return
+    created.append(path)
+
+
+def _freeze_file(staged: Path, destination: Path):
+    link = copy_symlink if staged.is_symlink() else link_file
+    try:
+        link(staged, destination)
+    except OSError as e:
+        if e.errno != errno.EMLINK:
+            raise
+        # Too many snapshots link to the staged file: stage a new copy
+        _stage_file(staged, staged)
+        link(staged, destination)
+
+
+def _remove_created(created: list[Path]):
+    """Remove the entries of a failed freeze, leaving those it did not create."""
+    for path in reversed(created):
+        try:
+            if path.is_dir() and not path.is_symlink():
+                # Not empty if an overlapping module was frozen into it meanwhile
+                path.rmdir()
+            else:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def _remove_staged(tree: Path, rel: str):
+    path = tree / rel
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+    # Directories that only held removed files are not part of the snapshot
+    parent = path.parent
+    while parent != tree:
+        try:
+            parent.rmdir()
+        except OSError:
+            break
+        parent = parent.parent
+
+
+class StagedModule:
+    """
+    A copy of a module that is kept in sync with its source by inotify, and
+    frozen into snapshots with hardlinks.
+    """
+
+    def __init__(self, module: str, location: Path):
+        self.module = module
+        self.source = location
+        self.dir = stage_dir(module, location)
+        self.tree = self.dir / "tree"
+        self.socket_path = self.dir / "watch.sock"
+
+        self._git = use_git(location)
+        self._matcher = IgnoreMatcher(location)
+        self._inotify = _Inotify()
+        self._watches: dict[int, str] = {}
+        self._ignore_files: dict[int, set[str]] = {}
+        self._dirty: set[str] = set()
+        self._new_dirs: set[str] = set()
+        self._removed_dirs: set[str] = set()
+        self._resync = False
+        self.last_event = 0.0
+        if self._git:
+            self._watch_ignore_files()
+
+    def _watch_ignore_files(self):
+        """
+        Watch the files outside of the module that decide which of its files
+        git ignores: the `.gitignore` files of its parent directories up to
+        the root of the repository, `info/exclude`, and the index (which
+        tracks files regardless of the ignore rules).
+        """
+        toplevel, exclude, index = run_git(
+            self.source,
+            (
+                "rev-parse",
+                "--show-toplevel",
+                "--git-path",
+                "info/exclude",
+                "--git-path",
+                "index",
+            ),
+        ).splitlines()
+        files = [self.source / exclude, self.source / index]
+        # git reports the toplevel with its symlinks resolved
+        parent = self.source.resolve()
+        while parent != Path(toplevel) and parent != parent.parent:
+            parent = parent.parent
+            files.append(parent / IGNORE_FILE_NAME)
+
+        # The directories are watched, since git replaces these files by renames
+        for path in files:
+            try:
+                wd = self._inotify.add_watch(path.parent)
+            except FileNotFoundError:
+                continue
+            self._ignore_files.setdefault(wd, set()).add(path.name)
+
+    @property
+    def fd(self) -> int:
+        return self._inotify.fd
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._dirty or self._new_dirs or self._removed_dirs or self._resync)
+
+    def _ignored(self, paths: list[str], is_dir: bool) -> set[str]:
+        """The subset of ``paths`` (relative to the source) that is ignored."""
+        if not paths:
+            return set()
+        if not self._git:
+            return {path for path in paths if self._matcher.is_ignored(path, is_dir)}
+
+        # Tracked files are never reported as ignored, as in `git ls-files`
+        process = subprocess.run(
+            ["git", "-C", str(self.source), "check-ignore", "--stdin", "-z"],
+            input=b"\0".join(os.fsencode(path) for path in paths),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if process.returncode not in (0, 1):
+            # E.g., paths inside of submodules, which `git ls-files` includes
+            log.debug(f"git check-ignore failed: {process.stderr.decode().strip()}")
+        ignored = {os.fsdecode(raw) for raw in process.stdout.split(b"\0") if raw}
+        return ignored | {path for path in paths if path.split("/")[0] == ".git"}
+
+    def _watch_tree(self, root: str) -> list[str]:
+        """
+        Watch ``root`` (relative to the source) and its directories that are
+        not ignored, and return the files below them.
+        """
+        files: list[str] = []
+        level = [root]
+        while level:
+            subdirs: list[str] = []
+            for rel in level:
+                directory = self.source / rel
+                try:
+                    self._watches[self._inotify.add_watch(directory)] = rel
+                    entries = list(os.scandir(directory))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        raise OSError(
+                            e.errno,
+                            f"Out of inotify watches while watching {directory}. "
+                            "Raise fs.inotify.max_user_watches.",
+                        )
+                    raise
+                prefix = f"{rel}/" if rel else ""
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(f"{prefix}{entry.name}")
+                    else:
+                        files.append(f"{prefix}{entry.name}")
+            # Directories are checked one level at a time, so the contents of
+            # ignored directories are never listed.
+            ignored = self._ignored(subdirs, is_dir=True)
+            level = [rel for rel in subdirs if rel not in ignored]
+        return files
+
+    def sync(self):
+        """Copy the whole module to the stage, skipping unchanged files."""
+        start = time.perf_counter()
+        for wd in self._watches:
+            self._inotify.rm_watch(wd)
+        self._watches.clear()
+        self._matcher = IgnoreMatcher(self.source)
+        self._dirty.clear()
+        self._new_dirs.clear()
+        self._removed_dirs.clear()
+        self._resync = False
+
+        # Watched first, so that changes made while copying are not missed
+        self._watch_tree("")
+        wanted = {
+            str(rel)
+            for rel in list_source_files(self.source)
+            if not (self.source / rel).is_dir() or (self.source / rel).is_symlink()
+        }
+
+        copied = 0
+        self.tree.mkdir(parents=True, exist_ok=True)
+        for dirpath, _, filenames in os.walk(self.tree, topdown=False):
+            for name in filenames:
+                path = Path(dirpath, name)
+                rel = path.relative_to(self.tree).as_posix()
+                if rel not in wanted:
+                    path.unlink()
+            if Path(dirpath) != self.tree and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        for rel in sorted(wanted):
+            if self._update(rel):
+                copied += 1
+        log.info(
+            f"Staged {self.module} ({len(wanted)} files, {copied} copied) in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+
+    def _update(self, rel: str) -> bool:
+        """Bring the staged copy of the file ``rel`` up to date with its source."""
+        src = self.source / rel
+        dst = self.tree / rel
+        try:
+            src_st = src.lstat()
+        except FileNotFoundError:
+            _remove_staged(self.tree, rel)
+            return False
+        try:
+            dst_st = dst.lstat()
+            if stat.S_ISLNK(src_st.st_mode):
+                if stat.S_ISLNK(dst_st.st_mode) and os.readlink(src) == os.readlink(
+                    dst
+                ):
+                    return False
+            elif _stamp(src_st) == _stamp(dst_st):
+                return False
+        except FileNotFoundError:
+            pass
+        try:
+            _stage_file(src, dst)
+        except FileNotFoundError:
+            # Removed while it was copied. The removal is queued.
+            return False
+        return True
+
+    def handle_events(self):
+        for wd, mask, name in self._inotify.read():
+            self.last_event = time.monotonic()
+            if mask & _IN_Q_OVERFLOW:
+                self._resync = True
+                continue
+            if (names := self._ignore_files.get(wd)) is not None:
+                if name in names:
+                    self._resync = True
+                continue
+            if (directory := self._watches.get(wd)) is None:
+                continue
+            if mask & _IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if not name:
+                # The watched directory itself was removed or moved. Its
+                # parent reports that, unless it is the root of the module.
+                if directory == "" and mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                    self._resync = True
+                continue
+
+            rel = f"{directory}/{name}" if directory else name
+            if name == IGNORE_FILE_NAME:
+                self._resync = True
+            elif mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._new_dirs.add(rel)
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    self._removed_dirs.add(rel)
+            else:
+                self._dirty.add(rel)
+
+    def apply(self):
+        """Copy the pending changes to the stage."""
+        if self._resync:
+            self.sync()
+            return
+
+        removed_dirs, self._removed_dirs = self._removed_dirs, set()
+        new_dirs, self._new_dirs = self._new_dirs, set()
+        dirty, self._dirty = self._dirty, set()
+
+        for rel in sorted(removed_dirs):
+            prefix = f"{rel}/"
+            for wd, directory in list(self._watches.items()):
+                if directory == rel or directory.startswith(prefix):
+                    # Moved directories are still watched under their new name
+                    self._inotify.rm_watch(wd)
+                    del self._watches[wd]
+            _remove_staged(self.tree, rel)
+
+        for rel in sorted(new_dirs - self._ignored(sorted(new_dirs), is_dir=True)):
+            dirty.update(self._watch_tree(rel))
+
+        existing = [rel for rel in dirty if os.path.lexists(self.source / rel)]
+        ignored = self._ignored(sorted(existing), is_dir=False)
+        for rel in sorted(dirty):
+            if rel in ignored:
+                _remove_staged(self.tree, rel)
+            else:
+                self._update(rel)
+
+    def freeze(self, destination: Path) -> CopyStats:
+        """
+        Clone the stage into ``destination`` with hardlinks. Entries that are
+        already there (e.g., the frozen copy of an overlapping module) are
+        replaced, and if the freeze fails, only the entries it created are
+        removed.
+        """
+        start = time.perf_counter()
+        stats = CopyStats()
+        created: list[Path] = []
+        try:
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            _make_dir(destination, created)
+            for dirpath, dirnames, filenames in os.walk(self.tree):
+                target = destination / os.path.relpath(dirpath, self.tree)
+                for name in dirnames:
+                    _make_dir(target / name, created)
+                for name in filenames:
+                    staged = Path(dirpath, name)
+                    existed = os.path.lexists(target / name)
+                    _freeze_file(staged, target / name)
+                    if not existed:
+                        created.append(target / name)
+                    stats.files += 1
+                    stats.bytes += staged.lstat().st_size
+        except BaseException:
+            _remove_created(created)
+            raise
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+    def close(self):
+        self._inotify.close()
+
+
+def _serve_freeze(staged: StagedModule, conn: socket.socket):
+    with conn:
+        try:
+            request = json.loads(conn.makefile("rb").read())
+            destination = Path(request["destination"])
+            # Changes made before the request are already queued
+            staged.handle_events()
+            staged.apply()
+            stats = staged.freeze(destination)
+            response = {"files": stats.files, "bytes": stats.bytes}
+            log.info(
+                f"Froze {staged.module} into {destination} in {stats.seconds:.3f}s"
+            )
+        except Exception as e:
+            log.exception(f"Failed to freeze {staged.module}")
+            response = {"error": f"{type(e).__name__}: {e}"}
+        try:
+            conn.sendall(json.dumps(response).encode())
+        except OSError as e:
+            log.warning(f"Failed to respond to a freeze request: {e}")
+
+
+def watch(config: SnapshotConfig):
+    """
+    Keep a staged copy of each module of ``config`` in sync with its working
+    tree, until interrupted. Snapshots of the watched modules freeze the
+    staged copies with hardlinks (see `SnapshotConfig.staged`) instead of
+    copying the modules.
+
+    Raises:
+        RuntimeError: If a module is already being watched.
+        OSError: If inotify is not available.
+    """
+    # Imported here, since snapshots import this module
+    from ._snapshot import _module_location
+
+    locations: dict[str, Path] = {}
+    for module in config._resolve_modules(current_environment()):
+        if (location := _module_location(module)) is None:
+            log.warning(f"Module {module} not found. Not watching it.")
+            continue
+        locations[module] = location
+    if not locations:
+        raise RuntimeError("No modules to watch")
+    _watch(locations)
+
+
+def _watch(modules: dict[str, Path]):
+    import fcntl
+
+    staged_modules: list[StagedModule] = []
+    listeners: list[socket.socket] = []
+    locks = []
+    selector = selectors.DefaultSelector()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for module, location in modules.items():
+            staged = StagedModule(module, location)
+            staged.dir.mkdir(parents=True, exist_ok=True)
+            lock = open(staged.dir / "watch.lock", "a")
+            locks.append(lock)
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f"{module} is already being watched")
+            staged_modules.append(staged)
+            staged.sync()
+
+            staged.socket_path.unlink(missing_ok=True)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(str(staged.socket_path))
+            os.chmod(staged.socket_path, 0o600)
+            listener.listen()
+            listeners.append(listener)
+
+            selector.register(staged.fd, selectors.EVENT_READ, (staged, None))
+            selector.register(listener, selectors.EVENT_READ, (staged, listener))
+            log.critical(f"Watching {module} at {location} (staged in {staged.tree})")
+
+        while True:
+            pending = [staged for staged in staged_modules if staged.pending]
+            timeout = _DEBOUNCE_SECONDS if pending else None
+            for key, _ in selector.select(timeout):
+                staged, listener = key.data
+                if listener is None:
+                    staged.handle_events()
+                else:
+                    conn, _ = listener.accept()
+                    _serve_freeze(staged, conn)
+
+            now = time.monotonic()
+            for staged in staged_modules:
+                if staged.pending and now - staged.last_event >= _DEBOUNCE_SECONDS:
+                    staged.apply()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for staged, listener in zip(staged_modules, listeners):
+            staged.socket_path.unlink(missing_ok=True)
+            listener.close()
+        for staged in staged_modules:
+            staged.close()
+        for lock in locks:
+            lock.close()
+        log.info("Stopped watching")
+
+
+def is_watched(module: str, location: Path) -> bool:
+    """Whether ``module`` has a staged copy that is kept in sync by `nshsnap watch`."""
+    return (stage_dir(module, location) / "watch.sock").exists()
+
+
+def freeze_staged(module: str, location: Path, destination: Path) -> CopyStats | None:
+    """
+    Ask the watcher of ``module`` (`nshsnap watch`) to freeze its staged copy
+    into ``destination``.
+
+    Returns:
+        The copy statistics, or None if the module is not watched or the
+        freeze failed, in which case the caller should copy the module.
+    """
+    if not is_watched(module, location):
+        return None
+    socket_path = stage_dir(module, location) / "watch.sock"
+
+    start = time.perf_counter()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(_FREEZE_TIMEOUT_SECONDS)
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps({"destination": str(destination)}).encode())
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("rb") as f:
+                response = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        log.info(f"The watcher of {module} is not available: {e}")
+        return None
+
+    if error := response.get("error"):
+        # The watcher removed what it froze, so the caller copies the module
+        log.warning(f"The watcher failed to freeze {module}: {error}. Copying it.")
+        return None
+
+    log.info(f"Froze the staged copy of {module} into {destination}")
+    return CopyStats(
+        files=response["files"],
+        bytes=response["bytes"],
+        seconds=time.perf_counter() - start,
+    )
@@ -1,12 +1,22 @@
 from __future__ import annotations
 
 import argparse
+import json
 import logging
+import re
+import sys
+from collections.abc import Callable
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from ._config import SnapshotConfig
-from ._snapshot import snapshot
+from ._lease import DEFAULT_LEASE_TTL_SECONDS
+from ._snapshot import ActiveSnapshot, snapshot
 from ._util import print_snapshot_usage
+from ._watch import watch
+
+if TYPE_CHECKING:
+    from ._catalog import CatalogEntry
 
 
 def add_parser_arguments(parser: argparse.ArgumentParser):
@@ -33,9 +43,128 @@ def add_parser_arguments(parser: argparse.ArgumentParser):
         help="Specify git reference for a module (format: module_name:git_reference). "
         "Can be used multiple times. Only works for modules that are git repositories.",
     )
+    parser.add_argument(
+        "--copy-strategy",
+        choices=["auto", "rsync", "native", "reflink", "hardlink"],
+        default="auto",
+        help="How to copy module files into the snapshot (default: auto)",
+    )
+    parser.add_argument(
+        "--copy-workers",
+        type=int,
+        help="Number of threads used by the native/reflink/hardlink copy engines",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["directory", "zip"],
+        default="directory",
+        help="Snapshot layout. `zip` writes a single archive that is imported with zipimport (default: directory)",
+    )
+    parser.add_argument(
+        "--compile-bytecode",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Precompile the snapshotted modules to unchecked-hash pycs",
+    )
+    parser.add_argument(
+        "--compile-optimize",
+        type=int,
+        nargs="+",
+        choices=[0, 1, 2],
+        default=[0],
+        help="Optimization levels to precompile bytecode for (default: 0)",
+    )
+    parser.add_argument(
+        "--compile-workers",
+        type=int,
+        help="Number of processes used to precompile bytecode",
+    )
+    parser.add_argument(
+        "--manifest",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Write a manifest of every copied file with its content hash",
+    )
+    parser.add_argument(
+        "--base-snapshot",
+        metavar="PATH|latest",
+        help="Create an incremental snapshot that only copies the files changed since "
+        "the given snapshot (or the most recent snapshot of the same modules)",
+    )
+    parser.add_argument(
+        "--reuse",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Reuse an existing snapshot if the modules are in the same code state",
+    )
+    parser.add_argument(
+        "--daemon",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Let the snapshot daemon (`nshsnap serve`) create the snapshot, if it "
+        "is running (default: true)",
+    )
+    parser.add_argument(
+        "--staged",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Freeze the staged copies of the modules watched by `nshsnap watch`, "
+        "instead of copying them (default: true)",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        metavar="PATH",
+        help="Write a Chrome trace of the snapshot phases to PATH "
+        "(open it in chrome://tracing or https://ui.perfetto.dev)",
+    )
     return parser
 
 
+def create_snapshot(config: SnapshotConfig, args: argparse.Namespace) -> ActiveSnapshot:
+    """Create the snapshot through the snapshot daemon if it is running, or in-process."""
+    from ._daemon import request_snapshot
+
+    if args.daemon and (snapshot_info := request_snapshot(config)) is not None:
+        return snapshot_info
+    return snapshot(config)
+
+
+def write_trace(snapshot_info: ActiveSnapshot, path: Path | None):
+    """Log the timings of the snapshot, and write them as a Chrome trace to ``path``."""
+    if (timings := snapshot_info.timings) is None:
+        return
+    logging.info(
+        "Snapshot took %.2fs (%s)",
+        timings.total,
+        ", ".join(
+            f"{category}: {seconds:.2f}s"
+            for category, seconds in sorted(
+                timings.categories().items(), key=lambda item: -item[1]
+            )
+        ),
+    )
+    if path is not None:
+        timings.write_chrome_trace(path)
+        logging.info("Trace written to: %s", path)
+
+
+def parse_git_references(
+    specs: list[str],
+    parser: argparse.ArgumentParser,
+) -> dict[str, str]:
+    git_references = {}
+    for git_ref_spec in specs:
+        if ":" not in git_ref_spec:
+            parser.error(
+                f"Invalid git reference format '{git_ref_spec}'. "
+                "Expected format: module_name:git_reference"
+            )
+        module_name, git_ref = git_ref_spec.split(":", 1)
+        git_references[module_name] = git_ref
+    return git_references
+
+
 def parsed_args_to_config(
     args: argparse.Namespace,
     parser: argparse.ArgumentParser,
@@ -50,32 +179,456 @@ def parsed_args_to_config(
     if args.dir:
         config.snapshot_dir = args.dir
 
+    config.copy_strategy = args.copy_strategy
+    config.copy_workers = args.copy_workers
+    config.format = args.format
+    config.compile_bytecode = args.compile_bytecode
+    config.compile_optimize = args.compile_optimize
+    config.compile_workers = args.compile_workers
+    config.manifest = args.manifest
+    if args.base_snapshot:
+        config.base_snapshot = (
+            "latest" if args.base_snapshot == "latest" else Path(args.base_snapshot)
+        )
+    config.reuse = args.reuse
+    config.staged = args.staged
+
     # Parse git references
     if args.git_ref:
-        git_references = {}
-        for git_ref_spec in args.git_ref:
-            if ":" not in git_ref_spec:
-                parser.error(
-                    f"Invalid git reference format '{git_ref_spec}'. "
-                    "Expected format: module_name:git_reference"
-                )
-            module_name, git_ref = git_ref_spec.split(":", 1)
-            git_references[module_name] = git_ref
-        config.git_references = git_references
+        config.git_references = parse_git_references(args.git_ref, parser)
 
     config = config.finalize()
     return config
 
 
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def _parse_size(value: str) -> int:
+    if (match := re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)B?", value.upper())) is None:
+        raise argparse.ArgumentTypeError(f"Invalid size '{value}' (e.g., 500M, 20G)")
+    return int(float(match[1]) * _SIZE_UNITS[match[2]])
+
+
+def _parse_duration(value: str) -> float:
+    if (match := re.fullmatch(r"(\d+(?:\.\d+)?)([smhdw]?)", value)) is None:
+        raise argparse.ArgumentTypeError(
+            f"Invalid duration '{value}' (e.g., 3600, 12h, 30d)"
+        )
+    return float(match[1]) * _DURATION_UNITS[match[2]]
+
+
+def gc_main(argv: list[str]):
+    from ._gc import gc_snapshots
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap gc",
+        description="Remove the least recently used snapshots until the budgets are met. "
+        "Snapshots in use by running jobs are never removed.",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=_parse_size,
+        help="Maximum total disk usage of the snapshots (e.g., 20G)",
+    )
+    parser.add_argument(
+        "--max-count", type=int, help="Maximum number of snapshots to keep"
+    )
+    parser.add_argument(
+        "--max-age",
+        type=_parse_duration,
+        help="Remove snapshots that were not used for this long (e.g., 30d)",
+    )
+    parser.add_argument(
+        "--dir",
+        type=Path,
+        help="The directory that holds the snapshots (default: ~/.cache/nshsnap/snapshots)",
+    )
+    parser.add_argument(
+        "--store-dir",
+        type=Path,
+        help="The snapshot store to remove unreferenced blobs from (default: ~/.cache/nshsnap/store)",
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=_parse_duration,
+        default=DEFAULT_LEASE_TTL_SECONDS,
+        help="How long a lease from another host is honored after its last refresh "
+        f"(default: {DEFAULT_LEASE_TTL_SECONDS}s)",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Number of threads used to remove snapshots"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report the snapshots that would be removed",
+    )
+    args = parser.parse_args(argv)
+    if args.max_size is None and args.max_count is None and args.max_age is None:
+        parser.error(
+            "At least one of --max-size, --max-count or --max-age must be provided"
+        )
+
+    result = gc_snapshots(
+        max_bytes=args.max_size,
+        max_count=args.max_count,
+        max_age=args.max_age,
+        snapshots_dir=args.dir,
+        store_dir=args.store_dir,
+        lease_ttl=args.lease_ttl,
+        workers=args.workers,
+        dry_run=args.dry_run,
+    )
+    for path in result.removed:
+        print(f"{'Would remove' if args.dry_run else 'Removed'} {path}")
+
+
+def _format_size(size: int | None) -> str:
+    if size is None:
+        return "-"
+    value = float(size)
+    for unit in ("B", "K", "M", "G"):
+        if value < 1024:
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}T"
+
+
+def _print_catalog_entries(entries: list[CatalogEntry], as_json: bool):
+    if as_json:
+        print(
+            json.dumps(
+                [
+                    {
+                        "snapshot_dir": str(entry.snapshot_dir),
+                        "id": entry.id,
+                        "created": entry.created.isoformat(),
+                        "size": entry.size,
+                        "format": entry.format,
+                        "config_hash": entry.config_hash,
+                        "base_snapshot": str(entry.base_snapshot)
+                        if entry.base_snapshot is not None
+                        else None,
+                        "modules": entry.modules,
+                        "complete": entry.complete,
+                    }
+                    for entry in entries
+                ],
+                indent=4,
+            )
+        )
+        return
+
+    for entry in entries:
+        modules = " ".join(
+            f"{name}@{commit[:12]}" if commit else name
+            for name, commit in entry.modules.items()
+        )
+        print(
+            f"{entry.created:%Y-%m-%d %H:%M:%S}  {_format_size(entry.size):>7}  "
+            f"{entry.snapshot_dir}  {modules}"
+        )
+
+
+def _add_query_arguments(parser: argparse.ArgumentParser, require_module: bool):
+    parser.add_argument(
+        "--module",
+        required=require_module,
+        help="Only include snapshots of this module",
+    )
+    parser.add_argument(
+        "--commit",
+        help="Only include snapshots of a module at this git commit (or commit prefix)",
+    )
+    parser.add_argument("--limit", type=int, help="Maximum number of snapshots")
+    parser.add_argument(
+        "--json", action="store_true", help="Print the snapshots as JSON"
+    )
+
+
+def list_main(argv: list[str]):
+    from ._catalog import list_snapshots
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap list",
+        description="List the snapshots in the snapshot catalog, newest first",
+    )
+    _add_query_arguments(parser, require_module=False)
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Include snapshots that are still being created (or failed)",
+    )
+    args = parser.parse_args(argv)
+
+    entries = list_snapshots(
+        module=args.module,
+        commit=args.commit,
+        limit=args.limit,
+        include_incomplete=args.all,
+    )
+    _print_catalog_entries(entries, args.json)
+
+
+def find_main(argv: list[str]):
+    from ._catalog import list_snapshots
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap find",
+        description="Print the directories of the snapshots of a module, newest first",
+    )
+    _add_query_arguments(parser, require_module=True)
+    args = parser.parse_args(argv)
+
+    entries = list_snapshots(module=args.module, commit=args.commit, limit=args.limit)
+    if args.json:
+        _print_catalog_entries(entries, as_json=True)
+        return
+    for entry in entries:
+        print(entry.snapshot_dir)
+
+
+def rebuild_catalog_main(argv: list[str]):
+    from ._catalog import rebuild_catalog
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap rebuild-catalog",
+        description="Re-index existing snapshot directories into the snapshot catalog",
+    )
+    parser.add_argument(
+        "--dir",
+        type=Path,
+        action="append",
+        help="A directory that holds snapshots. Can be used multiple times "
+        "(default: ~/.cache/nshsnap/snapshots)",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Number of threads used to read the snapshots"
+    )
+    args = parser.parse_args(argv)
+
+    count = rebuild_catalog(args.dir, workers=args.workers)
+    print(f"Indexed {count} snapshots")
+
+
+def serve_main(argv: list[str]):
+    from ._daemon import SOCKET_ENV, serve
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap serve",
+        description="Run a snapshot daemon that `nshsnap` and `nshsnap-run` hand their "
+        "snapshots to. It keeps the environment scan and the tool checks warm, and "
+        "coalesces identical concurrent requests into one snapshot.",
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        help=f"Unix socket to listen on (default: ${SOCKET_ENV}, or "
+        "~/.cache/nshsnap/daemon/<hostname>.sock)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=_parse_duration,
+        help="Exit once no request was received for this long (e.g., 2h)",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        serve(args.socket, idle_timeout=args.idle_timeout)
+    except RuntimeError as e:
+        logging.error("%s", e)
+        sys.exit(1)
+
+
+def watch_main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog="nshsnap watch",
+        description="Keep a staged copy of each module in sync with its working tree "
+        "(with inotify), so that snapshots only need to hardlink the staged copy.",
+    )
+    parser.add_argument(
+        "-e",
+        "--editables",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Watch all editable packages in the current environment",
+    )
+    parser.add_argument(
+        "--modules", nargs="*", default=[], help="Additional modules to watch"
+    )
+    args = parser.parse_args(argv)
+    if not args.modules and not args.editables:
+        parser.error("At least one of --modules or --editables must be provided")
+
+    config = SnapshotConfig.draft()
+    config.editable_modules = args.editables
+    config.modules = args.modules
+    config = config.finalize()
+    try:
+        watch(config)
+    except (RuntimeError, OSError) as e:
+        logging.error("%s", e)
+        sys.exit(1)
+
+
+def stage_local_main(argv: list[str]):
+    from ._stage_local import STAGE_DIR_ENV, stage_locally
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap stage-local",
+        description="Copy a snapshot to node-local storage (once per node, shared by "
+        "concurrent and later jobs), and print the entry to put on PYTHONPATH.",
+    )
+    parser.add_argument("snapshot_dir", type=Path, help="The snapshot to stage")
+    parser.add_argument(
+        "--stage-dir",
+        type=Path,
+        help=f"Node-local directory to stage in (default: ${STAGE_DIR_ENV}, $TMPDIR, "
+        "or /dev/shm)",
+    )
+    parser.add_argument("--workers", type=int, help="Number of threads that copy files")
+    args = parser.parse_args(argv)
+
+    try:
+        python_path = stage_locally(args.snapshot_dir, args.stage_dir, args.workers)
+    except (ValueError, RuntimeError) as e:
+        logging.error("%s", e)
+        sys.exit(1)
+    print(python_path)
+
+
+def export_main(argv: list[str]):
+    from ._export import export_snapshot
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap export",
+        description="Stream a snapshot as a compressed tar archive, e.g., "
+        "`nshsnap export SNAPSHOT | ssh host nshsnap import`.",
+    )
+    parser.add_argument("snapshot_dir", type=Path, help="The snapshot to export")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="-",
+        help="File to write the archive to (default: stdout)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["zstd", "gzip", "none"],
+        help="Compression of the archive (default: zstd if available, else gzip)",
+    )
+    parser.add_argument("--threads", type=int, help="Number of compression threads")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        if sys.stdout.isatty():
+            parser.error("Refusing to write the archive to a terminal (use -o FILE)")
+        output = sys.stdout.buffer
+    else:
+        output = Path(args.output)
+    try:
+        export_snapshot(args.snapshot_dir, output, args.compression, args.threads)
+    except (ValueError, RuntimeError) as e:
+        logging.error("%s", e)
+        sys.exit(1)
+
+
+def import_main(argv: list[str]):
+    import tarfile
+
+    from ._export import import_snapshot
+
+    parser = argparse.ArgumentParser(
+        prog="nshsnap import",
+        description="Create a snapshot from an archive of `nshsnap export`, and "
+        "print its directory.",
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        default="-",
+        help="The archive to import (default: stdin)",
+    )
+    parser.add_argument(
+        "--dir",
+        type=Path,
+        help="Directory to create the snapshot in (default: a new directory in "
+        "~/.cache/nshsnap/snapshots)",
+    )
+    args = parser.parse_args(argv)
+
+    input = sys.stdin.buffer if args.input == "-" else Path(args.input)
+    try:
+        snapshot_dir = import_snapshot(input, args.dir)
+    except (FileExistsError, ValueError, RuntimeError, tarfile.TarError) as e:
+        logging.error("%s", e)
+        sys.exit(1)
+    print(snapshot_dir)
+
+
+_SUBCOMMANDS: dict[str, Callable[[list[str]], None]] = {
+    "export": export_main,
+    "gc": gc_main,
+    "import": import_main,
+    "list": list_main,
+    "find": find_main,
+    "rebuild-catalog": rebuild_catalog_main,
+    "serve": serve_main,
+    "stage-local": stage_local_main,
+    "watch": watch_main,
+}
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
-    parser = argparse.ArgumentParser(description="Create a snapshot of a directory")
+
+    # `nshsnap <subcommand> ...`. Anything else creates a snapshot.
+    if len(sys.argv) > 1 and (subcommand := _SUBCOMMANDS.get(sys.argv[1])):
+        return subcommand(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description="Create a snapshot of a directory",
+        epilog="Subcommands: " + ", ".join(f"nshsnap {name}" for name in _SUBCOMMANDS),
+    )
     parser = add_parser_arguments(parser)
+    parser.add_argument(
+        "--git-ref-matrix",
+        action="append",
+        metavar="MODULE:REF[,MODULE:REF...]",
+        help="Create one snapshot per occurrence, with the given git references "
+        "(on top of --git-ref). The snapshots share the environment scan and the "
+        "unchanged files, and their directories are printed one per line. "
+        "An empty value snapshots the working trees. Can be used multiple times.",
+    )
     args = parser.parse_args()
 
     config = parsed_args_to_config(args, parser)
-    snapshot_info = snapshot(config)
+    if args.git_ref_matrix:
+        from ._batch import snapshot_many
+
+        reference_sets = [
+            parse_git_references([spec for spec in specs.split(",") if spec], parser)
+            for specs in args.git_ref_matrix
+        ]
+        snapshot_infos = snapshot_many(config, reference_sets)
+        write_trace(snapshot_infos[0], args.trace)
+        for snapshot_info in snapshot_infos:
+            log_snapshot(snapshot_info)
+        # One directory per line, for scripts that iterate over the snapshots
+        for snapshot_info in snapshot_infos:
+            print(snapshot_info.snapshot_dir)
+        return
 
+    snapshot_info = create_snapshot(config, args)
+    write_trace(snapshot_info, args.trace)
+    log_snapshot(snapshot_info)
+    print_snapshot_usage(snapshot_info.snapshot_dir)
+
+
+def log_snapshot(snapshot_info: ActiveSnapshot):
+    """Log the modules of the snapshot, their git references, and any failures."""
     logging.info("Snapshot created at: %s", snapshot_info.snapshot_dir)
     logging.info("Modules included: %s", ", ".join(snapshot_info.modules))
 
@@ -107,8 +660,6 @@ def main():
                     "  %s: Failed to use git reference '%s'", module_info.name, ref
                 )
 
-    print_snapshot_usage(snapshot_info.snapshot_dir)
-
 
 if __name__ == "__main__":
     main()
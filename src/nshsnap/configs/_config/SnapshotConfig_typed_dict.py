@@ -28,6 +28,95 @@ class SnapshotConfigTypedDict(typ.TypedDict, total=False):
     """Git references (branch, tag, commit hash) to use for specific modules. 
     Key is the module name, value is the git reference. Default: `{}`."""
 
+    copy_strategy: (
+        typ.Literal["auto"]
+        | typ.Literal["rsync"]
+        | typ.Literal["native"]
+        | typ.Literal["reflink"]
+        | typ.Literal["hardlink"]
+    )
+    """How to copy module files into the snapshot:
+    - `"native"`: Copy files in-process with a thread pool, using
+        `copy_file_range`/`sendfile`. Does not require rsync.
+    - `"rsync"`: Copy with `rsync -a`.
+    - `"reflink"`: Clone files with copy-on-write reflinks (e.g., XFS, Btrfs),
+        falling back to the native copy.
+    - `"hardlink"`: Hardlink files to the source. This is nearly free, but the
+        snapshot shares file contents with the source, so it is only safe if
+        the source files are not modified in place while the snapshot is used.
+    - `"auto"`: Probe each source/destination filesystem pair once and use
+        `"reflink"` if it is supported, `"native"` otherwise.
+    Ignored when `store` is set. Default: `"auto"`."""
+
+    copy_workers: int | None
+    """The number of threads used to copy files with the `"native"`, `"reflink"`
+    and `"hardlink"` copy strategies. Default: `None` (Python's
+    `ThreadPoolExecutor` default)."""
+
+    module_workers: int | None
+    """The number of modules to snapshot concurrently. Default: `None` (up to 8)."""
+
+    format: typ.Literal["directory"] | typ.Literal["zip"]
+    """How to lay out the snapshotted modules:
+    - `"directory"`: Plain directory trees in the snapshot directory.
+    - `"zip"`: A single uncompressed zip archive (`snapshot.zip`) that is put on
+        `sys.path` directly and imported with `zipimport`. Importing from the
+        archive needs a single open per process instead of a stat/open per file,
+        which greatly reduces the load on shared filesystems (NFS, Lustre).
+    Default: `"directory"`."""
+
+    compile_bytecode: bool
+    """Precompile the snapshotted modules to unchecked-hash pycs, so processes
+    that import from the snapshot do not compile (or write) any bytecode. The
+    pycs are only used by the interpreter version that created the snapshot.
+    Default: `False`."""
+
+    compile_optimize: list[int]
+    """The optimization levels (`0`, `1` and/or `2`, as in `python -O`) to
+    precompile bytecode for. Zip snapshots only support a single level, so
+    only the first one is used. Default: `[0]`."""
+
+    compile_workers: int | None
+    """The number of processes used to precompile bytecode. Default: `None`
+    (the number of CPUs)."""
+
+    manifest: bool
+    """Write a manifest of every copied file (path, size, mode, mtime and
+    BLAKE2b digest) to `.nshsnapmeta/manifest.tsv`. The files of each module
+    are hashed in a thread pool while the other modules are still being
+    copied. Default: `False`."""
+
+    base_snapshot: str | typ.Literal["latest"] | None
+    """Create an incremental snapshot derived from a previous snapshot: either
+    the path to a snapshot directory, or `"latest"` for the most recent snapshot
+    of the same modules in the same parent directory. For each module, the
+    files that changed since the base was taken (according to `git diff` and
+    the untracked files) are copied, and all other files are hardlinked from
+    the base. Modules that are not in git repositories, use git references, or
+    are not in the base are copied in full. Ignored when `store` is set.
+    Default: `None`."""
+
+    store: bool
+    """Store file contents in a shared, content-addressed blob store and
+    materialize the snapshot as hardlinks into it, so files that are unchanged
+    between snapshots are only stored once. Default: `False`."""
+
+    store_dir: str | None
+    """The directory of the blob store. It must be on the same filesystem as the
+    snapshot directory. Default: `~/.cache/nshsnap/store`."""
+
+    staged: bool
+    """Freeze the staged copy of each module that is watched by `nshsnap watch`
+    (a hardlink clone of a copy that is kept in sync with the working tree)
+    instead of copying the module. Modules that are not watched, or that use
+    git references, are copied as usual. Ignored when `store` is set.
+    Default: `True`."""
+
+    reuse: bool
+    """Reuse an existing snapshot if one was already created for the same modules
+    in the same code state (git HEAD, uncommitted changes, untracked files and git
+    references). Only applies when `snapshot_dir` is not set. Default: `False`."""
+
 
 @typ.overload
 def CreateSnapshotConfig(
@@ -6,8 +6,13 @@ import os
 import subprocess
 import sys
 
-from ._snapshot import snapshot
-from .cli import add_parser_arguments, parsed_args_to_config
+from ._stage_local import stage_locally
+from .cli import (
+    add_parser_arguments,
+    create_snapshot,
+    parsed_args_to_config,
+    write_trace,
+)
 
 
 def main():
@@ -34,6 +39,13 @@ Note: Use -- to separate snapshot options from the command to run.
         """,
     )
     parser = add_parser_arguments(parser)
+    parser.add_argument(
+        "--stage-local",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Run from a node-local copy of the snapshot ($NSHSNAP_STAGE_DIR, $TMPDIR "
+        "or /dev/shm), which is copied once per node and reused by later jobs",
+    )
     parser.add_argument(
         "command",
         nargs="*",
@@ -56,7 +68,8 @@ Note: Use -- to separate snapshot options from the command to run.
 
     # Create the snapshot
     logging.info("Creating snapshot...")
-    snapshot_info = snapshot(config)
+    snapshot_info = create_snapshot(config, args)
+    write_trace(snapshot_info, args.trace)
 
     logging.info("Snapshot created at: %s", snapshot_info.snapshot_dir)
     logging.info("Modules included: %s", ", ".join(snapshot_info.modules))
@@ -91,12 +104,20 @@ Note: Use -- to separate snapshot options from the command to run.
 
     logging.info("Executing command: %s", " ".join(command_args))
 
-    # Set up the environment with the snapshot directory in PYTHONPATH
+    python_path = snapshot_info.python_path
+    if args.stage_local:
+        try:
+            python_path = stage_locally(snapshot_info.snapshot_dir)
+        except (ValueError, RuntimeError) as e:
+            logging.error("Failed to stage the snapshot locally: %s", e)
+            sys.exit(1)
+
+    # Set up the environment with the snapshot directory (or archive) in PYTHONPATH
     env = os.environ.copy()
     if current_pythonpath := env.get("PYTHONPATH"):
-        env["PYTHONPATH"] = f"{snapshot_info.snapshot_dir}:{current_pythonpath}"
+        env["PYTHONPATH"] = f"{python_path}:{current_pythonpath}"
     else:
-        env["PYTHONPATH"] = str(snapshot_info.snapshot_dir)
+        env["PYTHONPATH"] = str(python_path)
 
     # Execute the command within the snapshot environment
     try:
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, snapshot
+from nshsnap._util import SNAPSHOT_ARCHIVE_NAME
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A package with a subpackage and a data file, outside of any git repository."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+    src = tmp_path / "src"
+    (src / "mypkg" / "sub").mkdir(parents=True)
+    (src / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    (src / "mypkg" / "sub" / "__init__.py").write_text("")
+    (src / "mypkg" / "sub" / "mod.py").write_text("VALUE = 3\n")
+    (src / "mypkg" / "data.txt").write_text("data\n")
+    monkeypatch.syspath_prepend(str(src))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return src
+
+
+_LOAD = """
+import json, sys
+from pathlib import Path
+import nshsnap
+nshsnap.load_existing_snapshot(Path(sys.argv[1]))
+import importlib.resources, mypkg.sub.mod
+print(json.dumps({
+    "file": mypkg.sub.mod.__file__,
+    "value": mypkg.sub.mod.VALUE,
+    "data": importlib.resources.files(mypkg).joinpath("data.txt").read_text(),
+}))
+"""
+
+
+def test_zip_round_trip(package: Path, tmp_path: Path):
+    active = snapshot(
+        SnapshotConfig(
+            snapshot_dir=tmp_path / "snapshot",
+            modules=["mypkg"],
+            editable_modules=False,
+            on_module_not_found="raise",
+            format="zip",
+        )
+    )
+    archive = active.snapshot_dir / SNAPSHOT_ARCHIVE_NAME
+    assert active.python_path == archive
+    with zipfile.ZipFile(archive) as zf:
+        assert "mypkg/sub/mod.py" in zf.namelist()
+    # The modules are only in the archive
+    assert not (active.snapshot_dir / "mypkg").exists()
+
+    # Loaded in a new process, which does not have the sources on `sys.path`
+    output = subprocess.run(
+        [sys.executable, "-c", _LOAD, str(active.snapshot_dir)],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ""},
+    ).stdout
+    result = json.loads(output)
+    assert result["file"] == str(archive / "mypkg" / "sub" / "mod.py")
+    assert result["value"] == 3
+    assert result["data"] == "data\n"
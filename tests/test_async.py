@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, asnapshot, snapshot
+from nshsnap import _snapshot as snapshot_module
+from nshsnap._catalog import list_snapshots
+from nshsnap._lease import read_leases, release_lease
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A package with a subpackage, outside of any git repository."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+    src = tmp_path / "src"
+    (src / "mypkg" / "sub").mkdir(parents=True)
+    (src / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    (src / "mypkg" / "sub" / "__init__.py").write_text("VALUE = 2\n")
+    monkeypatch.syspath_prepend(str(src))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return src
+
+
+def _is_held(snapshot_dir: Path) -> bool:
+    return any(lease.snapshot_dir == snapshot_dir for lease in read_leases())
+
+
+def _config(snapshot_dir: Path | None, **kwargs):
+    return SnapshotConfig(
+        snapshot_dir=snapshot_dir,
+        modules=["mypkg"],
+        editable_modules=False,
+        on_module_not_found="raise",
+        **kwargs,
+    )
+
+
+async def _cancel_mid_copy(
+    config: SnapshotConfig, copy_step: str, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Start `asnapshot`, and cancel it once ``copy_step`` has copied the module
+    (but before the snapshot is finished).
+    """
+    copied = threading.Event()
+    resume = threading.Event()
+    copy = getattr(snapshot_module, copy_step)
+
+    def blocking_copy(*args):
+        stats = copy(*args)
+        copied.set()
+        resume.wait()
+        return stats
+
+    monkeypatch.setattr(snapshot_module, copy_step, blocking_copy)
+
+    task = asyncio.ensure_future(asnapshot(config))
+    await asyncio.get_running_loop().run_in_executor(None, copied.wait)
+    task.cancel()
+    resume.set()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_cancel_removes_generated_snapshot(
+    package: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    snapshots = tmp_path / "home" / ".cache" / "nshsnap" / "snapshots"
+    asyncio.run(_cancel_mid_copy(_config(None), "copy_tree", monkeypatch))
+
+    assert not snapshots.exists() or not any(snapshots.iterdir())
+    assert list_snapshots(include_incomplete=True) == []
+    assert read_leases() == []
+
+
+def test_cancel_keeps_existing_entries(
+    package: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    base = snapshot(_config(tmp_path / "base")).snapshot_dir
+    release_lease(base)
+
+    snapshot_dir = tmp_path / "snapshot"
+    snapshot_dir.mkdir()
+    (snapshot_dir / "keep.txt").write_text("keep\n")
+    asyncio.run(
+        _cancel_mid_copy(
+            _config(snapshot_dir, base_snapshot=base),
+            "copy_tree_incremental",
+            monkeypatch,
+        )
+    )
+
+    assert [path.name for path in snapshot_dir.iterdir()] == ["keep.txt"]
+    assert [
+        entry.snapshot_dir for entry in list_snapshots(include_incomplete=True)
+    ] == [base]
+    assert not _is_held(snapshot_dir)
+    assert not _is_held(base)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, snapshot_many
+
+requires_git = pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+
+
+def _git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=a", "-c", "user.email=a@b", *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A package with a subpackage that holds a symlink."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+    src = tmp_path / "src"
+    (src / "mypkg" / "sub").mkdir(parents=True)
+    (src / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    (src / "mypkg" / "sub" / "__init__.py").write_text("VALUE = 2\n")
+    (src / "mypkg" / "sub" / "mod.py").write_text("VALUE = 3\n")
+    (src / "mypkg" / "sub" / "link.py").symlink_to("mod.py")
+    monkeypatch.syspath_prepend(str(src))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return src
+
+
+def _snapshot_many(tmp_path: Path, reference_sets: list[dict[str, str]]):
+    return snapshot_many(
+        SnapshotConfig(
+            snapshot_dir=tmp_path / "snapshots",
+            modules=["mypkg", "mypkg.sub"],
+            editable_modules=False,
+            on_module_not_found="raise",
+        ),
+        reference_sets,
+    )
+
+
+def test_overlapping_modules(package: Path, tmp_path: Path):
+    actives = _snapshot_many(tmp_path, [{}, {}])
+
+    assert len(actives) == 2
+    for active in actives:
+        assert all(info.status == "success" for info in active.module_infos)
+        sub = active.snapshot_dir / "mypkg" / "sub"
+        assert (active.snapshot_dir / "mypkg" / "__init__.py").read_text() == (
+            "VALUE = 1\n"
+        )
+        assert (sub / "mod.py").read_text() == "VALUE = 3\n"
+        assert (sub / "link.py").readlink() == Path("mod.py")
+
+
+@requires_git
+def test_shared_files_are_linked_across_commits(package: Path, tmp_path: Path):
+    repo = package
+    _git(repo, "init", "-q")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "one")
+    (package / "mypkg" / "__init__.py").write_text("VALUE = 10\n")
+    _git(repo, "commit", "-q", "-am", "two")
+    one, two = (_git(repo, "rev-parse", ref).strip() for ref in ("HEAD~", "HEAD"))
+
+    actives = _snapshot_many(
+        tmp_path,
+        [
+            {"mypkg": one, "mypkg.sub": one},
+            {"mypkg": two, "mypkg.sub": two},
+        ],
+    )
+
+    assert all(
+        info.status == "success" for active in actives for info in active.module_infos
+    )
+    first, second = (active.snapshot_dir / "mypkg" for active in actives)
+    assert (first / "__init__.py").read_text() == "VALUE = 1\n"
+    assert (second / "__init__.py").read_text() == "VALUE = 10\n"
+    # Files that are the same at both commits are extracted once
+    assert (first / "sub" / "mod.py").samefile(second / "sub" / "mod.py")
+    assert (first / "sub" / "__init__.py").samefile(second / "sub" / "__init__.py")
+    assert not (first / "__init__.py").samefile(second / "__init__.py")
+    for snapshot in (first, second):
+        assert (snapshot / "sub" / "link.py").readlink() == Path("mod.py")
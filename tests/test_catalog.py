@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, list_snapshots, rebuild_catalog, snapshot
+from nshsnap._catalog import _complete_snapshot, _connect, _insert_snapshot
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
+def _add(snapshot_dir: Path, created: float, commits: dict[str, str] | None):
+    """Add a snapshot to the catalog, which is complete if it has ``commits``."""
+    snapshot_dir.mkdir(parents=True)
+    (snapshot_dir / "file").write_bytes(b"x" * 1000)
+    with _connect() as conn:
+        _insert_snapshot(conn, snapshot_dir, created, "directory", "hash", None)
+        if commits is not None:
+            _complete_snapshot(
+                conn,
+                snapshot_dir,
+                [(name, commit, None) for name, commit in commits.items()],
+                None,
+            )
+
+
+def test_list_snapshots(tmp_path: Path):
+    _add(tmp_path / "a", 1.0, {"mypkg": "abc123", "other": "ffff"})
+    _add(tmp_path / "b", 2.0, {"mypkg": "a[b]*9"})
+    _add(tmp_path / "c", 3.0, None)
+
+    def listed(**kwargs) -> list[str]:
+        return [entry.snapshot_dir.name for entry in list_snapshots(**kwargs)]
+
+    # Newest first, and only complete snapshots by default
+    assert listed() == ["b", "a"]
+    assert listed(include_incomplete=True) == ["c", "b", "a"]
+    assert listed(limit=1) == ["b"]
+
+    # Commit prefixes are matched literally, even with GLOB wildcards
+    assert listed(commit="a") == ["b", "a"]
+    assert listed(commit="abc") == ["a"]
+    assert listed(commit="a[b]") == ["b"]
+    assert listed(commit="a[b]*9") == ["b"]
+    assert listed(commit="a*") == []
+    assert listed(commit="a?") == []
+    assert listed(commit="ff") == ["a"]
+    assert listed(module="mypkg", commit="ff") == []
+    assert listed(module="other") == ["a"]
+
+    # Sizes are measured when the snapshots are first listed, and stored
+    entries = list_snapshots(include_incomplete=True)
+    assert [entry.size is not None for entry in entries] == [False, True, True]
+    with _connect() as conn:
+        sizes = dict(conn.execute("SELECT id, size FROM snapshots"))
+    assert sizes["a"] is not None and sizes["a"] >= 1000
+    assert sizes["c"] is None
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    src = tmp_path / "src"
+    (src / "mypkg").mkdir(parents=True)
+    (src / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    monkeypatch.syspath_prepend(str(src))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return src
+
+
+def test_rebuild_catalog(package: Path):
+    config = SnapshotConfig(
+        modules=["mypkg"], editable_modules=False, on_module_not_found="raise"
+    )
+    first = snapshot(config)
+    time.sleep(0.01)
+    second = snapshot(config)
+    assert [entry.snapshot_dir for entry in list_snapshots()] == [
+        second.snapshot_dir,
+        first.snapshot_dir,
+    ]
+
+    shutil.rmtree(first.snapshot_dir)
+    with _connect() as conn:
+        conn.execute("DELETE FROM snapshots")
+    assert list_snapshots() == []
+
+    # Existing snapshots are found again, and removed ones are dropped
+    assert rebuild_catalog() == 1
+    (entry,) = list_snapshots()
+    assert entry.snapshot_dir == second.snapshot_dir
+    assert entry.modules == {"mypkg": None}
+    assert entry.size is not None and entry.size > 0
+
+
+def test_rebuild_catalog_drops_removed_snapshots(package: Path):
+    config = SnapshotConfig(
+        modules=["mypkg"], editable_modules=False, on_module_not_found="raise"
+    )
+    removed = snapshot(config)
+    kept = snapshot(config)
+    shutil.rmtree(removed.snapshot_dir)
+
+    assert rebuild_catalog() == 1
+    assert [entry.snapshot_dir for entry in list_snapshots()] == [kept.snapshot_dir]
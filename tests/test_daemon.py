@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import json
+import socket
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from nshsnap import _daemon
+from nshsnap._config import SnapshotConfig
+from nshsnap._lease import hold_lease, read_leases
+from nshsnap._snapshot import ActiveSnapshot
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
+def _is_held(snapshot_dir: Path) -> bool:
+    return any(lease.snapshot_dir == snapshot_dir for lease in read_leases())
+
+
+def _wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_lease_is_held_until_the_client_acknowledges(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    snapshot_dir = tmp_path / "snapshot"
+    base_snapshot = tmp_path / "base"
+
+    def fake_snapshot(config: SnapshotConfig) -> ActiveSnapshot:
+        # `_snapshot` leases the new snapshot and the snapshot it is based on
+        hold_lease(snapshot_dir)
+        hold_lease(base_snapshot)
+        return ActiveSnapshot(config, snapshot_dir, [], base_snapshot=base_snapshot)
+
+    monkeypatch.setattr(_daemon, "_snapshot", fake_snapshot)
+
+    socket_path = tmp_path / "daemon.sock"
+    server = _daemon._Server(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        request = {
+            **_daemon._client_identity(),
+            "config": SnapshotConfig(modules=[]).model_dump(mode="json"),
+        }
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+            assert response["snapshot"]["snapshot_dir"] == str(snapshot_dir)
+
+            # The base snapshot is released once the request is done, but the
+            # snapshot stays leased until the client acknowledges
+            assert not _is_held(base_snapshot)
+            time.sleep(0.1)
+            assert _is_held(snapshot_dir)
+
+            sock.sendall(b"\n")
+            _wait_until(lambda: not _is_held(snapshot_dir))
+    finally:
+        server.shutdown()
+        server.server_close()
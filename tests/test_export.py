@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import io
+from pathlib import Path
+
+import pytest
+
+from nshsnap import _export
+from nshsnap._export import export_snapshot, import_snapshot
+from nshsnap._lease import hold_lease, read_leases, release_lease
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path: Path) -> Path:
+    snapshot_dir = tmp_path / "snapshot"
+    (snapshot_dir / ".nshsnapmeta").mkdir(parents=True)
+    (snapshot_dir / ".nshsnapmeta" / "modules.json").write_text("[]")
+    (snapshot_dir / "mod").mkdir()
+    (snapshot_dir / "mod" / "__init__.py").write_text("X = 1\n")
+    return snapshot_dir
+
+
+def _is_held(snapshot_dir: Path) -> bool:
+    return any(lease.snapshot_dir == snapshot_dir for lease in read_leases())
+
+
+def test_export_keeps_the_callers_lease(
+    snapshot_dir: Path, monkeypatch: pytest.MonkeyPatch
+):
+    held_during_export: list[bool] = []
+    normalize = _export._normalize
+
+    def check_lease(tarinfo):
+        held_during_export.append(_is_held(snapshot_dir))
+        return normalize(tarinfo)
+
+    monkeypatch.setattr(_export, "_normalize", check_lease)
+
+    hold_lease(snapshot_dir)
+    try:
+        export_snapshot(snapshot_dir, io.BytesIO(), compression="gzip")
+        assert held_during_export and all(held_during_export)
+        assert _is_held(snapshot_dir)
+    finally:
+        release_lease(snapshot_dir)
+    assert not _is_held(snapshot_dir)
+
+    # Without a lease of its own, the caller holds none after the export
+    held_during_export.clear()
+    export_snapshot(snapshot_dir, io.BytesIO(), compression="gzip")
+    assert held_during_export and all(held_during_export)
+    assert not _is_held(snapshot_dir)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "none"])
+def test_round_trip(tmp_path: Path, snapshot_dir: Path, compression):
+    archive = io.BytesIO()
+    export_snapshot(snapshot_dir, archive, compression=compression)
+    archive.seek(0)
+    imported = import_snapshot(archive, tmp_path / "imported")
+    assert (imported / "mod" / "__init__.py").read_text() == "X = 1\n"
+    assert (imported / ".bin" / "execute").is_file()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from nshsnap._util import extract_git_reference
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+
+
+def _git(repo: Path, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=a", "-c", "user.email=a@b", *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+
+
+@pytest.fixture
+def module(tmp_path: Path) -> Path:
+    """A module in a subdirectory of a repository, with uncommitted changes."""
+    repo = tmp_path / "repo"
+    module = repo / "src" / "mypkg"
+    (module / "sub").mkdir(parents=True)
+    (repo / "README").write_text("readme\n")
+    (module / "__init__.py").write_text("VALUE = 1\n")
+    (module / "sub" / "mod.py").write_text("VALUE = 2\n")
+    _git(repo, "init", "-q")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "one")
+    _git(repo, "tag", "v1")
+
+    (module / "__init__.py").write_text("VALUE = 10\n")
+    _git(repo, "commit", "-q", "-am", "two")
+    # Staged, unstaged and untracked changes
+    (module / "sub" / "mod.py").write_text("VALUE = 20\n")
+    _git(repo, "add", "src/mypkg/sub/mod.py")
+    (module / "__init__.py").write_text("VALUE = 100\n")
+    (module / "new.py").write_text("")
+    return module
+
+
+def _repository_state(repo: Path) -> tuple[str, ...]:
+    return (
+        _git(repo, "rev-parse", "HEAD"),
+        _git(repo, "symbolic-ref", "HEAD"),
+        _git(repo, "ls-files", "--stage"),
+        _git(repo, "status", "--porcelain"),
+        (repo / ".git" / "index").read_bytes().hex(),
+    )
+
+
+def test_extract_leaves_the_repository_untouched(module: Path, tmp_path: Path):
+    repo = module.parent.parent
+    before = _repository_state(repo)
+
+    destination = tmp_path / "out" / "mypkg"
+    commit = extract_git_reference(module, "v1", destination)
+
+    assert commit == _git(repo, "rev-parse", "v1").strip()
+    assert (destination / "__init__.py").read_text() == "VALUE = 1\n"
+    assert (destination / "sub" / "mod.py").read_text() == "VALUE = 2\n"
+    # Only the subtree of the module is extracted
+    assert sorted(
+        path.relative_to(destination).as_posix()
+        for path in destination.rglob("*")
+        if path.is_file()
+    ) == ["__init__.py", "sub/mod.py"]
+
+    assert _repository_state(repo) == before
+    assert (module / "__init__.py").read_text() == "VALUE = 100\n"
+    assert (module / "sub" / "mod.py").read_text() == "VALUE = 20\n"
+
+
+def test_extract_paths(module: Path, tmp_path: Path):
+    repo = module.parent.parent
+    before = _repository_state(repo)
+
+    destination = tmp_path / "out" / "mypkg"
+    extract_git_reference(module, "HEAD", destination, paths=["sub/mod.py"])
+
+    assert [
+        path.relative_to(destination).as_posix()
+        for path in destination.rglob("*")
+        if path.is_file()
+    ] == ["sub/mod.py"]
+    assert (destination / "sub" / "mod.py").read_text() == "VALUE = 2\n"
+    assert _repository_state(repo) == before
+
+
+def test_extract_unknown_reference(module: Path, tmp_path: Path):
+    with pytest.raises(subprocess.CalledProcessError):
+        extract_git_reference(module, "nope", tmp_path / "out")
+
+
+def test_extract_outside_of_a_repository(tmp_path: Path):
+    with pytest.raises(ValueError, match="not a git repository"):
+        extract_git_reference(tmp_path, "HEAD", tmp_path / "out")
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from nshsnap._ignore import IgnoreMatcher, walk_source_files
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+
+_ROOT_GITIGNORE = """\
+# Comments and blank lines are skipped
+
+*.log
+!keep.log
+build/
+!build/keep.txt
+/root_only.txt
+doc/*.txt
+**/cache
+a/**/z.py
+logs/**
+\\#hash.py
+[abc].py
+?x.py
+trailing.py   
+"""
+
+_SUB_GITIGNORE = """\
+*.tmp
+!important.log
+/local.py
+"""
+
+_FILES = [
+    "app.log",
+    "keep.log",
+    "main.py",
+    "build/out.py",
+    "build/keep.txt",
+    "docs/build",
+    "root_only.txt",
+    "sub/root_only.txt",
+    "doc/a.txt",
+    "doc/nested/b.txt",
+    "cache/x.py",
+    "deep/er/cache/y.py",
+    "a/z.py",
+    "a/b/c/z.py",
+    "a/b/y.py",
+    "logs/today/x.py",
+    "#hash.py",
+    "a.py",
+    "d.py",
+    "xx.py",
+    "x.py",
+    "trailing.py",
+    "sub/x.tmp",
+    "sub/important.log",
+    "sub/other.log",
+    "sub/local.py",
+    "sub/deeper/local.py",
+    "sub/deeper/x.tmp",
+]
+
+
+@pytest.fixture
+def tree(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    # Keep the user's git configuration (e.g., core.excludesFile) out of it
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", "/dev/null")
+
+    root = tmp_path / "repo"
+    for rel in _FILES:
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_text("")
+    (root / ".gitignore").write_text(_ROOT_GITIGNORE)
+    (root / "sub" / ".gitignore").write_text(_SUB_GITIGNORE)
+    subprocess.run(["git", "init", "-q", str(root)], check=True)
+    return root
+
+
+def _git(root: Path, *args: str, input: str | None = None) -> list[str]:
+    output = subprocess.run(
+        ["git", *args],
+        cwd=root,
+        input=input,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return sorted(line for line in output.split("\0") if line)
+
+
+def _check_ignore(root: Path, paths: list[str]) -> list[str]:
+    return _git(root, "check-ignore", "-z", "--stdin", input="\0".join(paths))
+
+
+def test_walk_source_files_matches_git(tree: Path):
+    expected = _git(tree, "ls-files", "-z", "--others", "--exclude-standard")
+    assert sorted(path.as_posix() for path in walk_source_files(tree)) == expected
+
+
+def test_ignore_matcher_matches_git(tree: Path):
+    paths = sorted({*_FILES, ".gitignore", "sub/.gitignore"})
+    expected = _check_ignore(tree, paths)
+    matcher = IgnoreMatcher(tree)
+    assert [path for path in paths if matcher.is_ignored(path, is_dir=False)] == (
+        expected
+    )
+
+
+@pytest.mark.parametrize(
+    ("path", "is_dir"),
+    [("build", True), ("docs/build", False), ("logs", True), ("sub/deeper", True)],
+)
+def test_ignore_matcher_directories(tree: Path, path: str, is_dir: bool):
+    expected = _check_ignore(tree, [path])
+    assert IgnoreMatcher(tree).is_ignored(path, is_dir) == bool(expected)
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+
+def test_import_is_lazy():
+    # A fresh interpreter, since the test session already imported everything
+    script = (
+        "import json, sys\nimport nshsnap\nprint(json.dumps(sorted(sys.modules)))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout
+    modules = set(json.loads(output))
+
+    for name in (
+        "asyncio",
+        "socketserver",
+        "sqlite3",
+        "tarfile",
+        "nshsnap._async",
+        "nshsnap._batch",
+        "nshsnap._catalog",
+        "nshsnap._daemon",
+        "nshsnap._export",
+        "nshsnap._gc",
+    ):
+        assert name not in modules, name
+
+
+def test_lazy_attributes():
+    import nshsnap
+    from nshsnap._async import asnapshot
+    from nshsnap._catalog import list_snapshots
+
+    assert nshsnap.asnapshot is asnapshot
+    assert nshsnap.list_snapshots is list_snapshots
+    assert "snapshot_many" in dir(nshsnap)
+    with pytest.raises(AttributeError):
+        nshsnap.missing  # pyright: ignore[reportAttributeAccessIssue]
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, snapshot
+from nshsnap._index import read_module_index
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A package with a subpackage and a namespace package."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+    src = tmp_path / "src"
+    (src / "mypkg" / "sub").mkdir(parents=True)
+    (src / "mypkg" / "ns").mkdir()
+    (src / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    (src / "mypkg" / "sub" / "__init__.py").write_text("from .mod import VALUE\n")
+    (src / "mypkg" / "sub" / "mod.py").write_text("VALUE = 3\n")
+    (src / "mypkg" / "ns" / "leaf.py").write_text("VALUE = 4\n")
+    monkeypatch.syspath_prepend(str(src))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return src
+
+
+_LOAD = """
+import json, sys
+from pathlib import Path
+import nshsnap
+from nshsnap._index import SnapshotModuleFinder
+snapshot_dir = Path(sys.argv[1])
+nshsnap.load_existing_snapshot(snapshot_dir, use_module_index=True)
+import mypkg.sub, mypkg.ns.leaf
+print(json.dumps({
+    "finder": isinstance(sys.meta_path[0], SnapshotModuleFinder),
+    "on_sys_path": str(snapshot_dir) in sys.path,
+    "files": [mypkg.__file__, mypkg.sub.mod.__file__, mypkg.ns.leaf.__file__],
+    "values": [mypkg.VALUE, mypkg.sub.VALUE, mypkg.ns.leaf.VALUE],
+    "other": sys.meta_path[0].find_spec("json", None) is None,
+}))
+"""
+
+
+@pytest.mark.parametrize("format", ["directory", "zip"])
+def test_imports_resolve_through_the_index(package: Path, tmp_path: Path, format):
+    active = snapshot(
+        SnapshotConfig(
+            snapshot_dir=tmp_path / "snapshot",
+            modules=["mypkg"],
+            editable_modules=False,
+            on_module_not_found="raise",
+            format=format,
+        )
+    )
+    index = read_module_index(active.snapshot_dir)
+    assert index is not None
+    assert index["mypkg.sub.mod"] == {
+        "origin": "mypkg/sub/mod.py",
+        "package": False,
+    }
+    assert index["mypkg.ns"] == {"origin": None, "package": True}
+
+    output = subprocess.run(
+        [sys.executable, "-c", _LOAD, str(active.snapshot_dir)],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ""},
+    ).stdout
+    result = json.loads(output)
+    assert result["finder"] and not result["on_sys_path"]
+    assert result["files"] == [
+        str(active.python_path / "mypkg" / "__init__.py"),
+        str(active.python_path / "mypkg" / "sub" / "mod.py"),
+        str(active.python_path / "mypkg" / "ns" / "leaf.py"),
+    ]
+    assert result["values"] == [1, 3, 4]
+    assert result["other"]
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from nshsnap._lease import hold_lease, leased, read_leases, release_lease
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
+def _is_held(snapshot_dir: Path) -> bool:
+    return any(lease.snapshot_dir == snapshot_dir for lease in read_leases())
+
+
+def test_nested_holds(tmp_path: Path):
+    snapshot_dir = tmp_path / "snapshot"
+    hold_lease(snapshot_dir)
+    with leased(snapshot_dir):
+        hold_lease(snapshot_dir)
+        release_lease(snapshot_dir)
+        assert _is_held(snapshot_dir)
+    assert _is_held(snapshot_dir)
+
+    release_lease(snapshot_dir)
+    assert not _is_held(snapshot_dir)
+
+    # Releasing a lease that is not held does nothing
+    release_lease(snapshot_dir)
+    with leased(snapshot_dir):
+        assert _is_held(snapshot_dir)
+    assert not _is_held(snapshot_dir)
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from nshsnap._manifest import ManifestBuilder, lookup_manifest, read_manifest
+
+_NAMES = [
+    "a",
+    "a.py",
+    "a\tb.py",
+    "a\nb.py",
+    "a\\b.py",
+    "a\\tb.py",
+    "b",
+    "sub/a.py",
+    "sub/a\t.py",
+    "sub/\n",
+    "z" * 200,
+]
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path: Path) -> Path:
+    snapshot_dir = tmp_path / "snapshot"
+    (snapshot_dir / ".nshsnapmeta").mkdir(parents=True)
+    for name in _NAMES:
+        path = snapshot_dir / "mypkg" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    (snapshot_dir / "mypkg" / "link.py").symlink_to("a.py")
+
+    builder = ManifestBuilder(snapshot_dir)
+    builder.add_tree(snapshot_dir / "mypkg")
+    builder.write()
+    return snapshot_dir
+
+
+def test_lookup_every_entry(snapshot_dir: Path):
+    entries = list(read_manifest(snapshot_dir))
+    assert sorted(entry.path for entry in entries) == sorted(
+        f"mypkg/{name}" for name in [*_NAMES, "link.py"]
+    )
+    for entry in entries:
+        assert lookup_manifest(snapshot_dir, entry.path) == entry
+        if entry.path != "mypkg/link.py":
+            assert entry.size == len(entry.path.encode()) - len("mypkg/")
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "",
+        "mypkg",
+        "mypkg/",
+        "mypkg/a\t",
+        "mypkg/a.p",
+        "mypkg/a\tb",
+        "mypkg/a\\",
+        "mypkg/aa",
+        "mypkg/sub",
+        "mypkg/sub/a",
+        "mypkg/zz",
+        "zzz",
+        "0",
+    ],
+)
+def test_lookup_missing(snapshot_dir: Path, path: str):
+    assert lookup_manifest(snapshot_dir, path) is None
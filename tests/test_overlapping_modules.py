@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, snapshot
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A package with a subpackage, outside of any git repository."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+    src = tmp_path / "src"
+    (src / "mypkg" / "sub").mkdir(parents=True)
+    (src / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    (src / "mypkg" / "sub" / "__init__.py").write_text("VALUE = 2\n")
+    (src / "mypkg" / "sub" / "mod.py").write_text("VALUE = 3\n")
+    monkeypatch.syspath_prepend(str(src))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return src
+
+
+def _snapshot(tmp_path: Path, name: str, **kwargs):
+    return snapshot(
+        SnapshotConfig(
+            snapshot_dir=tmp_path / name,
+            modules=["mypkg", "mypkg.sub"],
+            editable_modules=False,
+            on_module_not_found="raise",
+            **kwargs,
+        )
+    )
+
+
+def _assert_contents(snapshot_dir: Path):
+    assert (snapshot_dir / "mypkg" / "__init__.py").read_text() == "VALUE = 1\n"
+    assert (snapshot_dir / "mypkg" / "sub" / "__init__.py").read_text() == "VALUE = 2\n"
+    assert (snapshot_dir / "mypkg" / "sub" / "mod.py").read_text() == "VALUE = 3\n"
+
+
+@pytest.mark.parametrize("module_workers", [1, None])
+def test_store(package: Path, tmp_path: Path, module_workers: int | None):
+    (package / "mypkg" / "sub" / "link.py").symlink_to("mod.py")
+    active = _snapshot(
+        tmp_path,
+        "snapshot",
+        store=True,
+        store_dir=tmp_path / "store",
+        module_workers=module_workers,
+    )
+    assert all(info.status == "success" for info in active.module_infos)
+    _assert_contents(active.snapshot_dir)
+    assert (active.snapshot_dir / "mypkg" / "sub" / "link.py").readlink() == Path(
+        "mod.py"
+    )
+
+
+@pytest.mark.parametrize("copy_strategy", ["native", "hardlink"])
+@pytest.mark.parametrize("module_workers", [1, None])
+def test_copy_strategy(
+    package: Path,
+    tmp_path: Path,
+    copy_strategy: str,
+    module_workers: int | None,
+):
+    (package / "mypkg" / "sub" / "link.py").symlink_to("mod.py")
+    active = _snapshot(
+        tmp_path,
+        "snapshot",
+        copy_strategy=copy_strategy,
+        module_workers=module_workers,
+    )
+    assert all(info.status == "success" for info in active.module_infos)
+    _assert_contents(active.snapshot_dir)
+    assert (active.snapshot_dir / "mypkg" / "sub" / "link.py").readlink() == Path(
+        "mod.py"
+    )
+
+
+@pytest.mark.parametrize("base_snapshot", ["path", "latest"])
+def test_incremental(package: Path, tmp_path: Path, base_snapshot: str):
+    base = _snapshot(tmp_path, "base")
+    base_contents = (base.snapshot_dir / "mypkg" / "sub" / "mod.py").read_text()
+
+    (package / "mypkg" / "sub" / "mod.py").write_text("VALUE = 4\n")
+    active = _snapshot(
+        tmp_path,
+        "snapshot",
+        base_snapshot=base.snapshot_dir if base_snapshot == "path" else "latest",
+    )
+    assert all(info.status == "success" for info in active.module_infos)
+    assert active.base_snapshot == base.snapshot_dir
+    assert (active.snapshot_dir / "mypkg" / "sub" / "mod.py").read_text() == (
+        "VALUE = 4\n"
+    )
+    assert (active.snapshot_dir / "mypkg" / "__init__.py").samefile(
+        base.snapshot_dir / "mypkg" / "__init__.py"
+    )
+    # The base snapshot is not modified through its links
+    assert (base.snapshot_dir / "mypkg" / "sub" / "mod.py").read_text() == (
+        base_contents
+    )
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from nshsnap import SnapshotConfig, snapshot
+from nshsnap._reuse import snapshot_key
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+
+
+def _git(repo: Path, *args: str):
+    subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=a", "-c", "user.email=a@b", *args],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+
+
+@pytest.fixture
+def package(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A committed package in a git repository."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+    repo = tmp_path / "repo"
+    (repo / "mypkg").mkdir(parents=True)
+    (repo / "mypkg" / "__init__.py").write_text("VALUE = 1\n")
+    (repo / ".gitignore").write_text("*.log\n")
+    _git(repo, "init", "-q")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "one")
+
+    monkeypatch.syspath_prepend(str(repo))
+    for name in [name for name in sys.modules if name.split(".")[0] == "mypkg"]:
+        monkeypatch.delitem(sys.modules, name)
+    return repo / "mypkg"
+
+
+def _config() -> SnapshotConfig:
+    return SnapshotConfig(
+        modules=["mypkg"],
+        editable_modules=False,
+        on_module_not_found="raise",
+        reuse=True,
+    )
+
+
+def test_concurrent_snapshots_share_one_result(package: Path):
+    with ThreadPoolExecutor(4) as executor:
+        actives = list(executor.map(lambda _: snapshot(_config()), range(4)))
+
+    assert len({active.snapshot_dir for active in actives}) == 1
+    assert sum(not active.reused for active in actives) == 1
+    assert (actives[0].snapshot_dir / "mypkg" / "__init__.py").read_text() == (
+        "VALUE = 1\n"
+    )
+
+    # Later snapshots of the same state reuse it as well
+    assert snapshot(_config()).snapshot_dir == actives[0].snapshot_dir
+
+
+def test_dirty_worktree_changes_the_key(package: Path):
+    config = _config()
+
+    def key() -> str | None:
+        return snapshot_key(config, {"mypkg": package})
+
+    clean = key()
+    assert clean is not None and key() == clean
+
+    # Ignored files are not part of the snapshot
+    (package / "debug.log").write_text("")
+    assert key() == clean
+
+    (package / "__init__.py").write_text("VALUE = 2\n")
+    modified = key()
+    assert modified != clean
+
+    _git(package, "add", "__init__.py")
+    assert key() == modified
+
+    (package / "new.py").write_text("")
+    untracked = key()
+    assert untracked not in (clean, modified)
+
+    (package / "new.py").unlink()
+    (package / "__init__.py").write_text("VALUE = 1\n")
+    _git(package, "add", "__init__.py")
+    assert key() == clean
+
+
+def test_reused_snapshot_is_not_used_once_removed(package: Path):
+    first = snapshot(_config())
+    shutil.rmtree(first.snapshot_dir)
+
+    second = snapshot(_config())
+    assert not second.reused
+    assert second.snapshot_dir != first.snapshot_dir
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from nshsnap._stage_local import stage_locally
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path: Path) -> Path:
+    snapshot_dir = tmp_path / "snapshot"
+    (snapshot_dir / ".nshsnapmeta").mkdir(parents=True)
+    (snapshot_dir / ".nshsnapmeta" / "modules.json").write_text("[]")
+    (snapshot_dir / "mod.py").write_text("X = 1\n")
+    return snapshot_dir
+
+
+def test_private_stage_dir(tmp_path: Path, snapshot_dir: Path):
+    stage_dir = tmp_path / "stage"
+    python_path = stage_locally(snapshot_dir, stage_dir)
+    assert (python_path / "mod.py").read_text() == "X = 1\n"
+    assert stage_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_shared_stage_dir_is_refused(tmp_path: Path, snapshot_dir: Path):
+    stage_dir = tmp_path / "stage"
+    stage_dir.mkdir(mode=0o777)
+    stage_dir.chmod(0o777)
+    with pytest.raises(RuntimeError, match="accessible by other users"):
+        stage_locally(snapshot_dir, stage_dir)
+
+
+def test_symlinked_stage_dir_is_refused(tmp_path: Path, snapshot_dir: Path):
+    target = tmp_path / "elsewhere"
+    target.mkdir(mode=0o700)
+    stage_dir = tmp_path / "stage"
+    stage_dir.symlink_to(target)
+    with pytest.raises(RuntimeError, match="not a directory"):
+        stage_locally(snapshot_dir, stage_dir)
+    assert not any(target.iterdir())
@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from nshsnap._files import file_digest
+from nshsnap._store import SnapshotStore
+
+
+def test_blob_is_keyed_by_the_stored_contents(tmp_path: Path):
+    store = SnapshotStore(tmp_path / "store")
+    source = tmp_path / "mod.py"
+    source.write_text("VALUE = 1\n")
+    stale_digest = file_digest(source)
+
+    # The file changes after it was hashed, but before it is stored
+    source.write_text("VALUE = 2\n")
+    store.add(source, tmp_path / "linked.py", stale_digest)
+
+    assert (tmp_path / "linked.py").read_text() == "VALUE = 2\n"
+    assert not store.blob_path(stale_digest, executable=False).exists()
+    blob = store.blob_path(file_digest(source), executable=False)
+    assert blob.samefile(tmp_path / "linked.py")
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from nshsnap import _watch
+from nshsnap._watch import StagedModule
+
+pytestmark = [
+    pytest.mark.skipif(shutil.which("git") is None, reason="requires git"),
+    pytest.mark.skipif(sys.platform != "linux", reason="requires inotify"),
+]
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
+def _settle(staged: StagedModule):
+    # inotify events are queued asynchronously
+    time.sleep(0.05)
+    staged.handle_events()
+    staged.apply()
+
+
+def _staged_files(staged: StagedModule) -> set[str]:
+    return {
+        path.relative_to(staged.tree).as_posix()
+        for path in staged.tree.rglob("*")
+        if not path.is_dir()
+    }
+
+
+def test_ignore_files_outside_of_the_module(tmp_path: Path):
+    repo = tmp_path / "repo"
+    module = repo / "src" / "mypkg"
+    module.mkdir(parents=True)
+    (module / "__init__.py").write_text("")
+    subprocess.run(["git", "init", "-q", str(repo)], check=True)
+
+    staged = StagedModule("mypkg", module)
+    try:
+        staged.sync()
+        (module / "new.py").write_text("")
+        (module / "other.py").write_text("")
+        (module / "tracked.py").write_text("")
+        _settle(staged)
+        assert _staged_files(staged) == {
+            "__init__.py",
+            "new.py",
+            "other.py",
+            "tracked.py",
+        }
+
+        (repo / ".gitignore").write_text("new.py\ntracked.py\n")
+        _settle(staged)
+        assert _staged_files(staged) == {"__init__.py", "other.py"}
+
+        (repo / ".git" / "info" / "exclude").write_text("other.py\n")
+        _settle(staged)
+        assert _staged_files(staged) == {"__init__.py"}
+
+        # Tracked files are never ignored
+        subprocess.run(
+            ["git", "-C", str(repo), "add", "-f", "src/mypkg/tracked.py"], check=True
+        )
+        _settle(staged)
+        assert _staged_files(staged) == {"__init__.py", "tracked.py"}
+    finally:
+        staged.close()
+
+
+@pytest.fixture
+def overlapping(tmp_path: Path):
+    """Staged copies of a package and of its subpackage."""
+    repo = tmp_path / "repo"
+    module = repo / "src" / "mypkg"
+    (module / "sub").mkdir(parents=True)
+    (module / "__init__.py").write_text("VALUE = 1\n")
+    (module / "sub" / "__init__.py").write_text("VALUE = 2\n")
+    (module / "sub" / "mod.py").write_text("VALUE = 3\n")
+    (module / "sub" / "link.py").symlink_to("mod.py")
+    subprocess.run(["git", "init", "-q", str(repo)], check=True)
+
+    package = StagedModule("mypkg", module)
+    sub = StagedModule("mypkg.sub", module / "sub")
+    try:
+        package.sync()
+        sub.sync()
+        yield package, sub
+    finally:
+        package.close()
+        sub.close()
+
+
+@pytest.mark.parametrize("sub_first", [True, False])
+def test_freeze_overlapping_modules(
+    overlapping: tuple[StagedModule, StagedModule], tmp_path: Path, sub_first: bool
+):
+    package, sub = overlapping
+    destination = tmp_path / "snapshot" / "mypkg"
+    freezes = [(package, destination), (sub, destination / "sub")]
+    for staged, path in reversed(freezes) if sub_first else freezes:
+        staged.freeze(path)
+
+    assert (destination / "__init__.py").read_text() == "VALUE = 1\n"
+    assert (destination / "sub" / "mod.py").read_text() == "VALUE = 3\n"
+    assert (destination / "sub" / "link.py").readlink() == Path("mod.py")
+
+
+def test_failed_freeze_keeps_overlapping_module(
+    overlapping: tuple[StagedModule, StagedModule],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    package, sub = overlapping
+    destination = tmp_path / "snapshot" / "mypkg"
+    sub.freeze(destination / "sub")
+    frozen = sorted(path.name for path in (destination / "sub").iterdir())
+
+    freeze_file = _watch._freeze_file
+
+    def failing_freeze_file(staged: Path, path: Path):
+        if path.name == "mod.py":
+            raise OSError("injected failure")
+        freeze_file(staged, path)
+
+    monkeypatch.setattr(_watch, "_freeze_file", failing_freeze_file)
+    with pytest.raises(OSError, match="injected failure"):
+        package.freeze(destination)
+
+    # Only what the failed freeze created is removed
+    assert sorted(path.name for path in destination.iterdir()) == ["sub"]
+    assert sorted(path.name for path in (destination / "sub").iterdir()) == frozen
+    assert (destination / "sub" / "mod.py").read_text() == "VALUE = 3\n"